@@ -1,10 +1,11 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from midya.changelist import LargeTableMixin
 from .models import User
 
 
 @admin.register(User)
-class UserAdmin(BaseUserAdmin):
+class UserAdmin(LargeTableMixin, BaseUserAdmin):
     list_display = ['username', 'email', 'role', 'is_active', 'date_joined']
     list_filter = ['role', 'is_active', 'is_staff']
     fieldsets = BaseUserAdmin.fieldsets + (
@@ -1,5 +1,6 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models.functions import Lower
 
 
 class User(AbstractUser):
@@ -15,6 +16,12 @@ class User(AbstractUser):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Case-insensitive prefix search and ordering for the users directory
+            models.Index(Lower('username'), 'id', name='accounts_user_username_lower'),
+        ]
+    
     def is_owner(self):
         return self.role == 'owner'
     
@@ -1,11 +1,13 @@
 from rest_framework import serializers
+from midya.metrics import SerializerMetricsMixin
 from django.contrib.auth import get_user_model
 from django.contrib.auth.password_validation import validate_password
+from social.graph import get_graph
 
 User = get_user_model()
 
 
-class UserRegistrationSerializer(serializers.ModelSerializer):
+class UserRegistrationSerializer(SerializerMetricsMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=True, validators=[validate_password])
     password2 = serializers.CharField(write_only=True, required=True)
     
@@ -31,7 +33,7 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         return user
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SerializerMetricsMixin, serializers.ModelSerializer):
     followers_count = serializers.SerializerMethodField()
     following_count = serializers.SerializerMethodField()
     posts_count = serializers.SerializerMethodField()
@@ -66,12 +68,15 @@ class UserSerializer(serializers.ModelSerializer):
         return False
     
     def get_followers_count(self, obj):
-        return obj.followers.count()
+        return get_graph().follower_count(obj.id)
     
     def get_following_count(self, obj):
-        return obj.following.count()
+        return get_graph().following_count(obj.id)
     
     def get_posts_count(self, obj):
+        # Directory pages annotate the count with a correlated subquery
+        if hasattr(obj, 'posts_count'):
+            return obj.posts_count
         return obj.posts.count()
 
 
@@ -85,12 +90,12 @@ class UserDetailSerializer(UserSerializer):
     def get_is_following(self, obj):
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            return obj.followers.filter(follower=request.user).exists()
+            return get_graph().is_following(request.user.id, obj.id)
         return False
     
     def get_is_blocked(self, obj):
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            return obj.blocked_by.filter(blocker=request.user).exists()
+            return get_graph().is_blocked(request.user.id, obj.id)
         return False
 
@@ -0,0 +1,48 @@
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from .models import User
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SOCIAL_GRAPH_SNAPSHOT=None,
+)
+class UserChangeListTests(TestCase):
+    """
+    The user changelist (midya.changelist) runs the same number of queries
+    per page whatever the table size: unfiltered, filtered and keyset pages
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('root', 'root@example.com', 'pw')
+        # Enough rows for a second page (list_per_page is 100)
+        User.objects.bulk_create(
+            User(username=f'user{i}', email=f'user{i}@example.com', password='!') for i in range(120)
+        )
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def get_page(self, queries, query_string=''):
+        with self.assertNumQueries(queries):
+            response = self.client.get(reverse('admin:accounts_user_changelist') + query_string)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_unfiltered(self):
+        cl = self.get_page(5).context['cl']
+        self.assertEqual(cl.result_count, User.objects.count())
+        self.assertEqual(len(cl.result_list), cl.list_per_page)
+
+    def test_filtered(self):
+        cl = self.get_page(4, '?role__exact=regular').context['cl']
+        self.assertEqual(cl.result_count, User.objects.filter(role='regular').count())
+
+    def test_keyset_page(self):
+        cl = self.get_page(5).context['cl']
+        last_id = cl.result_list[len(cl.result_list) - 1].pk
+        older = self.get_page(4, cl.next_keyset_url()).context['cl']
+        self.assertTrue(older.result_list)
+        self.assertTrue(all(user.pk < last_id for user in older.result_list))
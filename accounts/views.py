@@ -1,17 +1,30 @@
 from rest_framework import status, generics, viewsets
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.decorators import action, api_view, permission_classes, throttle_classes
+from rest_framework.pagination import CursorPagination
+from rest_framework.permissions import AllowAny, IsAuthenticated, SAFE_METHODS
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from django.contrib.auth import get_user_model, authenticate
+from django.http import Http404
 from .serializers import UserRegistrationSerializer, UserSerializer, UserDetailSerializer
 from social.permissions import IsOwnerOrAdmin, IsOwner
+from social.multiget import MultiGetMixin
+from social.graph import get_graph
+from social.models import Follow
+from social.rowcache import get_user, get_users, with_posts_count
+from midya.throttling import WriteRateThrottle
 
 User = get_user_model()
 
 
+class RegisterRateThrottle(WriteRateThrottle):
+    # Anonymous, so limited per IP
+    scope = 'register'
+
+
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([RegisterRateThrottle])
 def register(request):
     serializer = UserRegistrationSerializer(data=request.data)
     if serializer.is_valid():
@@ -48,13 +61,23 @@ def profile(request):
     return Response(serializer.data)
 
 
-class UserViewSet(viewsets.ModelViewSet):
+class FollowersPagination(CursorPagination):
+    # Matches the social_follow_followers index, so a page is an index range
+    ordering = ('-created_at', '-follower_id')
+
+
+class FollowingPagination(CursorPagination):
+    ordering = ('-created_at', '-following_id')
+
+
+class UserViewSet(MultiGetMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [IsAuthenticated]
     
     def get_serializer_class(self):
-        if self.action == 'retrieve':
+        # Multi-get returns the viewer flags of the detail view
+        if self.action == 'retrieve' or 'ids' in self.request.query_params:
             return UserDetailSerializer
         return UserSerializer
     
@@ -62,6 +85,47 @@ class UserViewSet(viewsets.ModelViewSet):
         # Show all users (blocked users are still visible, just their posts are hidden)
         return User.objects.all()
     
+    def get_object(self):
+        # Reads come from the row cache; updates and deletes load the current row
+        if self.request.method not in SAFE_METHODS:
+            return super().get_object()
+        try:
+            user = get_user(int(self.kwargs['pk']))
+        except (User.DoesNotExist, ValueError):
+            raise Http404
+        self.check_object_permissions(self.request, user)
+        return user
+    
+    def get_multi_get_queryset(self):
+        return with_posts_count(User.objects.all())
+    
+    @action(detail=True, methods=['get'], pagination_class=FollowersPagination)
+    def followers(self, request, pk=None):
+        return self.follow_list('following_id', 'follower_id')
+    
+    @action(detail=True, methods=['get'], pagination_class=FollowingPagination)
+    def following(self, request, pk=None):
+        return self.follow_list('follower_id', 'following_id')
+    
+    def follow_list(self, user_field, other_field):
+        """
+        One cursor page of the users on the other side of ``user``'s follows,
+        without users the viewer blocked
+        """
+        user = self.get_object()
+        follows = Follow.objects.filter(**{user_field: user.id})
+        blocked_ids = get_graph().blocked_ids(self.request.user.id)
+        if blocked_ids:
+            follows = follows.exclude(**{f'{other_field}__in': list(blocked_ids)})
+        page = self.paginate_queryset(follows.values(other_field, 'created_at'))
+        
+        # Rows from the row cache, viewer flags from the in-memory graph
+        user_ids = [row[other_field] for row in page]
+        users = get_users(user_ids)
+        users = [users[user_id] for user_id in user_ids if user_id in users]
+        serializer = UserDetailSerializer(users, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
+    
     def destroy(self, request, *args, **kwargs):
         user = self.get_object()
         if not (request.user.is_admin() or request.user == user):
@@ -69,11 +133,11 @@ class UserViewSet(viewsets.ModelViewSet):
         
         # Create activity
         from social.models import Activity
-        Activity.objects.create(
-            activity_type='user_deleted',
+        from social.sharding import create_activity
+        create_activity(
+            verb=Activity.Verb.USER_DELETED,
             actor=request.user,
-            target_user=user,
-            description=f"User deleted by '{request.user.username}'"
+            target_user=user
         )
         
         user.delete()
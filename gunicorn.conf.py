@@ -0,0 +1,44 @@
+"""
+Gunicorn configuration: gunicorn -c gunicorn.conf.py midya.wsgi:application
+"""
+import gc
+import os
+import shutil
+import time
+
+START = time.time()
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+# Import and warm the app once in the master; workers share it copy-on-write
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# Shared by all workers so /metrics can merge their samples (midya.metrics)
+metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(BASE_DIR, 'var', 'metrics'))
+
+
+def on_starting(server):
+    # Samples left by a previous run would be counted again
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+    if server.cfg.preload_app:
+        from midya import boot
+        boot.warm()
+        server.log.info('Preloaded app in %.2fs: %s', time.time() - START, boot.format_timings())
+        # Keep the collector from writing to (and so copying) every shared page
+        gc.freeze()
+
+
+def post_worker_init(worker):
+    from midya import boot
+    if not worker.cfg.preload_app:
+        worker.log.info('Worker %s loaded app: %s', worker.pid, boot.format_timings())
+    memory = boot.memory_usage()
+    worker.log.info('Worker %s ready %.2fs after start, RSS %.0f MB, PSS %.0f MB', worker.pid,
+                    time.time() - START, memory.get('rss', 0), memory.get('pss', 0))
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
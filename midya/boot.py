@@ -0,0 +1,88 @@
+"""
+Boot timings and warm-up.
+
+``midya.wsgi`` records how long each boot phase takes in ``timings``. With
+``preload_app`` (see gunicorn.conf.py) the gunicorn master imports the
+application, runs ``warm()`` and freezes the garbage collector before
+forking. The workers then share the imported modules, model metadata, URL
+patterns and compiled templates copy-on-write instead of each building its
+own copy. gunicorn.conf.py logs the timings and each worker's memory use.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+timings = []
+
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append((name, time.perf_counter() - start))
+
+
+def format_timings():
+    return ', '.join(f'{name} {seconds * 1000:.0f} ms' for name, seconds in timings)
+
+
+def warm():
+    """
+    Build what Django and DRF otherwise build lazily on the first requests
+    """
+    from django.apps import apps
+    from django.db import connections
+    from django.template import engines
+    from django.urls import get_resolver
+    from rest_framework.serializers import Serializer
+
+    with phase('models'):
+        for model in apps.get_models():
+            model._meta.get_fields()
+            model._meta._relation_tree
+
+    with phase('urls'):
+        resolver = get_resolver()
+        resolver.reverse_dict
+        for namespace in list(resolver.namespace_dict):
+            resolver.namespace_dict[namespace][1].reverse_dict
+
+    with phase('serializers'):
+        for serializer in _subclasses(Serializer):
+            if serializer.__module__.split('.')[0] in ('accounts', 'social'):
+                serializer().fields
+
+    with phase('templates'):
+        for engine in engines.all():
+            for directory in getattr(engine, 'dirs', []):
+                for root, _, files in os.walk(directory):
+                    for name in files:
+                        if name.endswith('.html'):
+                            engine.get_template(os.path.relpath(os.path.join(root, name), directory))
+
+    # Workers must not inherit the master's database handles
+    connections.close_all()
+
+
+def _subclasses(cls):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        yield from _subclasses(subclass)
+
+
+def memory_usage():
+    """
+    Resident and proportional set size of this process in MB, from /proc
+    """
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('Rss', 'Pss'):
+                    usage[key.lower()] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return usage
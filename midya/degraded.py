@@ -0,0 +1,389 @@
+"""
+Degraded mode for when SQLite is overloaded.
+
+``LoadMonitor`` keeps the query times of the last ``DEGRADED_WINDOW``
+seconds in this process and notes "database is locked" errors. When the
+90th percentile of at least ``DEGRADED_MIN_SAMPLES`` queries crosses
+``DEGRADED_LATENCY_MS``, or the database reports a lock, the process turns
+degraded until a probe on a separate connection can read and take the
+write lock again quickly. A single slow query, such as an export or an
+admin changelist, does not move the percentile.
+
+While degraded, ``DegradedModeMiddleware``:
+
+* answers GET requests to ``DEGRADED_ROUTES`` with the last good response
+  stored for the same credentials, marked with ``Warning: 110`` and
+  ``X-Degraded: stale``, also when the request failed because it ran
+  into the lock itself. Such requests are queued and their responses
+  rebuilt in the background once the database recovers.
+* lets at most ``DEGRADED_MAX_WRITES`` write requests through at a time,
+  counted across all workers, and answers the rest with 503 and
+  ``Retry-After``.
+
+Good responses to those routes are stored at most every
+``DEGRADED_STORE_INTERVAL`` seconds per user and path, keyed by a hash of
+the session cookie or Authorization header and tagged with the user they
+were built for. Before a copy is served, the credentials are looked up
+once more (a primary-key read, which SQLite's WAL mode does not block):
+a logged-out session, a deleted or rotated token or a deactivated user
+gets no stale copy. Revalidation replays only the path and credentials of
+a request, on a request object of its own.
+"""
+import fcntl
+import hashlib
+import io
+import logging
+import os
+import queue
+import sqlite3
+from collections import deque
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, get_user_model
+from django.core.cache import cache
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import DatabaseError, OperationalError, connections
+from django.http import HttpResponse, JsonResponse
+from django.urls import Resolver404, resolve
+from django.utils.module_loading import import_module
+
+from .metrics import DEGRADED_RESPONSES
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PERCENTILE = 0.9
+# Latest query times kept, and how often they are checked (seconds)
+MAX_SAMPLES = 1000
+CHECK_INTERVAL = 1
+MAX_STORED_BYTES = 512 * 1024
+# What a revalidated request keeps of the original: its path, host and credentials
+REPLAYED_META = (
+    'PATH_INFO', 'SCRIPT_NAME', 'QUERY_STRING', 'SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL',
+    'REMOTE_ADDR', 'wsgi.url_scheme', 'HTTP_HOST', 'HTTP_ACCEPT', 'HTTP_AUTHORIZATION', 'HTTP_COOKIE',
+    'HTTP_X_FORWARDED_PROTO', 'HTTP_X_FORWARDED_FOR',
+)
+
+
+class LoadMonitor:
+    """
+    Database health as seen by this process
+    """
+
+    def __init__(self):
+        # (monotonic time, query ms)
+        self.samples = deque(maxlen=MAX_SAMPLES)
+        self.checked_at = 0.0
+        self.degraded = False
+        self.lock = threading.Lock()
+        self.samples_lock = threading.Lock()
+        self.recovered = threading.Event()
+        self.probe_thread = None
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper hook
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        except OperationalError as e:
+            if 'locked' in str(e):
+                self.enter('database is locked')
+            raise
+        finally:
+            self.record((time.perf_counter() - start) * 1000)
+
+    def record(self, elapsed_ms):
+        now = time.monotonic()
+        self.samples.append((now, elapsed_ms))
+        if self.degraded or now - self.checked_at < CHECK_INTERVAL:
+            return
+        latency = self.latency(now)
+        if latency is not None and latency > settings.DEGRADED_LATENCY_MS:
+            self.enter(f'p{PERCENTILE * 100:.0f} query time {latency:.0f} ms')
+
+    def latency(self, now):
+        """
+        The PERCENTILE query time over the window, or None with too few queries
+        """
+        with self.samples_lock:
+            self.checked_at = now
+            cutoff = now - settings.DEGRADED_WINDOW
+            while self.samples and self.samples[0][0] < cutoff:
+                self.samples.popleft()
+            times = sorted(elapsed_ms for _, elapsed_ms in self.samples)
+        if len(times) < settings.DEGRADED_MIN_SAMPLES:
+            return None
+        return times[min(int(len(times) * PERCENTILE), len(times) - 1)]
+
+    def enter(self, reason):
+        with self.lock:
+            if self.degraded:
+                return
+            logger.warning('Entering degraded mode: %s', reason)
+            self.degraded = True
+            self.recovered.clear()
+            self.probe_thread = threading.Thread(target=self.probe_until_recovered, name='db-probe', daemon=True)
+            self.probe_thread.start()
+
+    def probe(self):
+        """
+        Time one read and one write lock on a connection of our own
+        """
+        timeout = settings.DEGRADED_LATENCY_MS / 1000
+        start = time.perf_counter()
+        try:
+            db = sqlite3.connect(settings.DATABASES['default']['NAME'], timeout=timeout)
+            try:
+                db.execute('SELECT count(*) FROM sqlite_master').fetchone()
+                db.execute('BEGIN IMMEDIATE')
+                db.rollback()
+            finally:
+                db.close()
+        except sqlite3.OperationalError:
+            return None
+        return (time.perf_counter() - start) * 1000
+
+    def probe_until_recovered(self):
+        while True:
+            time.sleep(settings.DEGRADED_PROBE_INTERVAL)
+            elapsed = self.probe()
+            if elapsed is not None and elapsed < settings.DEGRADED_LATENCY_MS:
+                break
+        logger.warning('Leaving degraded mode')
+        # Times from the overload would turn it on again at once
+        with self.samples_lock:
+            self.samples.clear()
+        self.degraded = False
+        self.recovered.set()
+
+
+monitor = LoadMonitor()
+
+
+class WriteSlots:
+    """
+    A semaphore shared by all workers: a write holds an fcntl lock on one
+    byte of ``path``. The kernel drops the lock when a worker dies, so a
+    crashed request cannot leak its slot.
+    """
+
+    def __init__(self, path, size):
+        self.size = size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # fcntl locks are per process; this tracks our own threads' slots
+        self.held = set()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a free slot without waiting. Returns its number, or None.
+        """
+        with self.lock:
+            for slot in range(self.size):
+                if slot in self.held:
+                    continue
+                try:
+                    fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+                except OSError:
+                    continue
+                self.held.add(slot)
+                return slot
+        return None
+
+    def release(self, slot):
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, slot)
+            self.held.discard(slot)
+
+
+_writes = None
+_writes_pid = None
+
+
+def _write_slots():
+    global _writes, _writes_pid
+    # Opened per process, after gunicorn forks the workers
+    if _writes is None or _writes_pid != os.getpid():
+        _writes = WriteSlots(settings.DEGRADED_WRITE_LOCK_FILE, settings.DEGRADED_MAX_WRITES)
+        _writes_pid = os.getpid()
+    return _writes
+
+
+def replay_environ(request):
+    return {name: request.META[name] for name in REPLAYED_META if name in request.META}
+
+
+def fresh_request(environ):
+    """
+    A new GET request for a replayed environ, with an empty body
+    """
+    environ = dict(environ, REQUEST_METHOD='GET', CONTENT_LENGTH='0')
+    environ['wsgi.input'] = io.BytesIO()
+    return WSGIRequest(environ)
+
+
+def credential_user_id(request):
+    """
+    The id of the active user the request's token or session belongs to, or None
+    """
+    from rest_framework.authtoken.models import Token
+
+    User = get_user_model()
+    scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+    if scheme:
+        if scheme.lower() != 'token':
+            return None
+        return Token.objects.filter(key=key.strip(), user__is_active=True).values_list('user_id', flat=True).first()
+    session = import_module(settings.SESSION_ENGINE).SessionStore(request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+    user_id = session.get(SESSION_KEY)
+    if user_id is None:
+        return None
+    return User.objects.filter(pk=user_id, is_active=True).values_list('pk', flat=True).first()
+
+
+class Revalidator:
+    """
+    Rebuild the responses that were served stale once the database recovers
+    """
+
+    def __init__(self, get_response, store, max_pending=100):
+        self.get_response = get_response
+        self.store = store
+        self.pending = queue.Queue(max_pending)
+        self.keys = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, key, request):
+        with self.lock:
+            if key in self.keys:
+                return
+            try:
+                # The request itself has finished by the time it is replayed
+                self.pending.put_nowait((key, replay_environ(request)))
+            except queue.Full:
+                return
+            self.keys.add(key)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='stale-revalidator', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    key, environ = self.pending.get(timeout=60)
+                except queue.Empty:
+                    return
+                monitor.recovered.wait()
+                try:
+                    request = fresh_request(environ)
+                    response = self.get_response(request)
+                    self.store(key, response, request)
+                except Exception:
+                    logger.exception('Revalidating %s failed', environ.get('PATH_INFO'))
+                finally:
+                    with self.lock:
+                        self.keys.discard(key)
+        finally:
+            connections.close_all()
+
+
+class DegradedModeMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.routes = set(getattr(settings, 'DEGRADED_ROUTES', []))
+        self.revalidator = Revalidator(self.get_response, self.store)
+        self.stored_at = {}
+
+    def __call__(self, request):
+        if request.method not in SAFE_METHODS:
+            return self.write(request)
+        key = self.cache_key(request)
+        if key is None:
+            return self.run(request)
+        if monitor.degraded:
+            stale = self.stale(key, request)
+            if stale is not None:
+                self.revalidator.submit(key, request)
+                return self.stale_response(stale)
+        response = self.run(request)
+        if response.status_code >= 500 and monitor.degraded:
+            # This request ran into the lock itself
+            stale = self.stale(key, request)
+            if stale is not None:
+                return self.stale_response(stale)
+        elif not monitor.degraded and time.monotonic() - self.stored_at.get(key, -1e9) > settings.DEGRADED_STORE_INTERVAL:
+            self.store(key, response, request)
+        return response
+
+    def run(self, request):
+        with connections['default'].execute_wrapper(monitor):
+            return self.get_response(request)
+
+    def write(self, request):
+        if not monitor.degraded:
+            return self.run(request)
+        slots = _write_slots()
+        slot = slots.acquire()
+        if slot is None:
+            DEGRADED_RESPONSES.labels('shed').inc()
+            response = JsonResponse({'error': 'The service is overloaded, please retry shortly'}, status=503)
+            response['Retry-After'] = str(settings.DEGRADED_RETRY_AFTER)
+            return response
+        try:
+            return self.run(request)
+        finally:
+            slots.release(slot)
+
+    def cache_key(self, request):
+        if request.method != 'GET':
+            return None
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+        if match.view_name not in self.routes:
+            return None
+        credentials = request.headers.get('Authorization') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if not credentials:
+            return None
+        request.resolver_match = match
+        digest = hashlib.sha256(f'{credentials}\n{request.get_full_path()}'.encode()).hexdigest()
+        return f'stale:2:{digest}'
+
+    def store(self, key, response, request):
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_authenticated:
+            return
+        if response.status_code != 200 or getattr(response, 'streaming', False) or len(response.content) > MAX_STORED_BYTES:
+            return
+        cache.set(key, (response.content, response['Content-Type'], time.time(), user.pk), settings.DEGRADED_STALE_TIMEOUT)
+        if len(self.stored_at) > 10000:
+            self.stored_at.clear()
+        self.stored_at[key] = time.monotonic()
+
+    def stale(self, key, request):
+        """
+        The stored copy, if the credentials still belong to the user it was stored for
+        """
+        stale = cache.get(key)
+        if stale is None:
+            return None
+        try:
+            user_id = credential_user_id(request)
+        except DatabaseError:
+            return None
+        return stale if user_id is not None and user_id == stale[3] else None
+
+    def stale_response(self, stale):
+        content, content_type, stored, _ = stale
+        DEGRADED_RESPONSES.labels('stale').inc()
+        response = HttpResponse(content, content_type=content_type)
+        response['Warning'] = '110 - "Response is Stale"'
+        response['X-Degraded'] = 'stale'
+        response['Age'] = str(int(time.time() - stored))
+        response['Cache-Control'] = 'private, no-store'
+        return response
@@ -0,0 +1,148 @@
+"""
+Content-addressed media storage and serving.
+
+Uploads are stored under the SHA-256 of their content
+(``ab/cd/abcd....jpg``), whatever name or ``upload_to`` directory they
+arrived with, so identical files are written once and shared by every row
+that references them. Because a name can only ever hold one content,
+``serve_media`` marks those files immutable and uses the hash as ETag.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import FileSystemStorage
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.views.decorators.http import require_safe
+
+HASHED_NAME = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/(?P<digest>[0-9a-f]{64})(\.[0-9a-z]{1,10})?$')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+CHUNK_SIZE = 64 * 1024
+
+
+def hashed_name(digest, name):
+    ext = os.path.splitext(name)[1].lower()
+    if not re.fullmatch(r'\.[0-9a-z]{1,10}', ext):
+        ext = ''
+    return f'{digest[:2]}/{digest[2:4]}/{digest}{ext}'
+
+
+def file_digest(content):
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        # The final name comes from the content in _save(), never a suffix
+        return name
+
+    def _save(self, name, content):
+        name = hashed_name(file_digest(content), name)
+        path = self.path(name)
+        if os.path.exists(path):
+            return name
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                for chunk in content.chunks():
+                    fh.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp, self.file_permissions_mode)
+            # A concurrent upload of the same content writes identical bytes
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return name
+
+
+def _etag(name, stat):
+    match = HASHED_NAME.match(name)
+    if match:
+        return f'"{match.group("digest")}"'
+    return f'"{stat.st_size:x}-{int(stat.st_mtime):x}"'
+
+
+def _parse_range(header, size):
+    """
+    Return (start, end) for a single ``bytes=`` range, None to ignore the header
+    or False when it cannot be satisfied.
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        while length > 0:
+            chunk = fh.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+@require_safe
+def serve_media(request, path):
+    """
+    Serve a media file with ETag/304 handling and single byte ranges
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+    stat = os.stat(full_path)
+    etag = _etag(path, stat)
+    cache_control = IMMUTABLE if HASHED_NAME.match(path) else 'public, max-age=3600'
+
+    if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Cache-Control'] = cache_control
+        return response
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    byte_range = None
+    if 'Range' in request.headers and request.headers.get('If-Range', etag) == etag:
+        byte_range = _parse_range(request.headers['Range'], stat.st_size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+    elif byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(_read_range(full_path, start, end - start + 1),
+                                         status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response
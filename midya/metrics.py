@@ -0,0 +1,187 @@
+"""
+Prometheus metrics for requests, database queries, caches and serializers.
+
+Metrics are recorded with prometheus_client in multiprocess mode: every
+gunicorn worker writes its samples to memory-mapped files under
+``PROMETHEUS_MULTIPROC_DIR`` and ``metrics_view`` merges the files of all
+workers at scrape time. ``gunicorn.conf.py`` clears the directory when the
+server starts and marks exited workers dead.
+
+Requests are labelled by route, the URL name the request resolved to
+(``post-list``, ``post-like``, ``feed``, ...), never by raw path.
+"""
+import hmac
+import time
+
+from django.conf import settings
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import CollectorRegistry, Counter, Histogram, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+REQUESTS = Counter(
+    'midya_http_requests_total', 'HTTP requests by route, method and status',
+    ['route', 'method', 'status'],
+)
+LATENCY = Histogram(
+    'midya_http_request_duration_seconds', 'Time spent handling a request',
+    ['route', 'method'], buckets=LATENCY_BUCKETS,
+)
+DB_QUERIES = Histogram(
+    'midya_http_request_db_queries', 'Database queries executed per request',
+    ['route'], buckets=QUERY_BUCKETS,
+)
+DB_TIME = Histogram(
+    'midya_http_request_db_seconds', 'Time spent in database queries per request',
+    ['route'], buckets=LATENCY_BUCKETS,
+)
+CACHE_REQUESTS = Counter(
+    'midya_cache_requests_total', 'Cache lookups by cache and result',
+    ['cache', 'result'],
+)
+DEGRADED_RESPONSES = Counter(
+    'midya_degraded_responses_total', 'Responses served stale or shed while the database was overloaded',
+    ['result'],
+)
+SERIALIZER_TIME = Histogram(
+    'midya_serializer_seconds', 'Time spent serializing one object',
+    ['serializer'], buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5),
+)
+
+
+def route_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.view_name or match._func_path
+
+
+class QueryTimer:
+    """
+    connection.execute_wrapper hook counting queries and their time
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with connections['default'].execute_wrapper(timer):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        route = route_name(request)
+        REQUESTS.labels(route, request.method, str(response.status_code)).inc()
+        LATENCY.labels(route, request.method).observe(duration)
+        DB_QUERIES.labels(route).observe(timer.count)
+        DB_TIME.labels(route).observe(timer.duration)
+        return response
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+class CacheMetricsMixin:
+    """
+    Count hits and misses of a Django cache backend under its alias
+    """
+    _missing = object()
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self.metrics_name = params.get('OPTIONS', {}).get('METRICS_NAME', name or 'default')
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, self._missing, version)
+        record_cache(self.metrics_name, value is not self._missing)
+        return default if value is self._missing else value
+
+    def get_many(self, keys, version=None):
+        # Per-key lookups like BaseCache.get_many, which would count each key twice through get()
+        keys = list(keys)
+        found = {}
+        for key in keys:
+            value = super().get(key, self._missing, version)
+            if value is not self._missing:
+                found[key] = value
+        if len(found):
+            CACHE_REQUESTS.labels(self.metrics_name, 'hit').inc(len(found))
+        if len(keys) - len(found):
+            CACHE_REQUESTS.labels(self.metrics_name, 'miss').inc(len(keys) - len(found))
+        return found
+
+
+class InstrumentedLocMemCache(CacheMetricsMixin, LocMemCache):
+    pass
+
+
+class InstrumentedFileBasedCache(CacheMetricsMixin, FileBasedCache):
+    """
+    File cache shared by all workers. FileBasedCache lists the whole
+    directory on every set() to decide whether to cull; only do that
+    every CULL_CHECK_INTERVAL sets.
+    """
+    CULL_CHECK_INTERVAL = 100
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self._sets = 0
+
+    def _cull(self):
+        self._sets += 1
+        if self._sets % self.CULL_CHECK_INTERVAL == 0:
+            super()._cull()
+
+
+class SerializerMetricsMixin:
+    """
+    Time to_representation() per object, labelled with the serializer class
+    """
+
+    def to_representation(self, instance):
+        start = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            SERIALIZER_TIME.labels(type(self).__name__).observe(time.perf_counter() - start)
+
+
+def _authorized(request):
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    if token and header.startswith('Bearer '):
+        return hmac.compare_digest(header[len('Bearer '):], token)
+    return request.user.is_authenticated and (request.user.is_staff or request.user.is_admin())
+
+
+def metrics_view(request):
+    """
+    Expose the metrics of all worker processes in the Prometheus text format.
+    Requires ``Authorization: Bearer <METRICS_TOKEN>`` or an admin session.
+    """
+    if not _authorized(request):
+        return HttpResponseForbidden('Forbidden')
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
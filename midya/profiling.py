@@ -0,0 +1,239 @@
+"""
+On-demand request profiling.
+
+A request is profiled when an admin sends ``X-Profile: sample`` (stack
+sampling) or ``X-Profile: cprofile``, or when it falls into the
+``PROFILE_SAMPLE_RATE`` fraction of traffic. Every other request costs one
+header lookup and, with a non-zero sample rate, one random() call.
+
+Each profile is written to ``PROFILE_DIR`` as ``<id>.json`` (request
+details and the SQL trace) plus either ``<id>.folded`` (collapsed stacks,
+ready for flamegraph.pl or speedscope) or ``<id>.prof`` (pstats, for
+snakeviz). Only the newest ``PROFILE_KEEP`` profiles are kept. Admins can
+browse them under ``/admin/profiles/``.
+"""
+import cProfile
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib import admin
+from django.db import connections
+from django.http import FileResponse, Http404
+from django.shortcuts import render
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+MODES = ('sample', 'cprofile')
+SQL_TRACE_LIMIT = 1000
+_ROOTS = sorted({os.path.abspath(p) for p in sys.path if p}, key=len, reverse=True)
+
+
+def profile_dir():
+    return settings.PROFILE_DIR
+
+
+class StackSampler:
+    """
+    Count the call stacks of one thread from a background thread
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, 'w') as fh:
+            for stack, count in self.stacks.most_common():
+                fh.write(f'{stack} {count}\n')
+
+
+class CProfiler:
+    def __init__(self, interval=None):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+
+PROFILERS = {'sample': (StackSampler, 'folded'), 'cprofile': (CProfiler, 'prof')}
+
+
+def _short_path(filename):
+    for root in _ROOTS:
+        if filename.startswith(root + os.sep):
+            return filename[len(root) + 1:]
+    return filename
+
+
+class SQLTrace:
+    """
+    connection.execute_wrapper hook recording each statement and its time
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.total = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.total += 1
+            if len(self.queries) < SQL_TRACE_LIMIT:
+                self.queries.append({'sql': sql, 'many': many, 'ms': round((time.perf_counter() - start) * 1000, 3)})
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0.0)
+
+    def __call__(self, request):
+        mode = self.requested_mode(request)
+        if mode is None:
+            return self.get_response(request)
+        return self.profile(request, mode)
+
+    def requested_mode(self, request):
+        header = request.META.get('HTTP_X_PROFILE')
+        if header:
+            mode = header.lower() if header.lower() in MODES else 'sample'
+            return mode if _is_admin(request) else None
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'sample'
+        return None
+
+    def profile(self, request, mode):
+        profiler_class, extension = PROFILERS[mode]
+        profiler = profiler_class(getattr(settings, 'PROFILE_SAMPLE_INTERVAL', 0.002))
+        trace = SQLTrace()
+        started_at = datetime.now()
+        start = time.perf_counter()
+        with connections['default'].execute_wrapper(trace):
+            profiler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.stop()
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        route = match.view_name if match else 'unmatched'
+        profile_id = '{}-{}-{}'.format(started_at.strftime('%Y%m%dT%H%M%S%f'), route.replace(':', '_'), os.getpid())
+        os.makedirs(profile_dir(), exist_ok=True)
+        profiler.write(os.path.join(profile_dir(), f'{profile_id}.{extension}'))
+        with open(os.path.join(profile_dir(), f'{profile_id}.json'), 'w') as fh:
+            json.dump({
+                'id': profile_id,
+                'mode': mode,
+                'output': f'{profile_id}.{extension}',
+                'method': request.method,
+                'path': request.get_full_path(),
+                'route': route,
+                'user': str(request.user) if getattr(request, 'user', None) else None,
+                'status': response.status_code,
+                'started_at': started_at.isoformat(),
+                'duration_ms': round(duration * 1000, 3),
+                'query_count': trace.total,
+                'query_ms': round(sum(q['ms'] for q in trace.queries), 3),
+                'queries': trace.queries,
+            }, fh, indent=1)
+        rotate_profiles(getattr(settings, 'PROFILE_KEEP', 200))
+        response['X-Profile-Id'] = profile_id
+        return response
+
+
+def _is_admin(request):
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        # API clients authenticate with a token, which DRF only checks inside the view
+        try:
+            result = TokenAuthentication().authenticate(request)
+        except AuthenticationFailed:
+            return False
+        if result is None:
+            return False
+        user = result[0]
+    return user.is_staff or user.is_admin()
+
+
+def list_profiles():
+    """
+    Profile metadata, newest first
+    """
+    if not os.path.isdir(profile_dir()):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(profile_dir()), reverse=True):
+        if name.endswith('.json'):
+            try:
+                with open(os.path.join(profile_dir(), name)) as fh:
+                    profiles.append(json.load(fh))
+            except (OSError, ValueError):
+                continue
+    return profiles
+
+
+def rotate_profiles(keep):
+    names = sorted(name[:-len('.json')] for name in os.listdir(profile_dir()) if name.endswith('.json'))
+    for profile_id in names[:-keep] if keep else names:
+        for extension in ('json', 'folded', 'prof'):
+            try:
+                os.remove(os.path.join(profile_dir(), f'{profile_id}.{extension}'))
+            except FileNotFoundError:
+                pass
+
+
+@admin.site.admin_view
+def profiles_view(request):
+    return render(request, 'admin/profiles.html', {
+        **admin.site.each_context(request),
+        'title': 'Request profiles',
+        'profiles': list_profiles(),
+    })
+
+
+@admin.site.admin_view
+def profile_file(request, name):
+    # Only files written by the profiler, never arbitrary paths
+    if os.sep in name or name.startswith('.') or not name.endswith(('.json', '.folded', '.prof')):
+        raise Http404
+    path = os.path.join(profile_dir(), name)
+    if not os.path.exists(path):
+        raise Http404
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=name)
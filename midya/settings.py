@@ -10,11 +10,16 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Runtime state written by the app (snapshots, archives, ...)
+VAR_DIR = BASE_DIR / 'var'
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -44,12 +49,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'midya.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'midya.degraded.DegradedModeMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'midya.profiling.ProfilingMiddleware',
+    'social.rowcache.IdentityMapMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -77,10 +86,27 @@ WSGI_APPLICATION = 'midya.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Tuned for several gunicorn workers writing at once
+SQLITE_OPTIONS = {
+    'timeout': 10,  # busy_timeout: seconds to wait for the write lock before "database is locked"
+    'transaction_mode': 'IMMEDIATE',  # atomic() takes the write lock at BEGIN instead of failing to upgrade later
+    'init_command': ';'.join([
+        'PRAGMA journal_mode=WAL',  # readers and the writer no longer block each other
+        'PRAGMA synchronous=NORMAL',  # fsync on checkpoint instead of every commit; durable with WAL
+        'PRAGMA mmap_size=268435456',  # read up to 256 MB through the page cache
+        'PRAGMA cache_size=-32000',  # 32 MB page cache per connection
+        'PRAGMA temp_store=MEMORY',
+    ]),
+}
+SQLITE_CONN_MAX_AGE = 600  # seconds a worker keeps its connection open
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': SQLITE_OPTIONS,
+        'CONN_MAX_AGE': SQLITE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
@@ -122,11 +148,26 @@ USE_TZ = True
 STATIC_URL = 'static/'
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 STATICFILES_DIRS = [BASE_DIR / 'static']
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+
+STORAGES = {
+    # Uploads are stored once per distinct content (midya.media)
+    'default': {
+        'BACKEND': 'midya.media.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
 
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Chunked image uploads (social.uploads)
+UPLOAD_TEMP_DIR = VAR_DIR / 'uploads'
+UPLOAD_MAX_SIZE = 20 * 1024 * 1024  # bytes per image
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # largest chunk accepted per request
+UPLOAD_EXPIRY_HOURS = 24  # pending uploads without progress are discarded
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -146,4 +187,102 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
+    # Write limits per throttle_scope (midya.throttling); <scope>_ip applies per client IP
+    'DEFAULT_THROTTLE_CLASSES': [
+        'midya.throttling.WriteRateThrottle',
+        'midya.throttling.WriteIPRateThrottle',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        'like': '120/min',
+        'like_ip': '600/min',
+        'follow': '60/min',
+        'follow_ip': '300/min',
+        'register': '10/hour',
+    },
 }
+
+# Shared throttle counters; /dev/shm keeps them in memory for every worker
+THROTTLE_FILE = '/dev/shm/midya-throttle' if os.path.isdir('/dev/shm') else str(VAR_DIR / 'throttle')
+THROTTLE_SLOTS = 65536  # counter slots, 24 bytes each
+
+# Filtered admin changelists count at most this many rows (midya.changelist)
+ADMIN_COUNT_LIMIT = 10000
+
+# Largest ?ids= list accepted by the multi-get list routes (social.multiget)
+MULTI_GET_MAX_IDS = 100
+
+# In-memory follow/block graph index (social.graph)
+SOCIAL_GRAPH_SNAPSHOT = VAR_DIR / 'graph.snapshot'
+SOCIAL_GRAPH_SYNC_INTERVAL = 1.0  # seconds between event log polls
+SOCIAL_GRAPH_MAX_PENDING = 10000  # overlay edges before compacting into the CSR arrays
+
+# Activity retention (manage.py archive_activities)
+ACTIVITY_RETENTION_DAYS = 90
+ACTIVITY_ARCHIVE_DIR = VAR_DIR / 'archive' / 'activities'
+
+# Delta sync change log (social.changelog); prune with manage.py prune_changelog
+SYNC_PAGE_SIZE = 500  # change log entries per /api/sync/ response
+CHANGELOG_RETENTION_DAYS = 30  # older cursors get a 410 and must resync
+
+# Activity shards (social.sharding); 0 keeps activities in the main database.
+# After changing the count run: python manage.py rebalance_shards
+SOCIAL_SHARD_COUNT = int(os.environ.get('SOCIAL_SHARD_COUNT', '0'))
+SOCIAL_SHARD_DIR = VAR_DIR / 'shards'
+if SOCIAL_SHARD_COUNT:
+    SOCIAL_SHARD_DIR.mkdir(parents=True, exist_ok=True)
+# manage.py test also gets two shards, used by the tests that enable sharding
+_TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+for _shard in range(SOCIAL_SHARD_COUNT or (2 if _TESTING else 0)):
+    DATABASES[f'shard{_shard}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': SOCIAL_SHARD_DIR / f'activity-{_shard}.sqlite3',
+        'OPTIONS': SQLITE_OPTIONS,
+        'CONN_MAX_AGE': SQLITE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+    }
+DATABASE_ROUTERS = ['social.sharding.ShardRouter']
+
+# Like write coalescing, shared by all workers; see social/likes.py
+SOCIAL_LIKE_COALESCING = False
+SOCIAL_LIKE_FLUSH_INTERVAL = 0.25  # seconds between buffer flushes
+SOCIAL_LIKE_MAX_PENDING = 5000  # buffered toggles before flushing inline
+SOCIAL_LIKE_BUFFER_FILE = '/dev/shm/midya-likes' if os.path.isdir('/dev/shm') else str(VAR_DIR / 'likes')
+
+# Shared by all gunicorn workers, so invalidations and warmed entries reach every process
+CACHES = {
+    'default': {
+        'BACKEND': 'midya.metrics.InstrumentedFileBasedCache',
+        'LOCATION': VAR_DIR / 'cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    }
+}
+
+# Post/User row cache (social.rowcache)
+ROW_CACHE_TIMEOUT = 300  # seconds; bounds staleness if a version token is evicted
+FEED_CACHE_TIMEOUT = 3600  # cached feed pages (social.feed), see manage.py warm_caches
+
+# Degraded mode (midya.degraded): serve stale reads and shed writes while SQLite is overloaded
+DEGRADED_ROUTES = ['feed', 'post-list', 'activity-list']  # URL names whose last good response is kept
+DEGRADED_LATENCY_MS = 500  # 90th percentile query time that turns degraded mode on
+DEGRADED_WINDOW = 10  # seconds of query times the percentile is taken over
+DEGRADED_MIN_SAMPLES = 20  # queries needed in the window before latency counts
+DEGRADED_PROBE_INTERVAL = 1  # seconds between recovery probes
+DEGRADED_MAX_WRITES = 1  # concurrent write requests across all workers while degraded
+DEGRADED_WRITE_LOCK_FILE = '/dev/shm/midya-degraded-writes' if os.path.isdir('/dev/shm') else str(VAR_DIR / 'degraded-writes')
+DEGRADED_RETRY_AFTER = 5  # seconds, sent with shed writes
+DEGRADED_STORE_INTERVAL = 10  # seconds between stored copies of one user's page
+DEGRADED_STALE_TIMEOUT = 86400  # how long a stored copy can be served
+
+# Prometheus metrics (midya.metrics). Must be set before prometheus_client is
+# imported; gunicorn.conf.py sets the same directory for all workers.
+METRICS_DIR = Path(os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', str(VAR_DIR / 'metrics')))
+METRICS_DIR.mkdir(parents=True, exist_ok=True)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # bearer token for scraping /metrics
+
+# Request profiling (midya.profiling); admins can force it with X-Profile
+PROFILE_DIR = VAR_DIR / 'profiles'
+PROFILE_SAMPLE_RATE = 0.0  # fraction of all requests to profile
+PROFILE_SAMPLE_INTERVAL = 0.002  # seconds between stack samples
+PROFILE_KEEP = 200  # newest profiles kept on disk
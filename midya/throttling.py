@@ -0,0 +1,141 @@
+"""
+Sliding-window rate limits shared by all gunicorn workers.
+
+Counters live in a fixed-size table in a memory-mapped file
+(``THROTTLE_FILE``, on /dev/shm by default), so every worker sees the
+same counts and a check never touches the database. A key hashes to one
+slot holding the current and the previous fixed window. The request count
+over the last ``duration`` seconds is estimated as::
+
+    previous * (1 - elapsed fraction of the current window) + current
+
+so a check is one slot read and write under a byte-range lock, O(1)
+however many requests the key made. Two keys landing in the same slot
+evict each other, which at worst resets a counter.
+
+``WriteRateThrottle`` limits a user (or an anonymous client's IP) and
+``WriteIPRateThrottle`` an IP, both per ``throttle_scope`` and only for
+unsafe methods. Rates are ``REST_FRAMEWORK['DEFAULT_THROTTLE_RATES']``
+entries named after the scope, ``<scope>_ip`` for the IP limit. Scopes
+without a rate are not limited.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.conf import settings
+from rest_framework.throttling import SimpleRateThrottle
+
+# Key hash, window number, requests in that window, requests in the window before
+SLOT = struct.Struct('=QqII')
+
+
+class SharedCounters:
+    def __init__(self, path, slots):
+        self.slots = slots
+        size = SLOT.size * slots
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        # fcntl locks are per process; this serializes our own threads
+        self.lock = threading.Lock()
+
+    def hit(self, key, limit, duration):
+        """
+        Count one request for ``key`` unless that exceeds ``limit`` per
+        ``duration`` seconds. Return (allowed, seconds until allowed).
+        """
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+        offset = digest % self.slots * SLOT.size
+        now = time.time()
+        window, elapsed = divmod(now, duration)
+        window = int(window)
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, SLOT.size, offset)
+            try:
+                stored, stored_window, current, previous = SLOT.unpack_from(self.map, offset)
+                if stored != digest or stored_window < window - 1:
+                    current = previous = 0
+                elif stored_window == window - 1:
+                    current, previous = 0, current
+                weight = 1 - elapsed / duration
+                if previous * weight + current >= limit:
+                    return False, self._wait(limit, duration, elapsed, current, previous)
+                SLOT.pack_into(self.map, offset, digest, window, current + 1, previous)
+                return True, 0
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, SLOT.size, offset)
+
+    def _wait(self, limit, duration, elapsed, current, previous):
+        if current >= limit or not previous:
+            # Only the next window brings the count down far enough
+            return duration - elapsed
+        # The previous window's weight has to fall until one more request fits
+        return max((1 - (limit - current) / previous) * duration - elapsed, 0)
+
+
+_counters = None
+_counters_pid = None
+
+
+def get_counters():
+    global _counters, _counters_pid
+    # Opened per process, after gunicorn forks the workers
+    if _counters is None or _counters_pid != os.getpid():
+        _counters = SharedCounters(settings.THROTTLE_FILE, settings.THROTTLE_SLOTS)
+        _counters_pid = os.getpid()
+    return _counters
+
+
+class WriteRateThrottle(SimpleRateThrottle):
+    """
+    Limit unsafe requests per user, or per IP for anonymous clients
+    """
+    scope = None  # the view's throttle_scope when not set
+    scope_suffix = ''
+
+    def __init__(self):
+        # The rate depends on the view, see allow_request
+        self.wait_seconds = None
+
+    def get_ident_key(self, request):
+        if request.user and request.user.is_authenticated:
+            return f'user:{request.user.pk}'
+        return f'ip:{self.get_ident(request)}'
+
+    def allow_request(self, request, view):
+        if request.method in ('GET', 'HEAD', 'OPTIONS'):
+            return True
+        scope = self.scope or getattr(view, 'throttle_scope', None)
+        if not scope:
+            return True
+        self.scope = scope + self.scope_suffix
+        self.rate = self.get_rate()
+        if self.rate is None:
+            return True
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        allowed, self.wait_seconds = get_counters().hit(
+            f'{self.scope}:{self.get_ident_key(request)}', self.num_requests, self.duration
+        )
+        return allowed
+
+    def get_rate(self):
+        return self.THROTTLE_RATES.get(self.scope)
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class WriteIPRateThrottle(WriteRateThrottle):
+    """
+    Limit unsafe requests per client IP, across all accounts used from it
+    """
+    scope_suffix = '_ip'
+
+    def get_ident_key(self, request):
+        return f'ip:{self.get_ident(request)}'
@@ -2,18 +2,24 @@
 URL configuration for midya project.
 """
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from django.views.generic import RedirectView
+from .media import serve_media
+from .metrics import metrics_view
+from .profiling import profiles_view, profile_file
 
 urlpatterns = [
+    path('admin/profiles/', profiles_view, name='admin_profiles'),
+    path('admin/profiles/<str:name>', profile_file, name='admin_profile_file'),
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('api/auth/', include('accounts.urls')),
     path('api/', include('social.urls')),
     path('', include('social.template_urls')),
+    re_path(r'^%s(?P<path>.+)$' % settings.MEDIA_URL.lstrip('/'), serve_media, name='media'),
 ]
 
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
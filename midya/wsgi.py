@@ -9,8 +9,12 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 
 import os
 
-from django.core.wsgi import get_wsgi_application
+from midya.boot import phase
+
+with phase('imports'):
+    from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'midya.settings')
 
-application = get_wsgi_application()
+with phase('setup'):
+    application = get_wsgi_application()
@@ -1,12 +1,17 @@
 from django.contrib import admin
+
+from midya.changelist import CappedCountPaginator, LargeTableMixin
 from .models import Post, Like, Follow, Block, Activity
+from .sharding import shard_count
 
 
 @admin.register(Post)
-class PostAdmin(admin.ModelAdmin):
+class PostAdmin(LargeTableMixin, admin.ModelAdmin):
     list_display = ['user', 'content_preview', 'created_at']
     list_filter = ['created_at']
+    list_select_related = ['user']
     search_fields = ['user__username', 'content']
+    autocomplete_fields = ['user']
     
     def content_preview(self, obj):
         return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
@@ -14,26 +19,46 @@ class PostAdmin(admin.ModelAdmin):
 
 
 @admin.register(Like)
-class LikeAdmin(admin.ModelAdmin):
+class LikeAdmin(LargeTableMixin, admin.ModelAdmin):
     list_display = ['user', 'post', 'created_at']
     list_filter = ['created_at']
+    list_select_related = ['user', 'post__user']
+    autocomplete_fields = ['user']
+    raw_id_fields = ['post']
 
 
 @admin.register(Follow)
-class FollowAdmin(admin.ModelAdmin):
+class FollowAdmin(LargeTableMixin, admin.ModelAdmin):
     list_display = ['follower', 'following', 'created_at']
     list_filter = ['created_at']
+    list_select_related = ['follower', 'following']
+    autocomplete_fields = ['follower', 'following']
 
 
 @admin.register(Block)
-class BlockAdmin(admin.ModelAdmin):
+class BlockAdmin(LargeTableMixin, admin.ModelAdmin):
     list_display = ['blocker', 'blocked', 'created_at']
     list_filter = ['created_at']
+    list_select_related = ['blocker', 'blocked']
+    autocomplete_fields = ['blocker', 'blocked']
 
 
 @admin.register(Activity)
-class ActivityAdmin(admin.ModelAdmin):
-    list_display = ['activity_type', 'description', 'actor', 'created_at']
-    list_filter = ['activity_type', 'created_at']
-    search_fields = ['description']
-
+class ActivityAdmin(LargeTableMixin, admin.ModelAdmin):
+    """
+    Lists the activities in the main database. With SOCIAL_SHARD_COUNT set
+    these are only rows not yet moved by rebalance_shards; the sharded rows
+    are read through the API, which fans out over the shards.
+    """
+    list_display = ['verb', 'description', 'actor', 'created_at']
+    list_filter = ['verb', 'created_at']
+    list_select_related = ['actor', 'target_user']
+    search_fields = ['actor__username']
+    autocomplete_fields = ['actor', 'target_user']
+    raw_id_fields = ['target_post']
+    
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        if shard_count():
+            # Rows moved between shards keep their (index + 1) << 40 ids, so the id range says nothing
+            return CappedCountPaginator(queryset, per_page, orphans, allow_empty_first_page)
+        return super().get_paginator(request, queryset, per_page, orphans, allow_empty_first_page)
@@ -0,0 +1,208 @@
+"""
+Cold storage for old activities.
+
+Activities past the retention window are appended to one gzip NDJSON file
+per month under ``ACTIVITY_ARCHIVE_DIR`` and removed from the table. Each
+archive run appends a new gzip member, so files can be extended safely and
+are still readable with ``zcat``.
+
+Archived and compacted rows that their recipients never read are taken
+back off the unread counters in the transaction that deletes them.
+"""
+import gzip
+import json
+import os
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .feed import invalidate_all_feeds
+from .models import Activity, Like, Follow
+from .sharding import activity_databases
+from .unread import uncount_unread
+
+
+def archive_dir():
+    return settings.ACTIVITY_ARCHIVE_DIR
+
+
+def archive_path(month):
+    return os.path.join(archive_dir(), f'activities-{month}.ndjson.gz')
+
+
+def archived_months():
+    if not os.path.isdir(archive_dir()):
+        return []
+    return sorted(
+        name[len('activities-'):-len('.ndjson.gz')]
+        for name in os.listdir(archive_dir())
+        if name.startswith('activities-') and name.endswith('.ndjson.gz')
+    )
+
+
+def activity_record(activity, usernames):
+    # The description is rendered once here since archived rows outlive usernames
+    return {
+        'id': activity.id,
+        'verb': activity.verb,
+        'activity_type': activity.activity_type,
+        'actor_id': activity.actor_id,
+        'target_user_id': activity.target_user_id,
+        'target_post_id': activity.target_post_id,
+        'description': activity.render_description(usernames),
+        'created_at': activity.created_at.isoformat(),
+    }
+
+
+def write_archive(activities):
+    """
+    Append activities to their monthly archive files and fsync them.
+    Returns the number of records written.
+    """
+    usernames = Activity.username_map(activities)
+    by_month = defaultdict(list)
+    for activity in activities:
+        by_month[activity.created_at.strftime('%Y-%m')].append(activity_record(activity, usernames))
+
+    os.makedirs(archive_dir(), exist_ok=True)
+    written = 0
+    for month, records in by_month.items():
+        with open(archive_path(month), 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='ab') as fh:
+                for record in records:
+                    fh.write(json.dumps(record, separators=(',', ':')).encode() + b'\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+        written += len(records)
+    return written
+
+
+def iter_archive(month, user_id=None):
+    """
+    Yield archived activity records for a month, optionally only those where
+    the user is the actor or the target. Records duplicated by an interrupted
+    archive run are yielded once.
+    """
+    path = archive_path(month)
+    if not os.path.exists(path):
+        return
+    seen = set()
+    with gzip.open(path, 'rt') as fh:
+        for line in fh:
+            record = json.loads(line)
+            if record['id'] in seen:
+                continue
+            seen.add(record['id'])
+            if user_id is not None and user_id not in (record['actor_id'], record['target_user_id']):
+                continue
+            record['created_at'] = parse_datetime(record['created_at'])
+            yield record
+
+
+def compact_activities():
+    """
+    Delete activities that no longer describe anything: likes that were
+    undone, follows that were undone, and all but the newest repeat of the
+    same like or follow. Returns the number of rows removed.
+    """
+    removed = 0
+    for db in activity_databases():
+        activities = Activity.objects.using(db)
+        if db == 'default':
+            # Like followed by an unlike
+            likes = Like.objects.filter(user_id=OuterRef('actor_id'), post_id=OuterRef('target_post_id'))
+            removed += _remove(db, activities.filter(
+                verb=Activity.Verb.POST_LIKED, target_post__isnull=False
+            ).exclude(Exists(likes)).values_list('id', flat=True))
+
+            # Follow followed by an unfollow
+            follows = Follow.objects.filter(follower_id=OuterRef('actor_id'), following_id=OuterRef('target_user_id'))
+            removed += _remove(db, activities.filter(
+                verb=Activity.Verb.USER_FOLLOWED, target_user__isnull=False
+            ).exclude(Exists(follows)).values_list('id', flat=True))
+        else:
+            # Likes and follows live in the main database, so check them in batches
+            removed += _remove(db, _undone(db, Activity.Verb.POST_LIKED, 'target_post_id', Like, 'user_id', 'post_id'))
+            removed += _remove(db, _undone(db, Activity.Verb.USER_FOLLOWED, 'target_user_id', Follow,
+                                           'follower_id', 'following_id'))
+
+        # Like/unlike/like or follow/unfollow/follow leaves repeated rows;
+        # one window pass numbers each (actor, target) group newest first
+        for verb, target in ((Activity.Verb.POST_LIKED, 'target_post_id'), (Activity.Verb.USER_FOLLOWED, 'target_user_id')):
+            newest_first = Window(RowNumber(), partition_by=[F('actor_id'), F(target)], order_by=F('id').desc())
+            removed += _remove(db, activities.filter(verb=verb).annotate(
+                position=newest_first
+            ).filter(position__gt=1).values_list('id', flat=True))
+
+    if removed:
+        invalidate_all_feeds()
+    return removed
+
+
+def _undone(db, verb, target, model, actor_field, target_field, batch_size=2000):
+    undone, last_id = [], 0
+    while True:
+        batch = list(
+            Activity.objects.using(db)
+            .filter(verb=verb, id__gt=last_id, **{f'{target}__isnull': False})
+            .order_by('id').values_list('id', 'actor_id', target)[:batch_size]
+        )
+        if not batch:
+            return undone
+        last_id = batch[-1][0]
+        existing = set(model.objects.filter(
+            **{f'{target_field}__in': {row[2] for row in batch}}
+        ).values_list(actor_field, target_field))
+        undone.extend(row[0] for row in batch if (row[1], row[2]) not in existing)
+
+
+def _delete(db, activities):
+    """
+    Delete activities and take them back off the unread counters of the
+    users who had not read them, in one transaction
+    """
+    with transaction.atomic(using='default'), transaction.atomic(using=db):
+        uncount_unread((activity[1], activity[2], activity[3]) for activity in activities)
+        return Activity.objects.using(db).filter(id__in=[activity[0] for activity in activities]).delete()[0]
+
+
+def _remove(db, ids, batch_size=2000):
+    """
+    Delete the activities with the given ids from ``db`` in batches
+    """
+    ids = list(ids)
+    removed = 0
+    for i in range(0, len(ids), batch_size):
+        removed += _delete(db, list(
+            Activity.objects.using(db).filter(id__in=ids[i:i + batch_size])
+            .values_list('id', 'actor_id', 'target_user_id', 'created_at')
+        ))
+    return removed
+
+
+def archive_activities(days, batch_size=5000):
+    """
+    Move activities older than ``days`` into the monthly archives in
+    id-ordered batches. Rows are deleted only after their batch is on disk.
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    moved = 0
+    for db in activity_databases():
+        while True:
+            batch = list(Activity.objects.using(db).filter(created_at__lt=cutoff).order_by('id')[:batch_size])
+            if not batch:
+                break
+            write_archive(batch)
+            _delete(db, [
+                (activity.id, activity.actor_id, activity.target_user_id, activity.created_at) for activity in batch
+            ])
+            moved += len(batch)
+    if moved:
+        invalidate_all_feeds()
+    return moved
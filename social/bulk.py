@@ -0,0 +1,53 @@
+from django.db import connections
+
+
+def _statement(model, fields, rows, connection, suffix=''):
+    qn = connection.ops.quote_name
+    fields = [model._meta.get_field(name) for name in fields]
+    adapters = [
+        connection.ops.adapt_datetimefield_value if field.get_internal_type() == 'DateTimeField' else None
+        for field in fields
+    ]
+    sql = 'INSERT INTO {} ({}) VALUES ({}){}'.format(
+        qn(model._meta.db_table),
+        ', '.join(qn(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+        suffix,
+    )
+    params = [
+        [adapt(value) if adapt else value for adapt, value in zip(adapters, row)]
+        for row in rows
+    ]
+    return sql, params
+
+
+def insert_rows(model, fields, rows, ignore_conflicts=False, using='default'):
+    """
+    executemany() a plain INSERT for rows whose ids are not needed back.
+    Much cheaper per row than bulk_create, which compiles every value.
+    """
+    if not rows:
+        return
+    connection = connections[using]
+    sql, params = _statement(model, fields, rows, connection, ' ON CONFLICT DO NOTHING' if ignore_conflicts else '')
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+def add_counts(model, key_fields, count_field, rows, using='default'):
+    """
+    Add each row's last value to count_field of the row with the same keys,
+    inserting it when missing. key_fields must be covered by a unique constraint.
+    """
+    if not rows:
+        return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    column = qn(model._meta.get_field(count_field).column)
+    suffix = ' ON CONFLICT ({}) DO UPDATE SET {} = {}.{} + excluded.{}'.format(
+        ', '.join(qn(model._meta.get_field(name).column) for name in key_fields),
+        column, qn(model._meta.db_table), column, column,
+    )
+    sql, params = _statement(model, list(key_fields) + [count_field], rows, connection, suffix)
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
@@ -0,0 +1,117 @@
+"""
+Streaming NDJSON export of everything a user owns.
+
+Rows are read section by section in primary-key order using keyset chunks,
+so memory use does not depend on the size of the account. Every line
+carries a ``cursor`` (``<section>:<last id>``); passing the last cursor a
+client received resumes the export right after that row.
+"""
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Post, Like, Follow, Block, Activity
+from .sharding import shard_for_user
+
+CHUNK_SIZE = 1000
+
+
+def _activity_rows(activities):
+    usernames = Activity.username_map(activities)
+    for activity in activities:
+        yield activity.id, {
+            'activity_type': activity.activity_type,
+            'target_user_id': activity.target_user_id,
+            'target_post_id': activity.target_post_id,
+            'description': activity.render_description(usernames),
+            'created_at': activity.created_at,
+        }
+
+
+def _values_rows(fields):
+    def rows(chunk):
+        for values in chunk:
+            yield values['id'], {field: values[field] for field in fields}
+    return rows
+
+
+# (section, queryset factory, fetch chunk, row formatter)
+SECTIONS = [
+    ('post',
+     lambda user: Post.objects.filter(user=user),
+     lambda qs: qs.values('id', 'content', 'image', 'created_at', 'updated_at'),
+     _values_rows(['content', 'image', 'created_at', 'updated_at'])),
+    ('like',
+     lambda user: Like.objects.filter(user=user),
+     lambda qs: qs.values('id', 'post_id', 'created_at'),
+     _values_rows(['post_id', 'created_at'])),
+    ('follow',
+     lambda user: Follow.objects.filter(follower=user),
+     lambda qs: qs.values('id', 'following_id', 'following__username', 'created_at'),
+     _values_rows(['following_id', 'following__username', 'created_at'])),
+    ('block',
+     lambda user: Block.objects.filter(blocker=user),
+     lambda qs: qs.values('id', 'blocked_id', 'blocked__username', 'created_at'),
+     _values_rows(['blocked_id', 'blocked__username', 'created_at'])),
+    ('activity',
+     lambda user: Activity.objects.using(shard_for_user(user.id)).filter(actor=user),
+     lambda qs: qs,
+     _activity_rows),
+]
+
+SECTION_NAMES = [name for name, *_ in SECTIONS]
+
+
+def parse_cursor(cursor):
+    """
+    Split ``<section>:<id>`` into its parts. Raises ValueError when invalid.
+    """
+    if not cursor:
+        return None, 0
+    section, _, last_id = cursor.partition(':')
+    if section not in SECTION_NAMES or not last_id.isdigit():
+        raise ValueError(f'Invalid export cursor: {cursor!r}')
+    return section, int(last_id)
+
+
+def _line(record):
+    return json.dumps(record, cls=DjangoJSONEncoder, separators=(',', ':')).encode() + b'\n'
+
+
+def iter_export(user, cursor=None, chunk_size=CHUNK_SIZE):
+    """
+    Yield NDJSON bytes, one block per keyset chunk, ending with an ``end`` record.
+    """
+    start_section, start_id = parse_cursor(cursor)
+    started = start_section is None
+    for name, queryset, fetch, rows in SECTIONS:
+        last_id = 0
+        if not started:
+            if name != start_section:
+                continue
+            started, last_id = True, start_id
+        while True:
+            chunk = list(fetch(queryset(user).filter(id__gt=last_id).order_by('id'))[:chunk_size].iterator())
+            if not chunk:
+                break
+            lines = []
+            for row_id, data in rows(chunk):
+                lines.append(_line({'type': name, 'cursor': f'{name}:{row_id}', 'data': data}))
+                last_id = row_id
+            yield b''.join(lines)
+            if len(chunk) < chunk_size:
+                break
+    yield _line({'type': 'end', 'cursor': None})
+
+
+def gzip_stream(blocks):
+    """
+    Compress a byte stream incrementally into a single gzip member.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
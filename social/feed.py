@@ -0,0 +1,192 @@
+"""
+Cached feed pages.
+
+The feed page shows the newest activities of the people a user follows and
+the newest posts overall.
+
+* Each user's activity page is cached under the version tokens of what it
+  was built from: a token of the user's network, replaced when they
+  follow, unfollow, block or unblock someone, and the token of every actor
+  in that network, replaced when the actor writes an activity. A write
+  therefore replaces one token however many followers the actor has, and
+  a read checks one token per followed user with a single ``get_many``.
+  Removing activities (user deletion, compaction, archiving) replaces a
+  token shared by every page instead.
+* The ids of the newest posts are cached once for everyone and replaced
+  when a post is created or deleted. The rows come from
+  ``social.rowcache``, so like counts stay current. Only whether the
+  viewer liked each post is read from the database per request. Pages
+  past that window are read with a keyset query (``older_posts``).
+
+``warm_feed`` builds these entries ahead of the first request; see the
+``warm_caches`` command.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+
+from .graph import get_graph
+from .models import Post, Like, Activity
+from .rowcache import get_posts, get_users
+from .sharding import fanout
+
+FEED_SIZE = 50
+# Posts per feed page; further pages are loaded as the reader scrolls
+PAGE_SIZE = 20
+# Newest post ids kept, enough to fill a page after dropping blocked authors
+POST_WINDOW = 200
+ACTIVITY_FIELDS = ['id', 'verb', 'actor_id', 'target_user_id', 'target_post_id', 'created_at']
+LATEST_POSTS_KEYS = ('feed:1:posts', 'feed:1:posts:v')
+# Replaced when activities are removed, which can touch any user's page
+ACTIVITIES_VERSION_KEY = 'feed:1:activities:v'
+
+
+def _activity_keys(user_id):
+    return f'feed:1:activities:{user_id}', f'feed:1:activities:{user_id}:v'
+
+
+def _actor_version_key(user_id):
+    return f'feed:1:actor:{user_id}:v'
+
+
+def _activity_version_keys(user_id, actor_ids):
+    return [_activity_keys(user_id)[1], ACTIVITIES_VERSION_KEY, *map(_actor_version_key, sorted(actor_ids))]
+
+
+def _read_through(key, version_keys, build):
+    """
+    Cached value stored under the current version tokens, else build() it
+    """
+    cached = cache.get_many([key, *version_keys])
+    # A digest, since a page can depend on thousands of tokens
+    token = hashlib.blake2b(
+        '|'.join(str(cached.get(version_key)) for version_key in version_keys).encode(), digest_size=16
+    ).hexdigest()
+    entry = cached.get(key)
+    if entry is not None and entry[0] == token:
+        return entry[1]
+    value = build()
+    cache.set(key, (token, value), settings.FEED_CACHE_TIMEOUT)
+    return value
+
+
+def network(user_id):
+    graph = get_graph()
+    user_ids = set(graph.following_ids(user_id))
+    user_ids.add(user_id)
+    user_ids.difference_update(graph.blocked_ids(user_id))
+    return user_ids
+
+
+def feed_activities(user_id):
+    user_ids = network(user_id)
+
+    def build():
+        activities = fanout(Activity.objects.filter(actor_id__in=user_ids), user_ids)[:FEED_SIZE]
+        return [tuple(getattr(activity, field) for field in ACTIVITY_FIELDS) for activity in activities]
+
+    rows = _read_through(_activity_keys(user_id)[0], _activity_version_keys(user_id, user_ids), build)
+    return [Activity(**dict(zip(ACTIVITY_FIELDS, row))) for row in rows]
+
+
+def latest_posts():
+    """
+    (post id, author id) of the newest posts
+    """
+    def build():
+        return list(Post.objects.order_by('-created_at', '-id').values_list('id', 'user_id')[:POST_WINDOW])
+
+    return _read_through(LATEST_POSTS_KEYS[0], LATEST_POSTS_KEYS[1:], build)
+
+
+def older_posts(posts, after):
+    """
+    Keyset filter: the posts that come after post ``after`` in (-created_at, -id) order
+    """
+    created_at = Post.objects.filter(pk=after).values_list('created_at', flat=True).first()
+    if created_at is None:
+        # The cursor post was deleted; ids grow with time closely enough
+        return posts.filter(id__lt=after)
+    # The created_at__lte range lets SQLite walk the (..., created_at, id) index in order
+    return posts.filter(Q(created_at__lt=created_at) | Q(id__lt=after), created_at__lte=created_at)
+
+
+def _feed_post_ids(user_id, after, limit):
+    blocked_ids = set(get_graph().blocked_ids(user_id))
+    latest = latest_posts()
+    post_ids = [post_id for post_id, author_id in latest if author_id not in blocked_ids]
+    if after is not None:
+        post_ids = post_ids[post_ids.index(after) + 1:] if after in post_ids else None
+    if post_ids is not None and (len(post_ids) > limit or len(latest) < POST_WINDOW):
+        return post_ids[:limit + 1]
+    # Past the cached window, or blocked authors filled it
+    posts = Post.objects.exclude(user_id__in=blocked_ids)
+    if after is not None:
+        posts = older_posts(posts, after)
+    return list(posts.order_by('-created_at', '-id').values_list('id', flat=True)[:limit + 1])
+
+
+def feed_posts(user, after=None, limit=PAGE_SIZE):
+    """
+    The next ``limit`` posts after post ``after`` not written by users the
+    viewer blocked, with viewer_liked set, and the cursor of the page after
+    """
+    post_ids = _feed_post_ids(user.id, after, limit)
+    next_cursor = post_ids[limit - 1] if len(post_ids) > limit else None
+    post_ids = post_ids[:limit]
+    posts = get_posts(post_ids)
+    page = [posts[post_id] for post_id in post_ids if post_id in posts]
+    liked = set(Like.objects.filter(user=user, post_id__in=post_ids).values_list('post_id', flat=True))
+    for post in page:
+        post.viewer_liked = post.id in liked
+    return page, next_cursor
+
+
+def warm_feed(user_id):
+    """
+    Fill the cache entries the feed and profile pages of ``user_id`` read
+    """
+    activities = feed_activities(user_id)
+    user_ids = {user_id}
+    for activity in activities:
+        user_ids.update((activity.actor_id, activity.target_user_id))
+    user_ids.discard(None)
+    get_users(user_ids)
+    get_posts(post_id for post_id, _ in latest_posts()[:PAGE_SIZE])
+    return len(activities)
+
+
+def _replace_tokens(keys):
+    if keys:
+        transaction.on_commit(lambda: cache.set_many(
+            {key: uuid.uuid4().hex for key in keys}, settings.FEED_CACHE_TIMEOUT * 2
+        ))
+
+
+def invalidate_feeds(user_ids):
+    """
+    Rebuild the pages of users whose network changed
+    """
+    _replace_tokens([_activity_keys(user_id)[1] for user_id in set(user_ids) if user_id])
+
+
+def invalidate_actors(actor_ids):
+    """
+    Rebuild the pages that show activities of these actors, after they wrote new ones
+    """
+    _replace_tokens([_actor_version_key(actor_id) for actor_id in set(actor_ids) if actor_id])
+
+
+def invalidate_all_feeds():
+    """
+    Rebuild every activity page, after activities were deleted
+    """
+    _replace_tokens([ACTIVITIES_VERSION_KEY])
+
+
+def invalidate_latest_posts():
+    _replace_tokens([LATEST_POSTS_KEYS[1]])
@@ -0,0 +1,430 @@
+"""
+Process-local index of the follow and block graphs.
+
+Both relations are held as CSR (compressed sparse row) arrays: a sorted
+array of node ids, an offsets array and a flat array of sorted targets,
+for the forward and the reverse direction. Changes since the last
+compaction live in a small overlay of added/removed edges which is folded
+back into the arrays once it grows past ``SOCIAL_GRAPH_MAX_PENDING``.
+
+The index is loaded from a snapshot file on first use and kept current by
+replaying ``GraphEvent`` rows, which the follow/block write paths append
+in the same transaction as the edge change. Every worker process therefore
+converges on the same graph without re-reading the Follow/Block tables.
+"""
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+
+FOLLOW = 0
+BLOCK = 1
+
+SNAPSHOT_MAGIC = b'MIDYAG01'
+_HEADER = struct.Struct('<8sq')
+_SIZES = struct.Struct('<qq')
+
+
+class CSR:
+    """
+    Immutable adjacency arrays for one direction of one relation
+    """
+    __slots__ = ('nodes', 'offsets', 'targets')
+
+    def __init__(self, nodes=None, offsets=None, targets=None):
+        self.nodes = nodes if nodes is not None else array('q')
+        self.offsets = offsets if offsets is not None else array('q', [0])
+        self.targets = targets if targets is not None else array('q')
+
+    @classmethod
+    def from_edges(cls, edges):
+        nodes, offsets, targets = array('q'), array('q', [0]), array('q')
+        last = None
+        for src, dst in sorted(set(edges)):
+            if src != last:
+                if last is not None:
+                    offsets.append(len(targets))
+                nodes.append(src)
+                last = src
+            targets.append(dst)
+        if last is not None:
+            offsets.append(len(targets))
+        return cls(nodes, offsets, targets)
+
+    def _span(self, node):
+        i = bisect_left(self.nodes, node)
+        if i < len(self.nodes) and self.nodes[i] == node:
+            return self.offsets[i], self.offsets[i + 1]
+        return 0, 0
+
+    def row(self, node):
+        start, end = self._span(node)
+        return self.targets[start:end]
+
+    def degree(self, node):
+        start, end = self._span(node)
+        return end - start
+
+    def has(self, src, dst):
+        start, end = self._span(src)
+        i = bisect_left(self.targets, dst, start, end)
+        return i < end and self.targets[i] == dst
+
+    def edges(self):
+        for i, src in enumerate(self.nodes):
+            for j in range(self.offsets[i], self.offsets[i + 1]):
+                yield src, self.targets[j]
+
+    def __len__(self):
+        return len(self.targets)
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.nodes, self.offsets, self.targets))
+
+
+def _with(overlay, src, dst):
+    overlay = dict(overlay)
+    overlay[src] = overlay.get(src, frozenset()) | {dst}
+    return overlay
+
+
+def _without(overlay, src, dst):
+    overlay = dict(overlay)
+    rest = overlay.pop(src) - {dst}
+    if rest:
+        overlay[src] = rest
+    return overlay
+
+
+class Adjacency:
+    """
+    CSR base plus an overlay of edges added or removed since the last compaction
+
+    The base and both overlays are published together as one ``state``
+    tuple that is never changed in place: writers build the next state and
+    swap it in with a single assignment, so threads reading the graph take
+    no lock and always see one consistent version of it.
+    """
+
+    def __init__(self, base=None):
+        self.state = (base or CSR(), {}, {})
+        self.pending = 0
+
+    @property
+    def base(self):
+        return self.state[0]
+
+    def has(self, src, dst):
+        base, added, removed = self.state
+        if dst in added.get(src, ()):
+            return True
+        if dst in removed.get(src, ()):
+            return False
+        return base.has(src, dst)
+
+    def add(self, src, dst):
+        base, added, removed = self.state
+        if dst in removed.get(src, ()):
+            self.state = base, added, _without(removed, src, dst)
+            self.pending -= 1
+        elif dst not in added.get(src, ()) and not base.has(src, dst):
+            self.state = base, _with(added, src, dst), removed
+            self.pending += 1
+
+    def remove(self, src, dst):
+        base, added, removed = self.state
+        if dst in added.get(src, ()):
+            self.state = base, _without(added, src, dst), removed
+            self.pending -= 1
+        elif dst not in removed.get(src, ()) and base.has(src, dst):
+            self.state = base, added, _with(removed, src, dst)
+            self.pending += 1
+
+    def neighbours(self, src):
+        base, added, removed = self.state
+        row = base.row(src)
+        removed = removed.get(src)
+        added = added.get(src)
+        if not removed and not added:
+            return list(row)
+        result = [dst for dst in row if not removed or dst not in removed]
+        if added:
+            result.extend(added)
+            result.sort()
+        return result
+
+    def degree(self, src):
+        base, added, removed = self.state
+        return base.degree(src) + len(added.get(src, ())) - len(removed.get(src, ()))
+
+    def edges(self):
+        base, added, removed = self.state
+        for src, dst in base.edges():
+            if dst not in removed.get(src, ()):
+                yield src, dst
+        for src, targets in added.items():
+            for dst in targets:
+                yield src, dst
+
+    def compact(self):
+        if self.pending:
+            self.state = CSR.from_edges(self.edges()), {}, {}
+        else:
+            self.state = self.base, {}, {}
+        self.pending = 0
+
+
+class Relation:
+    """
+    One directed relation indexed in both directions
+    """
+
+    def __init__(self, forward=None):
+        forward = forward or CSR()
+        self.forward = Adjacency(forward)
+        self.reverse = Adjacency(CSR.from_edges((dst, src) for src, dst in forward.edges()))
+
+    def add(self, src, dst):
+        self.forward.add(src, dst)
+        self.reverse.add(dst, src)
+
+    def remove(self, src, dst):
+        self.forward.remove(src, dst)
+        self.reverse.remove(dst, src)
+
+    @property
+    def pending(self):
+        return self.forward.pending
+
+    def compact(self):
+        self.forward.compact()
+        self.reverse.compact()
+
+
+class GraphIndex:
+    """
+    Follow and block graphs for the whole site, queryable without the database
+    """
+
+    def __init__(self, follows=None, blocks=None, last_event_id=0):
+        self.relations = {
+            FOLLOW: Relation(follows),
+            BLOCK: Relation(blocks),
+        }
+        self.last_event_id = last_event_id
+        self.synced_at = 0.0
+        self.lock = threading.RLock()
+
+    # Queries
+
+    def following_ids(self, user_id):
+        return self.relations[FOLLOW].forward.neighbours(user_id)
+
+    def follower_ids(self, user_id):
+        return self.relations[FOLLOW].reverse.neighbours(user_id)
+
+    def following_count(self, user_id):
+        return self.relations[FOLLOW].forward.degree(user_id)
+
+    def follower_count(self, user_id):
+        return self.relations[FOLLOW].reverse.degree(user_id)
+
+    def is_following(self, follower_id, following_id):
+        return self.relations[FOLLOW].forward.has(follower_id, following_id)
+
+    def blocked_ids(self, user_id):
+        return self.relations[BLOCK].forward.neighbours(user_id)
+
+    def blocker_ids(self, user_id):
+        return self.relations[BLOCK].reverse.neighbours(user_id)
+
+    def is_blocked(self, blocker_id, blocked_id):
+        return self.relations[BLOCK].forward.has(blocker_id, blocked_id)
+
+    # Updates
+
+    def apply(self, kind, src, dst, added):
+        with self.lock:
+            relation = self.relations[kind]
+            if added:
+                relation.add(src, dst)
+            else:
+                relation.remove(src, dst)
+            if relation.pending > getattr(settings, 'SOCIAL_GRAPH_MAX_PENDING', 10000):
+                relation.compact()
+
+    def compact(self):
+        with self.lock:
+            for relation in self.relations.values():
+                relation.compact()
+
+    def nbytes(self):
+        total = 0
+        for relation in self.relations.values():
+            total += relation.forward.base.nbytes() + relation.reverse.base.nbytes()
+        return total
+
+    # Snapshots
+
+    def save(self, path):
+        with self.lock:
+            self.compact()
+            tmp = f'{path}.tmp'
+            os.makedirs(os.path.dirname(os.fspath(path)) or '.', exist_ok=True)
+            with open(tmp, 'wb') as fh:
+                fh.write(_HEADER.pack(SNAPSHOT_MAGIC, self.last_event_id))
+                for kind in (FOLLOW, BLOCK):
+                    csr = self.relations[kind].forward.base
+                    fh.write(_SIZES.pack(len(csr.nodes), len(csr.targets)))
+                    csr.nodes.tofile(fh)
+                    csr.offsets.tofile(fh)
+                    csr.targets.tofile(fh)
+            os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fh:
+            magic, last_event_id = _HEADER.unpack(fh.read(_HEADER.size))
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError(f'{path} is not a graph snapshot')
+            relations = []
+            for _ in (FOLLOW, BLOCK):
+                n_nodes, n_edges = _SIZES.unpack(fh.read(_SIZES.size))
+                nodes, offsets, targets = array('q'), array('q'), array('q')
+                nodes.fromfile(fh, n_nodes)
+                offsets.fromfile(fh, n_nodes + 1)
+                targets.fromfile(fh, n_edges)
+                relations.append(CSR(nodes, offsets, targets))
+        return cls(relations[0], relations[1], last_event_id)
+
+    @classmethod
+    def build(cls):
+        from .models import Follow, Block, GraphEvent
+
+        last_event_id = _last_event_id()
+        follows = CSR.from_edges(
+            Follow.objects.order_by().values_list('follower_id', 'following_id').iterator(chunk_size=5000)
+        )
+        blocks = CSR.from_edges(
+            Block.objects.order_by().values_list('blocker_id', 'blocked_id').iterator(chunk_size=5000)
+        )
+        return cls(follows, blocks, last_event_id)
+
+    def sync(self):
+        """
+        Replay graph events written since the last sync. Returns False when
+        events are missing (pruned) and the index has to be rebuilt.
+
+        Event ids are never reused, so the next event must carry exactly the
+        id after the last one applied; this holds for an index at event 0
+        too, which would otherwise replay a pruned log from the middle.
+        """
+        from .models import GraphEvent
+
+        with self.lock:
+            events = GraphEvent.objects.filter(id__gt=self.last_event_id).order_by('id')
+            expected = self.last_event_id + 1
+            for event_id, kind, src, dst, added in events.values_list(
+                    'id', 'kind', 'source_id', 'target_id', 'added').iterator(chunk_size=2000):
+                if event_id != expected:
+                    return False
+                self.apply(kind, src, dst, added)
+                self.last_event_id = event_id
+                expected = event_id + 1
+            self.synced_at = time.monotonic()
+        return True
+
+
+def _last_event_id():
+    """
+    The highest graph event id handed out so far. SQLite keeps it in
+    ``sqlite_sequence`` even after the rows are pruned, so an index built
+    from an empty log still expects the right next id.
+    """
+    from django.db import connection
+    from .models import GraphEvent
+
+    last_event_id = GraphEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [GraphEvent._meta.db_table])
+            row = cursor.fetchone()
+        if row:
+            last_event_id = max(last_event_id, row[0])
+    return last_event_id
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def snapshot_path():
+    return getattr(settings, 'SOCIAL_GRAPH_SNAPSHOT', None)
+
+
+def load_index():
+    """
+    Load the snapshot (or the tables when no usable snapshot exists) and
+    catch up with events written since it was taken.
+    """
+    path = snapshot_path()
+    index = None
+    if path and os.path.exists(path):
+        try:
+            index = GraphIndex.load(path)
+        except (OSError, ValueError, EOFError, struct.error):
+            index = None
+    if index is None or not index.sync():
+        index = GraphIndex.build()
+        index.synced_at = time.monotonic()
+        if path:
+            index.save(path)
+    return index
+
+
+def get_graph():
+    """
+    Return the process-wide graph index, syncing it with the event log at
+    most once per ``SOCIAL_GRAPH_SYNC_INTERVAL`` seconds.
+    """
+    global _index
+    index = _index
+    if index is None:
+        with _index_lock:
+            if _index is None:
+                _index = load_index()
+            return _index
+    interval = getattr(settings, 'SOCIAL_GRAPH_SYNC_INTERVAL', 1.0)
+    if time.monotonic() - index.synced_at >= interval:
+        if not index.sync():
+            with _index_lock:
+                _index = load_index()
+            return _index
+    return index
+
+
+def reset_graph():
+    global _index
+    with _index_lock:
+        _index = None
+
+
+def record_edge(kind, source_id, target_id, added):
+    """
+    Append a graph event and apply it to this process once the surrounding
+    transaction commits.
+    """
+    from django.db import transaction
+    from .models import GraphEvent
+
+    GraphEvent.objects.create(kind=kind, source_id=source_id, target_id=target_id, added=added)
+    transaction.on_commit(lambda: _apply_local(kind, source_id, target_id, added))
+
+
+def _apply_local(kind, source_id, target_id, added):
+    if _index is not None:
+        _index.apply(kind, source_id, target_id, added)
@@ -0,0 +1,377 @@
+"""
+Bulk import of users, posts, follows, blocks and likes from NDJSON.
+
+One JSON object per line, discriminated by ``type``:
+
+    {"type": "user", "username": "ann", "email": "ann@x.io", "password_hash": "pbkdf2_sha256$...",
+     "bio": "", "role": "regular"}
+    {"type": "post", "ref": "p1", "user": "ann", "content": "hi", "created_at": "2024-05-01T10:00:00Z"}
+    {"type": "follow", "follower": "ann", "following": "bob"}
+    {"type": "block", "blocker": "ann", "blocked": "eve"}
+    {"type": "like", "user": "bob", "post": "p1"}
+
+Users may carry ``password`` (plain text, hashed here) instead of
+``password_hash``; users without either get an unusable password. Posts
+are referenced by their ``ref`` and users by username, both within the
+file and against rows that already exist. Records are validated and
+written in batches, each batch in its own transaction, and rows that
+already exist are skipped.
+"""
+import json
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .bulk import insert_rows
+from .changelog import last_id, log_changes, log_inserted
+from .rowcache import invalidate
+from .feed import invalidate_feeds, invalidate_latest_posts
+from .graph import FOLLOW, BLOCK
+from .likes import recount_likes
+from .sharding import insert_activities
+from .tags import index_posts
+from .models import Post, Like, Follow, Block, Activity, GraphEvent, ChangeLog
+
+User = get_user_model()
+
+# Flush order: later types reference rows created by earlier ones
+TYPES = ['user', 'post', 'follow', 'block', 'like']
+ROLES = {role for role, _ in User.ROLE_CHOICES}
+
+
+class InvalidRecord(ValueError):
+    pass
+
+
+@contextmanager
+def preserve_timestamps(*models):
+    """
+    Let bulk_create keep the created_at values set on imported rows
+    """
+    fields = [model._meta.get_field('created_at') for model in models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def _timestamp(record, key='created_at'):
+    value = record.get(key)
+    if not value:
+        return timezone.now()
+    try:
+        parsed = parse_datetime(value) if isinstance(value, str) else None
+    except ValueError:
+        # Well formed but out of range, such as month 13
+        parsed = None
+    if parsed is None:
+        raise InvalidRecord(f'invalid {key}: {value!r}')
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _text(record, key, default=None):
+    value = record.get(key, default)
+    if value is not None and not isinstance(value, str):
+        raise InvalidRecord(f'{key} must be a string, not {type(value).__name__}')
+    return value
+
+
+def _required(record, *keys):
+    values = [_text(record, key) for key in keys]
+    for key, value in zip(keys, values):
+        if not value:
+            raise InvalidRecord(f'missing {key}')
+    return values
+
+
+def _names(records, *keys):
+    """
+    The string values of ``keys`` in ``records``, for looking up users
+    """
+    return {record.get(key) for record in records for key in keys if isinstance(record.get(key), str)}
+
+
+class SocialImporter:
+    def __init__(self, batch_size=2000, defer_hash=False, with_activities=True, stderr=None):
+        self.batch_size = batch_size
+        self.defer_hash = defer_hash
+        self.with_activities = with_activities
+        self.stderr = stderr
+        self.buffers = {kind: [] for kind in TYPES}
+        self.user_ids = {}
+        self.post_ids = {}
+        self.deferred_passwords = []
+        self.liked_posts = set()
+        self.stats = {kind: 0 for kind in TYPES}
+        self.stats.update(skipped=0, errors=0)
+
+    # Input
+
+    def feed(self, lines):
+        for lineno, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                kind = record.get('type')
+                if kind not in self.buffers:
+                    raise InvalidRecord(f'unknown type {kind!r}')
+            except (ValueError, TypeError, AttributeError) as e:
+                self.error(lineno, e)
+                continue
+            self.buffers[kind].append((lineno, record))
+            if len(self.buffers[kind]) >= self.batch_size:
+                self.flush(upto=kind)
+        self.flush()
+        if self.liked_posts:
+            # Raw like inserts skip the counter signals
+            recount_likes(self.liked_posts)
+        if self.deferred_passwords:
+            self.hash_deferred_passwords()
+        return self.stats
+
+    def error(self, lineno, message):
+        self.stats['errors'] += 1
+        if self.stderr:
+            self.stderr.write(f'line {lineno}: {message}')
+
+    def flush(self, upto=None):
+        last = TYPES.index(upto) if upto else len(TYPES) - 1
+        with preserve_timestamps(Post):
+            for kind in TYPES[:last + 1]:
+                batch, self.buffers[kind] = self.buffers[kind], []
+                if batch:
+                    with transaction.atomic():
+                        getattr(self, f'import_{kind}s')(batch)
+
+    # Lookups
+
+    def resolve_users(self, usernames):
+        missing = {name for name in usernames if name not in self.user_ids}
+        if missing:
+            self.user_ids.update(User.objects.filter(username__in=missing).values_list('username', 'id'))
+        return self.user_ids
+
+    def resolve_posts(self, refs):
+        missing = [ref for ref in refs if ref not in self.post_ids]
+        numeric = [int(ref) for ref in missing if str(ref).isdigit()]
+        if numeric:
+            # Fall back to existing post ids for refs not defined in the file
+            self.post_ids.update((str(pk), pk) for pk in Post.objects.filter(id__in=numeric).values_list('id', flat=True))
+        return self.post_ids
+
+    def parse(self, batch, parser):
+        rows = []
+        for lineno, record in batch:
+            try:
+                rows.append(parser(record))
+            except InvalidRecord as e:
+                self.error(lineno, e)
+        return rows
+
+    # Record types
+
+    def import_users(self, batch):
+        def parse(record):
+            username, email = _required(record, 'username', 'email')
+            if len(username) > 150:
+                raise InvalidRecord('username longer than 150 characters')
+            role = _text(record, 'role', 'regular')
+            if role not in ROLES:
+                raise InvalidRecord(f'invalid role {role!r}')
+            password_hash = _text(record, 'password_hash')
+            if password_hash:
+                try:
+                    identify_hasher(password_hash)
+                except ValueError:
+                    raise InvalidRecord('unrecognised password_hash')
+            user = User(username=username, email=email, bio=_text(record, 'bio') or '', role=role,
+                        password=password_hash, date_joined=_timestamp(record, 'date_joined'))
+            return user, None if password_hash else _text(record, 'password')
+
+        rows = {}
+        for user, raw in self.parse(batch, parse):
+            rows.setdefault(user.username, (user, raw))
+        existing = set(User.objects.filter(username__in=rows).values_list('username', flat=True))
+        new = [row for name, row in rows.items() if name not in existing]
+        self.stats['skipped'] += len(rows) - len(new)
+
+        # Hash only for users that are actually created
+        for user, raw in new:
+            if not user.password:
+                user.password = make_password(raw if raw and not self.defer_hash else None)
+
+        created = User.objects.bulk_create([user for user, _ in new], batch_size=500)
+        for user, (_, raw) in zip(created, new):
+            self.user_ids[user.username] = user.id
+            if raw and self.defer_hash:
+                self.deferred_passwords.append((user.id, raw))
+        log_changes(ChangeLog.Kind.USER, [(user.id, user.id, None) for user in created])
+        self.stats['user'] += len(created)
+
+    def import_posts(self, batch):
+        users = self.resolve_users(_names([record for _, record in batch], 'user'))
+
+        def parse(record):
+            username, content = _required(record, 'user', 'content')
+            if username not in users:
+                raise InvalidRecord(f'unknown user {username!r}')
+            ref = record.get('ref')
+            if ref is not None and (isinstance(ref, bool) or not isinstance(ref, (str, int))):
+                raise InvalidRecord(f'invalid ref {ref!r}')
+            return ref, Post(user_id=users[username], content=content,
+                             created_at=_timestamp(record))
+
+        rows = self.parse(batch, parse)
+        # A post with the same author, timestamp and content was imported before
+        existing = {
+            (user_id, created_at, content): pk
+            for pk, user_id, created_at, content in Post.objects.filter(
+                user_id__in={post.user_id for _, post in rows},
+                created_at__in={post.created_at for _, post in rows},
+            ).values_list('id', 'user_id', 'created_at', 'content').iterator()
+        }
+        new = []
+        for ref, post in rows:
+            pk = existing.get((post.user_id, post.created_at, post.content))
+            if pk is None:
+                new.append((ref, post))
+            elif ref is not None:
+                self.post_ids[str(ref)] = pk
+        self.stats['skipped'] += len(rows) - len(new)
+
+        created = Post.objects.bulk_create([post for _, post in new], batch_size=500)
+        for (ref, _), post in zip(new, created):
+            if ref is not None:
+                self.post_ids[str(ref)] = post.id
+        # bulk_create sends no post_save, so index tags and mentions and log the changes here
+        index_posts(created, notify=self.with_activities)
+        log_changes(ChangeLog.Kind.POST, [(post.id, post.user_id, None) for post in created])
+        invalidate(User, {post.user_id for post in created})
+        invalidate_latest_posts()
+        if self.with_activities:
+            self.create_activities(
+                (Activity.Verb.POST_CREATED, post.user_id, None, None, post.created_at) for post in created
+            )
+        self.stats['post'] += len(created)
+
+    def _edges(self, batch, kind, source_key, target_key, model, source_field, target_field, change_kind):
+        records = [record for _, record in batch]
+        users = self.resolve_users(_names(records, source_key, target_key))
+        name = model.__name__.lower()
+
+        def parse(record):
+            source, target = _required(record, source_key, target_key)
+            if source not in users or target not in users:
+                raise InvalidRecord(f'unknown user in {name} {source!r} -> {target!r}')
+            if source == target:
+                raise InvalidRecord(f'cannot {name} yourself')
+            return users[source], users[target], _timestamp(record)
+
+        rows = {(src, dst): created_at for src, dst, created_at in self.parse(batch, parse)}
+        existing = set(model.objects.filter(
+            **{f'{source_field}__in': {src for src, _ in rows}}
+        ).values_list(source_field, target_field).iterator())
+        new = [(src, dst, created_at) for (src, dst), created_at in rows.items() if (src, dst) not in existing]
+        self.stats['skipped'] += len(rows) - len(new)
+
+        before = last_id(model)
+        insert_rows(model, [source_field, target_field, 'created_at'], new, ignore_conflicts=True)
+        # No signals fire for raw inserts, so publish the graph changes explicitly
+        log_inserted(change_kind, model.objects.filter(id__gt=before), source_field, target_field)
+        now = timezone.now()
+        insert_rows(GraphEvent, ['kind', 'source_id', 'target_id', 'added', 'created_at'],
+                    [(kind, src, dst, True, now) for src, dst, _ in new])
+        invalidate_feeds(src for src, _, _ in new)
+        return new
+
+    def import_follows(self, batch):
+        new = self._edges(batch, FOLLOW, 'follower', 'following', Follow, 'follower_id', 'following_id',
+                          ChangeLog.Kind.FOLLOW)
+        if self.with_activities:
+            self.create_activities(
+                (Activity.Verb.USER_FOLLOWED, src, dst, None, created_at) for src, dst, created_at in new
+            )
+        self.stats['follow'] += len(new)
+
+    def import_blocks(self, batch):
+        new = self._edges(batch, BLOCK, 'blocker', 'blocked', Block, 'blocker_id', 'blocked_id',
+                          ChangeLog.Kind.BLOCK)
+        # As in the API: a new block ends the blocker's follow and likes of the blocked user.
+        # Deleted through the ORM so the graph, counters and change log see it.
+        pairs = {(src, dst) for src, dst, _ in new}
+        if pairs:
+            sources, targets = {src for src, _ in pairs}, {dst for _, dst in pairs}
+            follows = Follow.objects.filter(follower_id__in=sources, following_id__in=targets)
+            Follow.objects.filter(id__in=[
+                pk for pk, src, dst in follows.values_list('id', 'follower_id', 'following_id') if (src, dst) in pairs
+            ]).delete()
+            likes = Like.objects.filter(user_id__in=sources, post__user_id__in=targets)
+            Like.objects.filter(id__in=[
+                pk for pk, src, dst in likes.values_list('id', 'user_id', 'post__user_id') if (src, dst) in pairs
+            ]).delete()
+        self.stats['block'] += len(new)
+
+    def import_likes(self, batch):
+        records = [record for _, record in batch]
+        users = self.resolve_users(_names(records, 'user'))
+        posts = self.resolve_posts({str(r.get('post')) for r in records if r.get('post') is not None})
+
+        def parse(record):
+            username, = _required(record, 'user')
+            ref = record.get('post')
+            if ref is None or ref == '':
+                raise InvalidRecord('missing post')
+            if isinstance(ref, bool) or not isinstance(ref, (str, int)):
+                raise InvalidRecord(f'invalid post {ref!r}')
+            if username not in users:
+                raise InvalidRecord(f'unknown user {username!r}')
+            if str(ref) not in posts:
+                raise InvalidRecord(f'unknown post {ref!r}')
+            return users[username], posts[str(ref)], _timestamp(record)
+
+        rows = {(user_id, post_id): created_at for user_id, post_id, created_at in self.parse(batch, parse)}
+        existing = set(Like.objects.filter(
+            post_id__in={p for _, p in rows}
+        ).values_list('user_id', 'post_id').iterator())
+        new = [(u, p, created_at) for (u, p), created_at in rows.items() if (u, p) not in existing]
+        self.stats['skipped'] += len(rows) - len(new)
+
+        before = last_id(Like)
+        insert_rows(Like, ['user_id', 'post_id', 'created_at'], new, ignore_conflicts=True)
+        log_inserted(ChangeLog.Kind.LIKE, Like.objects.filter(id__gt=before), 'user_id', 'post__user_id')
+        self.liked_posts.update(p for _, p, _ in new)
+        if self.with_activities and new:
+            owners = dict(Post.objects.filter(id__in={p for _, p, _ in new}).values_list('id', 'user_id'))
+            self.create_activities(
+                (Activity.Verb.POST_LIKED, u, owners.get(p), p, created_at) for u, p, created_at in new
+            )
+        self.stats['like'] += len(new)
+
+    def create_activities(self, rows):
+        insert_activities(list(rows))
+
+    # Finishing
+
+    def hash_deferred_passwords(self, workers=None):
+        """
+        Hash plain-text passwords in parallel once all rows are in
+        """
+        pending, self.deferred_passwords = self.deferred_passwords, []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            hashes = pool.map(make_password, [raw for _, raw in pending], chunksize=32)
+            users = [User(id=user_id, password=password) for (user_id, _), password in zip(pending, hashes)]
+        for start in range(0, len(users), 500):
+            with transaction.atomic():
+                User.objects.bulk_update(users[start:start + 500], ['password'])
@@ -0,0 +1,402 @@
+"""
+Like counters and write coalescing for hot posts.
+
+``Post.like_count`` is kept in step with the Like table by the signal
+handlers in ``social.signals`` for ordinary writes and recomputed with
+``recount_likes`` after bulk writes, which bypass signals.
+
+With ``SOCIAL_LIKE_COALESCING`` enabled, ``PostViewSet.like`` hands like
+and unlike toggles to the ``LikeBuffer`` instead of writing them. The
+buffer lives in a memory-mapped file (``SOCIAL_LIKE_BUFFER_FILE``, on
+/dev/shm by default) shared by all gunicorn workers, so a like and an
+unlike of the same post taken by different workers still cancel out
+before the next flush. Each worker runs a flusher thread, and a file lock
+lets one of them at a time write the toggles of every worker every
+``SOCIAL_LIKE_FLUSH_INTERVAL`` seconds in one transaction: one
+``INSERT ... ON CONFLICT DO NOTHING`` batch for likes, one DELETE per post
+for unlikes and a single counter UPDATE per touched post. The batch being
+written stays visible to new toggles and to the reported counts until it
+commits. Toggles of users or posts deleted meanwhile are dropped, and a
+toggle that fails ``MAX_RETRIES`` flushes is dropped and logged. Toggles
+in the buffer survive a killed worker, but not a reboot.
+"""
+import atexit
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .bulk import insert_rows
+from .changelog import last_id, log_inserted
+from .rowcache import invalidate
+from .sharding import insert_activities
+from .models import Post, Like, Activity, ChangeLog
+
+User = get_user_model()
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+
+@contextmanager
+def counters_suppressed():
+    """
+    Skip per-row like_count signal updates while a bulk path recounts instead
+    """
+    _state.suppressed = True
+    try:
+        yield
+    finally:
+        _state.suppressed = False
+
+
+def counters_are_suppressed():
+    return getattr(_state, 'suppressed', False)
+
+
+def with_viewer_liked(posts, user):
+    """
+    Annotate whether the user liked each post, replacing a query per row
+    """
+    if not user.is_authenticated:
+        return posts
+    return posts.annotate(viewer_liked=Exists(Like.objects.filter(post=OuterRef('pk'), user=user)))
+
+
+def recount_likes(post_ids):
+    """
+    Set like_count from the Like table with one UPDATE for all given posts
+    """
+    post_ids = list(post_ids)
+    count = Like.objects.filter(post=OuterRef('pk')).order_by().values('post').annotate(c=Count('*')).values('c')
+    for start in range(0, len(post_ids), 500):
+        Post.objects.filter(id__in=post_ids[start:start + 500]).update(like_count=Coalesce(Subquery(count), 0))
+    invalidate(Post, post_ids)
+
+
+# Header: magic, slots per table, live toggles, deleted toggle slots, deleted delta slots
+HEADER = struct.Struct('=8sqqqq')
+# User id, post id, slot state, liked in the database, liked after the toggles,
+# value being written by a flush (-1 when none), failed flushes
+ENTRY = struct.Struct('=qqbbbbbxxx')
+# Post id, like count change not yet written, slot state
+DELTA = struct.Struct('=qqq')
+MAGIC = b'MIDYALB1'
+EMPTY, USED, DELETED = 0, 1, 2
+# Byte-range locks: one for the tables, one held by the worker that is flushing
+TABLE_LOCK, FLUSH_LOCK = 0, 1
+# Toggles that failed this many flushes are dropped
+MAX_RETRIES = 5
+
+
+class LikeBuffer:
+    """
+    Pending like toggles of every worker, in two open-addressed hash tables
+    in a memory-mapped file: the toggles by (user, post) and the resulting
+    like count change by post. Holds at most ``max_pending`` toggles.
+    """
+
+    def __init__(self, path, interval=0.25, max_pending=5000):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.slots = max_pending * 2
+        self.entries_at = HEADER.size
+        self.deltas_at = self.entries_at + ENTRY.size * self.slots
+        size = self.deltas_at + DELTA.size * self.slots
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        # fcntl locks are per process; these serialize our own threads
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread_lock = threading.Lock()
+        self.thread = None
+        with self.locked():
+            magic, slots = HEADER.unpack_from(self.map)[:2]
+            if (magic, slots) != (MAGIC, self.slots):
+                if magic == MAGIC:
+                    logger.warning('Like buffer resized to %d slots, dropping its pending toggles', self.slots)
+                self.map[:size] = bytes(size)
+                HEADER.pack_into(self.map, 0, MAGIC, self.slots, 0, 0, 0)
+
+    @contextmanager
+    def locked(self, shared=False):
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX, 1, TABLE_LOCK)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, TABLE_LOCK)
+
+    # Tables
+
+    def _counts(self):
+        return list(HEADER.unpack_from(self.map)[2:])
+
+    def _set_counts(self, live, deleted, deltas_deleted):
+        HEADER.pack_into(self.map, 0, MAGIC, self.slots, live, deleted, deltas_deleted)
+
+    def _probe(self, at, layout, key):
+        """
+        Return the offset of the slot holding ``key`` (or None) and of the
+        first slot a new key can go into
+        """
+        start = (key[0] * 1000003 + key[-1]) % self.slots
+        free = None
+        for i in range(self.slots):
+            offset = at + (start + i) % self.slots * layout.size
+            row = layout.unpack_from(self.map, offset)
+            if row[2] == EMPTY:
+                return None, offset if free is None else free
+            if row[2] == DELETED:
+                if free is None:
+                    free = offset
+            elif row[:len(key)] == key:
+                return offset, free
+        return None, free
+
+    def _rows(self, at, layout):
+        for index, row in enumerate(layout.iter_unpack(self.map[at:at + layout.size * self.slots])):
+            if row[2] == USED:
+                yield at + index * layout.size, row
+
+    def _add_delta(self, post_id, change):
+        if not change:
+            return
+        live, deleted, deltas_deleted = self._counts()
+        offset, free = self._probe(self.deltas_at, DELTA, (post_id,))
+        if offset is None:
+            if DELTA.unpack_from(self.map, free)[2] == DELETED:
+                deltas_deleted -= 1
+            DELTA.pack_into(self.map, free, post_id, change, USED)
+        else:
+            delta = DELTA.unpack_from(self.map, offset)[1] + change
+            if delta:
+                DELTA.pack_into(self.map, offset, post_id, delta, USED)
+            else:
+                DELTA.pack_into(self.map, offset, 0, 0, DELETED)
+                deltas_deleted += 1
+        self._set_counts(live, deleted, deltas_deleted)
+
+    def _delete(self, offset):
+        live, deleted, deltas_deleted = self._counts()
+        ENTRY.pack_into(self.map, offset, 0, 0, DELETED, 0, 0, -1, 0)
+        self._set_counts(live - 1, deleted + 1, deltas_deleted)
+
+    def _compact(self):
+        """
+        Rehash both tables once deleted slots make up a quarter of either
+        """
+        live, deleted, deltas_deleted = self._counts()
+        if max(deleted, deltas_deleted) < self.slots // 4:
+            return
+        entries = [row for _, row in self._rows(self.entries_at, ENTRY)]
+        deltas = [row for _, row in self._rows(self.deltas_at, DELTA)]
+        self.map[self.entries_at:] = bytes(len(self.map) - self.entries_at)
+        for row in entries:
+            ENTRY.pack_into(self.map, self._probe(self.entries_at, ENTRY, row[:2])[1], *row)
+        for row in deltas:
+            DELTA.pack_into(self.map, self._probe(self.deltas_at, DELTA, row[:1])[1], *row)
+        self._set_counts(len(entries), 0, 0)
+
+    # Toggles
+
+    def pending_state(self, user_id, post_id):
+        with self.locked(shared=True):
+            offset, _ = self._probe(self.entries_at, ENTRY, (user_id, post_id))
+            return None if offset is None else bool(ENTRY.unpack_from(self.map, offset)[4])
+
+    def pending_delta(self, post_id):
+        with self.locked(shared=True):
+            offset, _ = self._probe(self.deltas_at, DELTA, (post_id,))
+            return 0 if offset is None else DELTA.unpack_from(self.map, offset)[1]
+
+    def toggle(self, user_id, post_id, liked, liked_in_db):
+        """
+        Record the desired like state. Returns False when it is already the current state.
+        """
+        for attempt in range(2):
+            with self.locked():
+                changed = self._toggle(user_id, post_id, liked, liked_in_db)
+            if changed is not None:
+                self.start()
+                return changed
+            if not attempt:
+                self.flush()
+        # Still full after a flush (the database is failing): write it through
+        self.write({(user_id, post_id): liked})
+        return True
+
+    def _toggle(self, user_id, post_id, liked, liked_in_db):
+        offset, free = self._probe(self.entries_at, ENTRY, (user_id, post_id))
+        if offset is None:
+            if liked == liked_in_db:
+                return False
+            live, deleted, deltas_deleted = self._counts()
+            if live >= self.max_pending:
+                return None
+            if ENTRY.unpack_from(self.map, free)[2] == DELETED:
+                deleted -= 1
+            ENTRY.pack_into(self.map, free, user_id, post_id, USED, liked_in_db, liked, -1, 0)
+            self._set_counts(live + 1, deleted, deltas_deleted)
+        else:
+            _, _, _, original, current, flushing, retries = ENTRY.unpack_from(self.map, offset)
+            if current == liked:
+                return False
+            if liked == original and flushing < 0:
+                # Toggled back before a flush: nothing to write
+                self._delete(offset)
+            else:
+                ENTRY.pack_into(self.map, offset, user_id, post_id, USED, original, liked, flushing, retries)
+        self._add_delta(post_id, 1 if liked else -1)
+        return True
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            with self.thread_lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self.run, name='like-flusher', daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush(wait=False)
+            except Exception:
+                logger.exception('Like buffer flush failed')
+
+    def flush(self, wait=True):
+        """
+        Write the toggles of all workers. One worker flushes at a time; with
+        ``wait=False`` a flush already running elsewhere is left to it.
+        """
+        if not self.flush_lock.acquire(blocking=wait):
+            return 0
+        try:
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB, 1, FLUSH_LOCK)
+            except OSError:
+                return 0
+            try:
+                return self._flush()
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, FLUSH_LOCK)
+        finally:
+            self.flush_lock.release()
+
+    def _flush(self):
+        with self.locked():
+            batch = {}
+            if self._counts()[0]:
+                for offset, (user_id, post_id, _, original, current, flushing, retries) in self._rows(
+                        self.entries_at, ENTRY):
+                    # A value still marked as being written was left by a flusher that died; write it again
+                    if current != original or flushing >= 0:
+                        ENTRY.pack_into(self.map, offset, user_id, post_id, USED, original, current, current, retries)
+                        batch[offset] = (user_id, post_id), current
+            if not batch:
+                self._compact()
+                return 0
+        # The batch stays visible to new toggles and to the reported counts until it commits
+        try:
+            self.write(dict(batch.values()))
+        except Exception:
+            with self.locked():
+                self._failed(batch)
+                self._compact()
+            raise
+        with self.locked():
+            for offset, (key, written) in batch.items():
+                _, _, _, original, current, _, _ = ENTRY.unpack_from(self.map, offset)
+                # like_count now includes the written state
+                self._add_delta(key[1], original - written)
+                if current == written:
+                    self._delete(offset)
+                else:
+                    ENTRY.pack_into(self.map, offset, *key, USED, written, current, -1, 0)
+            self._compact()
+        return len(batch)
+
+    def _failed(self, batch):
+        dropped = []
+        for offset, (key, _) in batch.items():
+            _, _, _, original, current, _, retries = ENTRY.unpack_from(self.map, offset)
+            if retries + 1 >= MAX_RETRIES:
+                self._add_delta(key[1], original - current)
+                self._delete(offset)
+                dropped.append((*key, bool(current)))
+            else:
+                ENTRY.pack_into(self.map, offset, *key, USED, original, current, -1, retries + 1)
+        if dropped:
+            logger.error('Dropped %d like toggles after %d failed flushes: %s', len(dropped), MAX_RETRIES,
+                         ', '.join(f'user {u} post {p} liked={liked}' for u, p, liked in dropped))
+
+    def write(self, batch):
+        """
+        Write {(user_id, post_id): liked} in one transaction. Toggles of
+        users or posts deleted meanwhile are dropped, since their rows
+        would fail the foreign key check at commit.
+        """
+        unlikes = defaultdict(list)
+        for (user_id, post_id), liked in batch.items():
+            if not liked:
+                unlikes[post_id].append(user_id)
+
+        with transaction.atomic(), counters_suppressed():
+            owners = dict(Post.objects.filter(id__in={post_id for _, post_id in batch}).values_list('id', 'user_id'))
+            users = set(User.objects.filter(id__in={user_id for user_id, _ in batch}).values_list('id', flat=True))
+            likes = [key for key, liked in batch.items() if liked and key[0] in users and key[1] in owners]
+            existing = set(Like.objects.filter(
+                post_id__in={post_id for _, post_id in likes}, user_id__in={user_id for user_id, _ in likes}
+            ).values_list('user_id', 'post_id'))
+            new = [key for key in likes if key not in existing]
+
+            now = timezone.now()
+            before = last_id(Like)
+            insert_rows(Like, ['user_id', 'post_id', 'created_at'],
+                        [(user_id, post_id, now) for user_id, post_id in new], ignore_conflicts=True)
+            log_inserted(ChangeLog.Kind.LIKE, Like.objects.filter(id__gt=before), 'user_id', 'post__user_id')
+            for post_id, user_ids in unlikes.items():
+                Like.objects.filter(post_id=post_id, user_id__in=user_ids).delete()
+            insert_activities([(Activity.Verb.POST_LIKED, user_id, owners[post_id], post_id, now) for user_id, post_id in new])
+            recount_likes(owners)
+
+
+_buffer = None
+_buffer_pid = None
+_buffer_lock = threading.Lock()
+
+
+def get_like_buffer():
+    global _buffer, _buffer_pid
+    # Opened per process, after gunicorn forks the workers
+    if _buffer is None or _buffer_pid != os.getpid():
+        with _buffer_lock:
+            if _buffer is None or _buffer_pid != os.getpid():
+                _buffer = LikeBuffer(
+                    settings.SOCIAL_LIKE_BUFFER_FILE,
+                    interval=getattr(settings, 'SOCIAL_LIKE_FLUSH_INTERVAL', 0.25),
+                    max_pending=getattr(settings, 'SOCIAL_LIKE_MAX_PENDING', 5000),
+                )
+                _buffer_pid = os.getpid()
+                atexit.register(_buffer.flush)
+    return _buffer
+
+
+def coalescing_enabled():
+    return getattr(settings, 'SOCIAL_LIKE_COALESCING', False)
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from social.archive import archive_activities, compact_activities
+
+
+class Command(BaseCommand):
+    help = 'Collapses redundant activities and moves old ones into monthly gzip archives'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.ACTIVITY_RETENTION_DAYS,
+                            help='Archive activities older than this many days')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows moved per batch')
+        parser.add_argument('--no-compact', action='store_true', help='Skip collapsing redundant activities')
+
+    def handle(self, *args, **options):
+        if not options['no_compact']:
+            removed = compact_activities()
+            self.stdout.write(f'Collapsed {removed} redundant activities')
+        
+        moved = archive_activities(options['days'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {moved} activities older than {options["days"]} days to {settings.ACTIVITY_ARCHIVE_DIR}'
+        ))
@@ -0,0 +1,75 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from rest_framework.throttling import SimpleRateThrottle
+
+from midya.throttling import get_counters
+
+
+class CacheThrottle(SimpleRateThrottle):
+    """
+    DRF's stock throttle (a timestamp list per key in the default cache), for comparison
+    """
+    rate = '1000000/min'
+    key = None
+
+    def get_cache_key(self, request, view):
+        return self.key
+
+
+def shared_memory_checks(iterations, keys):
+    counters = get_counters()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        counters.hit(f'bench:user:{random.randrange(keys)}', 1000000, 60)
+    return time.perf_counter() - start
+
+
+def cache_checks(iterations, keys):
+    throttle = CacheThrottle()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        throttle.key = f'bench:user:{random.randrange(keys)}'
+        throttle.allow_request(None, None)
+    return time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = ('Measures the cost of one throttle check with the shared-memory sliding window (midya.throttling), '
+            'against DRF\'s cache based throttle, using scratch counter and cache files')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100000, help='Checks per process')
+        parser.add_argument('--keys', type=int, default=1000, help='Distinct users being limited')
+        parser.add_argument('--processes', type=int, default=1, help='Processes checking concurrently')
+        parser.add_argument('--cache-iterations', type=int, default=2000,
+                            help='Checks per process for the cache based throttle (0 to skip)')
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp(prefix='bench-throttle-')
+        try:
+            caches = {'default': {**settings.CACHES['default'], 'LOCATION': os.path.join(directory, 'cache')}}
+            with override_settings(THROTTLE_FILE=os.path.join(directory, 'counters'), CACHES=caches):
+                self.report('shared memory', shared_memory_checks, options['iterations'], options)
+                if options['cache_iterations']:
+                    self.report('DRF cache', cache_checks, options['cache_iterations'], options)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def report(self, name, bench, iterations, options):
+        processes = options['processes']
+        with ProcessPoolExecutor(max_workers=processes, mp_context=get_context('fork')) as pool:
+            elapsed = list(pool.map(bench, [iterations] * processes, [options['keys']] * processes))
+        total = iterations * processes
+        self.stdout.write(
+            f'{name:<14} {sum(elapsed) / total * 1e6:8.1f} us/check  '
+            f'{total / max(elapsed):10.0f} checks/s over {processes} process(es)'
+        )
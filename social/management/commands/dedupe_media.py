@@ -0,0 +1,82 @@
+import os
+
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from midya.media import HASHED_NAME, file_digest, hashed_name
+from social.models import Post
+from social.rowcache import invalidate
+
+User = get_user_model()
+
+FILE_FIELDS = [(Post, 'image'), (User, 'profile_picture')]
+
+
+class Command(BaseCommand):
+    help = 'Moves uploaded files into content-addressed storage so identical files are stored once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-originals', action='store_true', help='Do not delete the files that were moved')
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help='Also delete content-addressed files no row references')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would change')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        moved, written, originals = 0, 0, {}
+
+        for model, field in FILE_FIELDS:
+            rows = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+            for pk, name in rows.values_list('pk', field).iterator(chunk_size=1000):
+                if HASHED_NAME.match(name):
+                    continue
+                if name not in originals:
+                    if not default_storage.exists(name):
+                        self.stderr.write(f'{model.__name__} {pk}: {name} is missing')
+                        continue
+                    with default_storage.open(name) as fh:
+                        new_name = hashed_name(file_digest(fh), name)
+                        if not default_storage.exists(new_name):
+                            written += default_storage.size(name)
+                            if not dry_run:
+                                default_storage.save(name, fh)
+                    originals[name] = (new_name, default_storage.size(name))
+                if not dry_run:
+                    # update() leaves auto_now fields such as updated_at alone
+                    model.objects.filter(pk=pk).update(**{field: originals[name][0]})
+                    invalidate(model, [pk])
+                moved += 1
+
+        freed = 0
+        if not options['keep_originals']:
+            freed = sum(size for _, size in originals.values()) - written
+            if not dry_run:
+                for name in originals:
+                    default_storage.delete(name)
+        self.stdout.write(f'Moved {moved} file references from {len(originals)} files')
+
+        if options['delete_orphans']:
+            removed, orphan_bytes = self.delete_orphans(dry_run)
+            freed += orphan_bytes
+            self.stdout.write(f'Deleted {removed} unreferenced files')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Freed {freed / 1024 / 1024:.1f} MiB' + (' (dry run)' if dry_run else '')
+        ))
+
+    def delete_orphans(self, dry_run):
+        referenced = set()
+        for model, field in FILE_FIELDS:
+            referenced.update(model.objects.exclude(**{field: ''}).values_list(field, flat=True).iterator())
+        removed, freed = 0, 0
+        root = default_storage.location
+        for directory, _, files in os.walk(root):
+            for filename in files:
+                name = os.path.relpath(os.path.join(directory, filename), root).replace(os.sep, '/')
+                if HASHED_NAME.match(name) and name not in referenced:
+                    freed += default_storage.size(name)
+                    removed += 1
+                    if not dry_run:
+                        default_storage.delete(name)
+        return removed, freed
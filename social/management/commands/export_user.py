@@ -0,0 +1,43 @@
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from social.export import iter_export, gzip_stream, parse_cursor
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Exports a user's posts, likes, follows, blocks and activities as NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', type=str, help='User to export')
+        parser.add_argument('--output', type=str, default='-', help='Output file (default: stdout)')
+        parser.add_argument('--gzip', action='store_true', help='Gzip the output')
+        parser.add_argument('--cursor', type=str, default=None, help='Resume after this cursor')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f'User "{options["username"]}" does not exist')
+        try:
+            parse_cursor(options['cursor'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        
+        stream = iter_export(user, cursor=options['cursor'])
+        if options['gzip']:
+            stream = gzip_stream(stream)
+        
+        if options['output'] == '-':
+            out = sys.stdout.buffer
+            for block in stream:
+                out.write(block)
+            out.flush()
+        else:
+            with open(options['output'], 'wb') as fh:
+                for block in stream:
+                    fh.write(block)
+            self.stderr.write(self.style.SUCCESS(f'Exported {user.username} to {options["output"]}'))
@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from social.graph import GraphIndex, snapshot_path
+from social.models import GraphEvent
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the follow/block graph snapshot loaded by each worker on startup'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', type=str, default=None, help='Snapshot path (defaults to SOCIAL_GRAPH_SNAPSHOT)')
+        parser.add_argument('--prune-hours', type=int, default=24,
+                            help='Delete graph events older than this many hours (0 keeps everything)')
+
+    def handle(self, *args, **options):
+        path = options['output'] or snapshot_path()
+        index = GraphIndex.build()
+        index.save(path)
+        
+        follows = index.relations[0].forward.base
+        blocks = index.relations[1].forward.base
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {len(follows)} follows and {len(blocks)} blocks '
+            f'({index.nbytes() // 1024} KiB in memory) to {path}'
+        ))
+        
+        if options['prune_hours']:
+            cutoff = timezone.now() - timedelta(hours=options['prune_hours'])
+            deleted, _ = GraphEvent.objects.filter(created_at__lt=cutoff, id__lte=index.last_event_id).delete()
+            self.stdout.write(f'Pruned {deleted} graph events')
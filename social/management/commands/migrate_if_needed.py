@@ -0,0 +1,32 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.migrations.executor import MigrationExecutor
+
+from social.sharding import shard_aliases
+
+
+def pending_migrations(alias):
+    """
+    Migrations ``migrate`` would apply to ``alias``, read from its
+    django_migrations table, so rollbacks and partial runs are seen too
+    """
+    executor = MigrationExecutor(connections[alias])
+    return executor.migration_plan(executor.loader.graph.leaf_nodes())
+
+
+class Command(BaseCommand):
+    help = ('Runs migrate on the main and shard databases that have unapplied migrations, '
+            'so an unchanged deploy boots without it')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Migrate even if nothing is pending')
+
+    def handle(self, *args, **options):
+        for alias in ['default'] + shard_aliases():
+            pending = pending_migrations(alias)
+            if not options['force'] and not pending:
+                self.stdout.write(f'{alias}: no pending migrations, skipping migrate')
+                continue
+            call_command('migrate', database=alias, interactive=False, verbosity=options['verbosity'])
+            self.stdout.write(self.style.SUCCESS(f'{alias}: migrated, {len(pending)} migration(s) applied'))
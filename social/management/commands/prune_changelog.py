@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from social.changelog import prune_changelog
+
+
+class Command(BaseCommand):
+    help = 'Deletes old delta sync change log entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CHANGELOG_RETENTION_DAYS,
+                            help='Delete entries older than this many days')
+
+    def handle(self, *args, **options):
+        deleted = prune_changelog(options['days'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {deleted} change log entries older than {options["days"]} days'
+        ))
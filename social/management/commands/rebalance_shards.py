@@ -0,0 +1,34 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from social.sharding import shard_count, shard_aliases, rebalance, seed_sequence
+
+
+class Command(BaseCommand):
+    help = 'Migrates the activity shards and moves every activity into the shard of its actor'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows moved per batch')
+        parser.add_argument('--migrate-only', action='store_true', help='Only create or migrate the shard databases')
+
+    def handle(self, *args, **options):
+        if not shard_count():
+            self.stdout.write('Sharding is disabled (SOCIAL_SHARD_COUNT is 0)')
+            return
+        
+        for alias in shard_aliases():
+            call_command('migrate', database=alias, verbosity=0)
+        if options['migrate_only']:
+            self.stdout.write(self.style.SUCCESS(f'Migrated {shard_count()} shards'))
+            return
+        
+        # Unsharded rows in the main database first, then rows left behind by a shard count change
+        total = 0
+        for source in ['default'] + shard_aliases():
+            moved = rebalance(source, batch_size=options['batch_size'])
+            if moved:
+                self.stdout.write(f'Moved {moved} activities out of {source}')
+            total += moved
+        for alias in shard_aliases():
+            seed_sequence(alias)
+        self.stdout.write(self.style.SUCCESS(f'Moved {total} activities across {shard_count()} shards'))
@@ -0,0 +1,168 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from social.models import Post, Follow
+from social.views import PostViewSet, FollowViewSet
+
+User = get_user_model()
+
+OPERATIONS = ('post', 'like', 'follow')
+
+
+def use_scratch_databases(directory, plain):
+    """
+    Point every database, the cache and the graph snapshot at ``directory``
+    """
+    connections.close_all()
+    for alias in connections:
+        connections[alias].settings_dict['NAME'] = os.path.join(directory, f'{alias}.sqlite3')
+        if plain:
+            # Django's defaults, to compare against
+            connections[alias].settings_dict.update(OPTIONS={}, CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False)
+    caches = {'default': {**settings.CACHES['default'], 'LOCATION': os.path.join(directory, 'cache')}}
+    override_settings(CACHES=caches, SOCIAL_GRAPH_SNAPSHOT=None).enable()
+
+
+def seed(users, posts):
+    User.objects.bulk_create(User(username=f'stress{i}', email=f'stress{i}@example.com', password='!')
+                             for i in range(users))
+    user_ids = list(User.objects.values_list('id', flat=True))
+    Post.objects.bulk_create(Post(user_id=random.choice(user_ids), content=f'Seed post {i}') for i in range(posts))
+
+
+def _init_worker():
+    # Forked after the parent closed its connections
+    connections.close_all()
+    random.seed()
+
+
+def hammer(seconds):
+    """
+    Run random post/like/follow requests through the API views for ``seconds``
+    """
+    factory = APIRequestFactory()
+    create_post = PostViewSet.as_view({'post': 'create'})
+    like = PostViewSet.as_view({'post': 'like', 'delete': 'like'})
+    follow = FollowViewSet.as_view({'post': 'create'})
+    unfollow = FollowViewSet.as_view({'delete': 'destroy'})
+    users = list(User.objects.all())
+    post_ids = list(Post.objects.values_list('id', flat=True))
+
+    done, locked, failed = Counter(), Counter(), Counter()
+    latencies = defaultdict(list)
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        operation = random.choice(OPERATIONS)
+        user = random.choice(users)
+        start = time.perf_counter()
+        try:
+            if operation == 'post':
+                request = factory.post('/api/posts/', {'content': 'Stress test post'}, format='json')
+                force_authenticate(request, user)
+                response = create_post(request)
+                if response.status_code == 201:
+                    post_ids.append(response.data['id'])
+            elif operation == 'like':
+                request = getattr(factory, random.choice(['post', 'delete']))('/api/posts/like/')
+                force_authenticate(request, user)
+                response = like(request, pk=random.choice(post_ids))
+            else:
+                target = random.choice(users)
+                existing = Follow.objects.filter(follower=user, following=target).values_list('id', flat=True).first()
+                if existing:
+                    request = factory.delete('/api/follows/')
+                    force_authenticate(request, user)
+                    response = unfollow(request, pk=existing)
+                else:
+                    request = factory.post('/api/follows/', {'following_id': target.id}, format='json')
+                    force_authenticate(request, user)
+                    response = follow(request)
+            if response.status_code >= 500:
+                failed[operation] += 1
+                continue
+        except OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            locked[operation] += 1
+            continue
+        done[operation] += 1
+        latencies[operation].append(time.perf_counter() - start)
+    connections.close_all()
+    return done, locked, failed, dict(latencies)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0
+
+
+class Command(BaseCommand):
+    help = ('Hammers post creation, likes and follows from several processes against scratch copies of the '
+            'databases and reports throughput, latency and the "database is locked" error rate')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4, help='Concurrent writer processes')
+        parser.add_argument('--seconds', type=float, default=10, help='How long each process runs')
+        parser.add_argument('--users', type=int, default=200, help='Users to seed')
+        parser.add_argument('--posts', type=int, default=1000, help='Posts to seed')
+        parser.add_argument('--plain', action='store_true',
+                            help='Use Django\'s default SQLite options instead of SQLITE_OPTIONS, for comparison')
+        parser.add_argument('--keep', action='store_true', help='Keep the scratch directory')
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp(prefix='stress-sqlite-')
+        try:
+            use_scratch_databases(directory, options['plain'])
+            for alias in connections:
+                call_command('migrate', database=alias, verbosity=0)
+            seed(options['users'], options['posts'])
+            connections.close_all()
+
+            done, locked, failed = Counter(), Counter(), Counter()
+            latencies = defaultdict(list)
+            with ProcessPoolExecutor(max_workers=options['processes'], mp_context=get_context('fork'),
+                                     initializer=_init_worker) as pool:
+                futures = [pool.submit(hammer, options['seconds']) for _ in range(options['processes'])]
+                for future in futures:
+                    worker_done, worker_locked, worker_failed, worker_latencies = future.result()
+                    done.update(worker_done)
+                    locked.update(worker_locked)
+                    failed.update(worker_failed)
+                    for operation, values in worker_latencies.items():
+                        latencies[operation].extend(values)
+        finally:
+            if options['keep']:
+                self.stdout.write(f'Scratch databases kept in {directory}')
+            else:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        mode = 'Django defaults' if options['plain'] else 'SQLITE_OPTIONS'
+        self.stdout.write(f'{options["processes"]} processes for {options["seconds"]:g}s with {mode}')
+        for operation in OPERATIONS:
+            attempts = done[operation] + locked[operation] + failed[operation]
+            self.stdout.write(
+                f'  {operation:<7} {done[operation] / options["seconds"]:8.1f}/s  '
+                f'p50 {percentile(latencies[operation], 0.5) * 1000:6.1f} ms  '
+                f'p99 {percentile(latencies[operation], 0.99) * 1000:7.1f} ms  '
+                f'locked {locked[operation]} ({locked[operation] / max(attempts, 1):.1%})  '
+                f'errors {failed[operation]}'
+            )
+        attempts = sum(done.values()) + sum(locked.values()) + sum(failed.values())
+        self.stdout.write(self.style.SUCCESS(
+            f'Total {sum(done.values()) / options["seconds"]:.1f} writes/s, '
+            f'lock error rate {sum(locked.values()) / max(attempts, 1):.2%}'
+        ))
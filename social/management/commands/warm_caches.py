@@ -0,0 +1,88 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError, as_completed
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Max
+from django.utils import timezone
+
+from social.feed import warm_feed
+from social.graph import GraphIndex, get_graph, snapshot_path
+from social.models import Activity
+from social.sharding import activity_databases
+
+
+def active_users(limit, days):
+    """
+    Ids of the users with the newest activities, most recent first
+    """
+    since = timezone.now() - timedelta(days=days)
+    latest = {}
+    for db in activity_databases():
+        rows = (Activity.objects.using(db).filter(created_at__gte=since, actor__isnull=False)
+                .values_list('actor_id').annotate(last=Max('created_at')).order_by('-last')[:limit])
+        for user_id, last in rows:
+            latest[user_id] = max(last, latest.get(user_id, last))
+    return sorted(latest, key=latest.get, reverse=True)[:limit]
+
+
+def _init_worker():
+    import django
+
+    django.setup()
+    # Never share the parent's SQLite handles across processes
+    connections.close_all()
+
+
+def warm_users(user_ids, deadline):
+    warmed = activities = 0
+    for user_id in user_ids:
+        if time.time() >= deadline:
+            break
+        activities += warm_feed(user_id)
+        warmed += 1
+    return warmed, activities
+
+
+class Command(BaseCommand):
+    help = 'Fills the feed, profile and row caches for the most recently active users, e.g. after a deploy'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Warm at most this many users')
+        parser.add_argument('--days', type=int, default=7, help='Only consider users active in this many days')
+        parser.add_argument('--seconds', type=float, default=120, help='Stop after this many seconds')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes')
+        parser.add_argument('--chunk-size', type=int, default=25, help='Users per worker task')
+        parser.add_argument('--no-snapshot', action='store_true', help='Do not rewrite the graph snapshot')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        deadline = start + options['seconds']
+
+        # Web workers load the follow/block sets from the snapshot when they start
+        if not options['no_snapshot'] and snapshot_path():
+            GraphIndex.build().save(snapshot_path())
+        get_graph()
+
+        user_ids = active_users(options['users'], options['days'])
+        chunks = [user_ids[i:i + options['chunk_size']] for i in range(0, len(user_ids), options['chunk_size'])]
+        warmed = activities = 0
+        connections.close_all()
+        pool = ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker)
+        try:
+            futures = [pool.submit(warm_users, chunk, deadline) for chunk in chunks]
+            for future in as_completed(futures, timeout=max(deadline - time.time(), 0) + 5):
+                users, count = future.result()
+                warmed += users
+                activities += count
+        except TimeoutError:
+            self.stderr.write('Time budget exhausted')
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Warmed the caches of {warmed} of {len(user_ids)} active users '
+            f'({activities} feed activities) in {time.time() - start:.1f}s'
+        ))
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.9 on 2026-10-19 13:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GraphEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.PositiveSmallIntegerField(choices=[(0, 'Follow'), (1, 'Block')])),
+                ('source_id', models.BigIntegerField()),
+                ('target_id', models.BigIntegerField()),
+                ('added', models.BooleanField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
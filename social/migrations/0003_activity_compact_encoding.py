@@ -0,0 +1,75 @@
+from django.db import migrations, models
+
+
+VERBS = {
+    'post_created': 1,
+    'post_liked': 2,
+    'user_followed': 3,
+    'user_deleted': 4,
+    'post_deleted': 5,
+}
+
+DESCRIPTIONS = {
+    1: "{actor} made a post",
+    2: "{actor} liked {target}'s post",
+    3: "{actor} followed {target}",
+    4: "User deleted by '{actor}'",
+    5: "Post deleted by '{actor}'",
+}
+
+
+def encode_verbs(apps, schema_editor):
+    Activity = apps.get_model('social', 'Activity')
+    for activity_type, verb in VERBS.items():
+        Activity.objects.filter(activity_type=activity_type).update(verb=verb)
+
+
+def decode_verbs(apps, schema_editor):
+    Activity = apps.get_model('social', 'Activity')
+    activity_types = {verb: activity_type for activity_type, verb in VERBS.items()}
+    for activity in Activity.objects.select_related('actor', 'target_user').iterator(chunk_size=2000):
+        activity.activity_type = activity_types[activity.verb]
+        activity.description = DESCRIPTIONS[activity.verb].format(
+            actor=activity.actor.username if activity.actor_id else 'A deleted user',
+            target=activity.target_user.username if activity.target_user_id else 'a deleted user',
+        )
+        activity.save(update_fields=['activity_type', 'description'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social', '0002_graphevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='verb',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Post Created'), (2, 'Post Liked'), (3, 'User Followed'), (4, 'User Deleted'), (5, 'Post Deleted')], default=1),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='activity',
+            name='activity_type',
+            field=models.CharField(max_length=20, default=''),
+        ),
+        migrations.AlterField(
+            model_name='activity',
+            name='description',
+            field=models.CharField(max_length=255, default=''),
+        ),
+        migrations.RunPython(encode_verbs, decode_verbs),
+        migrations.RemoveField(
+            model_name='activity',
+            name='activity_type',
+        ),
+        migrations.RemoveField(
+            model_name='activity',
+            name='description',
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['actor', '-created_at'], name='social_activity_actor_created'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_likes(apps, schema_editor):
+    Post = apps.get_model('social', 'Post')
+    Like = apps.get_model('social', 'Like')
+    count = Like.objects.filter(post=OuterRef('pk')).order_by().values('post').annotate(c=Count('*')).values('c')
+    Post.objects.update(like_count=Coalesce(Subquery(count), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social', '0003_activity_compact_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_likes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.2.9 on 2026-10-19 13:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social', '0005_upload'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='activity',
+            name='verb',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Post Created'), (2, 'Post Liked'), (3, 'User Followed'), (4, 'User Deleted'), (5, 'Post Deleted'), (6, 'User Mentioned')]),
+        ),
+        migrations.CreateModel(
+            name='Mention',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mentions', to='social.post')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mentions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('post', 'user')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PostTag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField()),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='post_tags', to='social.post')),
+                ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='post_tags', to='social.tag')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['tag', '-created_at'], name='social_posttag_tag_created')],
+                'unique_together': {('tag', 'post')},
+            },
+        ),
+        migrations.CreateModel(
+            name='TagCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('count', models.IntegerField(default=0)),
+                ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='counts', to='social.tag')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bucket'], name='social_tagcount_bucket')],
+                'unique_together': {('tag', 'bucket')},
+            },
+        ),
+    ]
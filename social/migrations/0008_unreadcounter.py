@@ -0,0 +1,24 @@
+# Generated by Django 5.2.9 on 2026-10-19 13:49
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_user_username_lower_index'),
+        ('social', '0007_activity_no_db_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='unread_counter', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('unread', models.IntegerField(default=0)),
+                ('last_read_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.9 on 2026-10-19 13:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social', '0008_unreadcounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.PositiveSmallIntegerField(choices=[(0, 'Post'), (1, 'Like'), (2, 'Follow'), (3, 'Block'), (4, 'User')])),
+                ('object_id', models.BigIntegerField()),
+                ('user_id', models.BigIntegerField()),
+                ('target_user_id', models.BigIntegerField(blank=True, null=True)),
+                ('deleted', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_id', 'id'], name='social_changelog_user'), models.Index(fields=['target_user_id', 'id'], name='social_changelog_target'), models.Index(condition=models.Q(('deleted', True), ('kind', 4)), fields=['id'], name='social_changelog_user_deleted')],
+            },
+        ),
+    ]
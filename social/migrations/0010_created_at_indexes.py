@@ -0,0 +1,39 @@
+# Generated by Django 5.2.9 on 2026-10-19 14:08
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social', '0009_changelog'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['created_at'], name='social_activity_created'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['verb', 'created_at'], name='social_activity_verb_created'),
+        ),
+        migrations.AddIndex(
+            model_name='block',
+            index=models.Index(fields=['created_at'], name='social_block_created'),
+        ),
+        migrations.AddIndex(
+            model_name='follow',
+            index=models.Index(fields=['created_at'], name='social_follow_created'),
+        ),
+        migrations.AddIndex(
+            model_name='like',
+            index=models.Index(fields=['created_at'], name='social_like_created'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['created_at'], name='social_post_created'),
+        ),
+    ]
@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth import get_user_model
 from django.utils import timezone
@@ -11,9 +13,16 @@ class Post(models.Model):
     image = models.ImageField(upload_to='posts/', blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Denormalised from Like, see social.likes
+    like_count = models.PositiveIntegerField(default=0, editable=False)
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at'], name='social_post_created'),
+            # Profile pages: a user's posts newest first (social.template_views)
+            models.Index(fields=['user', '-created_at', '-id'], name='social_post_user_created'),
+        ]
     
     def __str__(self):
         return f"{self.user.username}'s post - {self.content[:50]}"
@@ -27,6 +36,9 @@ class Like(models.Model):
     class Meta:
         unique_together = ['user', 'post']
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at'], name='social_like_created'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} liked {self.post.user.username}'s post"
@@ -40,6 +52,12 @@ class Follow(models.Model):
     class Meta:
         unique_together = ['follower', 'following']
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at'], name='social_follow_created'),
+            # Follower and following lists, read from the index alone (accounts.views)
+            models.Index(fields=['following', '-created_at', '-follower'], name='social_follow_followers'),
+            models.Index(fields=['follower', '-created_at', '-following'], name='social_follow_following'),
+        ]
     
     def __str__(self):
         return f"{self.follower.username} follows {self.following.username}"
@@ -53,31 +71,252 @@ class Block(models.Model):
     class Meta:
         unique_together = ['blocker', 'blocked']
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at'], name='social_block_created'),
+        ]
     
     def __str__(self):
         return f"{self.blocker.username} blocked {self.blocked.username}"
 
 
+class ActivityManager(models.Manager):
+    def create(self, **kwargs):
+        # Let the router pick the actor's shard from the instance
+        activity = self.model(**kwargs)
+        activity.save(force_insert=True, using=self._db)
+        return activity
+
+
 class Activity(models.Model):
-    ACTIVITY_TYPES = [
-        ('post_created', 'Post Created'),
-        ('post_liked', 'Post Liked'),
-        ('user_followed', 'User Followed'),
-        ('user_deleted', 'User Deleted'),
-        ('post_deleted', 'Post Deleted'),
-    ]
+    class Verb(models.IntegerChoices):
+        POST_CREATED = 1, 'Post Created'
+        POST_LIKED = 2, 'Post Liked'
+        USER_FOLLOWED = 3, 'User Followed'
+        USER_DELETED = 4, 'User Deleted'
+        POST_DELETED = 5, 'Post Deleted'
+        USER_MENTIONED = 6, 'User Mentioned'
     
-    activity_type = models.CharField(max_length=20, choices=ACTIVITY_TYPES)
-    actor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='activities', null=True, blank=True)
-    target_user = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='targeted_activities', null=True, blank=True)
-    target_post = models.ForeignKey(Post, on_delete=models.SET_NULL, null=True, blank=True)
-    description = models.CharField(max_length=255)
+    # Public activity_type names used by the API
+    ACTIVITY_TYPES = {
+        Verb.POST_CREATED: 'post_created',
+        Verb.POST_LIKED: 'post_liked',
+        Verb.USER_FOLLOWED: 'user_followed',
+        Verb.USER_DELETED: 'user_deleted',
+        Verb.POST_DELETED: 'post_deleted',
+        Verb.USER_MENTIONED: 'user_mentioned',
+    }
+    
+    # Descriptions are rendered at read time so they never go stale
+    DESCRIPTIONS = {
+        Verb.POST_CREATED: "{actor} made a post",
+        Verb.POST_LIKED: "{actor} liked {target}'s post",
+        Verb.USER_FOLLOWED: "{actor} followed {target}",
+        Verb.USER_DELETED: "User deleted by '{actor}'",
+        Verb.POST_DELETED: "Post deleted by '{actor}'",
+        Verb.USER_MENTIONED: "{actor} mentioned {target} in a post",
+    }
+    
+    verb = models.PositiveSmallIntegerField(choices=Verb.choices)
+    # No database constraints: activities may live in a shard (social/sharding.py)
+    actor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='activities', null=True, blank=True,
+                              db_constraint=False)
+    target_user = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='targeted_activities', null=True,
+                                    blank=True, db_constraint=False)
+    target_post = models.ForeignKey(Post, on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    objects = ActivityManager()
+    
     class Meta:
         ordering = ['-created_at']
         verbose_name_plural = 'Activities'
+        indexes = [
+            models.Index(fields=['actor', '-created_at'], name='social_activity_actor_created'),
+            models.Index(fields=['created_at'], name='social_activity_created'),
+            models.Index(fields=['verb', 'created_at'], name='social_activity_verb_created'),
+        ]
+    
+    @property
+    def activity_type(self):
+        return self.ACTIVITY_TYPES[self.verb]
+    
+    def render_description(self, usernames=None):
+        """
+        Render the description from a prefetched {user_id: username} map, or
+        from the related rows when no map is given.
+        """
+        if usernames is None:
+            actor = self.actor.username if self.actor_id else None
+            target = self.target_user.username if self.target_user_id else None
+        else:
+            actor = usernames.get(self.actor_id)
+            target = usernames.get(self.target_user_id)
+        return self.DESCRIPTIONS[self.verb].format(
+            actor=actor or 'A deleted user',
+            target=target or 'a deleted user',
+        )
+    
+    @property
+    def description(self):
+        return self.render_description()
+    
+    @staticmethod
+    def username_map(activities):
+        """
+        Load usernames for every actor and target of the given activities in one query
+        """
+        user_ids = set()
+        for activity in activities:
+            user_ids.add(activity.actor_id)
+            user_ids.add(activity.target_user_id)
+        user_ids.discard(None)
+        if not user_ids:
+            return {}
+        return dict(User.objects.filter(id__in=user_ids).values_list('id', 'username'))
     
     def __str__(self):
         return self.description
 
+
+class GraphEvent(models.Model):
+    """
+    Append-only log of follow/block edge changes, replayed by the in-memory graph index
+    """
+    KIND_CHOICES = [
+        (0, 'Follow'),
+        (1, 'Block'),
+    ]
+    
+    kind = models.PositiveSmallIntegerField(choices=KIND_CHOICES)
+    source_id = models.BigIntegerField()
+    target_id = models.BigIntegerField()
+    added = models.BooleanField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        verb = 'added' if self.added else 'removed'
+        return f"{self.get_kind_display()} {self.source_id} -> {self.target_id} {verb}"
+
+
+class Upload(models.Model):
+    """
+    A resumable chunked image upload, see social/uploads.py
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('complete', 'Complete'),
+        ('attached', 'Attached'),
+    ]
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField(max_length=255)
+    size = models.PositiveIntegerField()
+    received = models.PositiveIntegerField(default=0)
+    content_type = models.CharField(max_length=50, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    file = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.user.username}'s upload {self.filename} ({self.received}/{self.size})"
+
+
+class Tag(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    
+    def __str__(self):
+        return f"#{self.name}"
+
+
+class PostTag(models.Model):
+    """
+    Inverted index from hashtags to the posts using them, see social/tags.py
+    """
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE, related_name='post_tags')
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='post_tags')
+    created_at = models.DateTimeField()
+    
+    class Meta:
+        unique_together = ['tag', 'post']
+        indexes = [
+            models.Index(fields=['tag', '-created_at'], name='social_posttag_tag_created'),
+        ]
+    
+    def __str__(self):
+        return f"#{self.tag.name} on post {self.post_id}"
+
+
+class Mention(models.Model):
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='mentions')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mentions')
+    
+    class Meta:
+        unique_together = ['post', 'user']
+    
+    def __str__(self):
+        return f"@{self.user.username} in post {self.post_id}"
+
+
+class TagCount(models.Model):
+    """
+    Posts per tag per hour, kept up to date as posts are indexed
+    """
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE, related_name='counts')
+    bucket = models.DateTimeField()
+    count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['tag', 'bucket']
+        indexes = [
+            models.Index(fields=['bucket'], name='social_tagcount_bucket'),
+        ]
+    
+    def __str__(self):
+        return f"#{self.tag.name} {self.bucket:%Y-%m-%d %H:00}: {self.count}"
+
+
+class UnreadCounter(models.Model):
+    """
+    Activities a user has not seen yet, kept up to date as activities are
+    written (social/unread.py) so badge polling is a primary-key lookup
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='unread_counter')
+    unread = models.IntegerField(default=0)
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"{self.user.username}: {self.unread} unread"
+
+
+class ChangeLog(models.Model):
+    """
+    Append-only log of post, like, follow, block and user changes, read by
+    the delta sync endpoint (social/changelog.py). The id is the sync cursor.
+    """
+    class Kind(models.IntegerChoices):
+        POST = 0, 'Post'
+        LIKE = 1, 'Like'
+        FOLLOW = 2, 'Follow'
+        BLOCK = 3, 'Block'
+        USER = 4, 'User'
+    
+    kind = models.PositiveSmallIntegerField(choices=Kind.choices)
+    object_id = models.BigIntegerField()
+    # Plain ids: entries outlive the rows and users they describe
+    user_id = models.BigIntegerField()
+    target_user_id = models.BigIntegerField(null=True, blank=True)
+    deleted = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', 'id'], name='social_changelog_user'),
+            models.Index(fields=['target_user_id', 'id'], name='social_changelog_target'),
+            models.Index(fields=['id'], condition=models.Q(kind=4, deleted=True), name='social_changelog_user_deleted'),
+        ]
+    
+    def __str__(self):
+        change = 'deleted' if self.deleted else 'changed'
+        return f"{self.get_kind_display()} {self.object_id} {change}"
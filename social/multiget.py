@@ -0,0 +1,59 @@
+"""
+Multi-get for list routes.
+
+``GET /api/posts/?ids=3,1,2`` returns ``{"results": [...]}`` with one entry
+per requested id, in the requested order. Found objects are serialized as
+usual; the rest are ``{"id": 2, "error": "not_found"}`` or, for objects the
+viewer may not see, ``{"id": 2, "error": "hidden"}``. Every object comes
+from a single query and is serialized in one pass, so the viewer flags
+must be annotated by ``get_multi_get_queryset`` rather than looked up per
+object.
+"""
+from django.conf import settings
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def parse_ids(value):
+    """
+    Parse a comma separated id list, keeping the order and dropping repeats
+    """
+    ids = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part.isdigit():
+            raise ValueError('ids must be a comma separated list of integers')
+        if int(part) not in ids:
+            ids.append(int(part))
+    limit = settings.MULTI_GET_MAX_IDS
+    if len(ids) > limit:
+        raise ValueError(f'At most {limit} ids can be requested at once')
+    return ids
+
+
+class MultiGetMixin:
+    def get_multi_get_queryset(self):
+        return self.get_queryset()
+
+    def is_hidden(self, obj):
+        return False
+
+    def list(self, request, *args, **kwargs):
+        if 'ids' not in request.query_params:
+            return super().list(request, *args, **kwargs)
+        try:
+            ids = parse_ids(request.query_params['ids'])
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        found = {obj.pk: obj for obj in self.get_multi_get_queryset().filter(pk__in=ids)}
+        visible = [found[pk] for pk in ids if pk in found and not self.is_hidden(found[pk])]
+        serialized = dict(zip((obj.pk for obj in visible), self.get_serializer(visible, many=True).data))
+
+        results = []
+        for pk in ids:
+            if pk in serialized:
+                results.append(serialized[pk])
+            else:
+                results.append({'id': pk, 'error': 'hidden' if pk in found else 'not_found'})
+        return Response({'results': results})
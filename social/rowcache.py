@@ -0,0 +1,175 @@
+"""
+Read-through cache for Post and User rows.
+
+``get_posts`` and ``get_users`` look rows up in three places, in order:
+
+1. the identity map of the current request, so a row is loaded at most
+   once per request (``IdentityMapMiddleware``),
+2. the shared cache backend, where each row is stored as a tuple of
+   column values together with its derived counts (``like_count`` for
+   posts, ``posts_count`` for users). Users keep only ``USER_FIELDS``;
+   the password hash and permission flags never reach the cache and load
+   from the database if something reads them,
+3. the database, one query for all rows still missing.
+
+Every cached row carries the version token that was current when it was
+read. Writers replace the token (``invalidate``) after their transaction
+commits, so a reader that loaded a row just before a write stores it under
+the old token and nobody reads it again. Signal handlers invalidate on
+save and delete; paths that write with ``update()`` or raw SQL (like
+counters, recounts, imports) call ``invalidate`` themselves. Entries
+expire after ``ROW_CACHE_TIMEOUT`` seconds, which bounds staleness should
+a token be evicted.
+"""
+import threading
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Post
+
+User = get_user_model()
+
+KEY_PREFIX = 'row:2'
+
+# User columns the serializers and templates read
+USER_FIELDS = {'id', 'username', 'email', 'role', 'bio', 'profile_picture', 'is_active', 'date_joined'}
+
+_local = threading.local()
+
+
+def _label(model):
+    return model._meta.model_name
+
+
+def _keys(model, pk):
+    return f'{KEY_PREFIX}:{_label(model)}:{pk}', f'{KEY_PREFIX}:{_label(model)}:{pk}:v'
+
+
+def _identity_map():
+    return getattr(_local, 'rows', None)
+
+
+def with_posts_count(users):
+    posts_count = Post.objects.filter(user=OuterRef('pk')).order_by().values('user').annotate(c=Count('*')).values('c')
+    return users.annotate(posts_count=Coalesce(Subquery(posts_count), 0))
+
+
+def _fields(model):
+    # In model order, as from_db() expects them
+    fields = [field.attname for field in model._meta.concrete_fields]
+    return fields if model is Post else [name for name in fields if name in USER_FIELDS]
+
+
+def _load(model, ids):
+    if model is Post:
+        return Post.objects.filter(id__in=ids).values_list(*_fields(Post))
+    return with_posts_count(User.objects.filter(id__in=ids)).values_list(*_fields(User), 'posts_count')
+
+
+def _instance(model, values):
+    fields = _fields(model)
+    instance = model.from_db('default', fields, values[:len(fields)])
+    if model is not Post:
+        instance.posts_count = values[-1]
+    return instance
+
+
+def get_rows(model, ids):
+    """
+    Return {id: instance} for the ids that exist
+    """
+    rows = {}
+    identity_map = _identity_map()
+    seen = identity_map.setdefault(model, {}) if identity_map is not None else {}
+    missing = []
+    for pk in ids:
+        if pk in seen:
+            if seen[pk] is not None:
+                rows[pk] = seen[pk]
+        else:
+            missing.append(pk)
+    if not missing:
+        return rows
+
+    keys = {pk: _keys(model, pk) for pk in missing}
+    cached = cache.get_many([key for pair in keys.values() for key in pair])
+    tokens, to_load = {}, []
+    for pk, (key, version_key) in keys.items():
+        tokens[pk] = cached.get(version_key)
+        entry = cached.get(key)
+        if entry is not None and entry[0] == tokens[pk]:
+            rows[pk] = seen[pk] = _instance(model, entry[1])
+        else:
+            to_load.append(pk)
+
+    if to_load:
+        loaded = {values[0]: values for values in _load(model, to_load)}
+        cache.set_many({keys[pk][0]: (tokens[pk], values) for pk, values in loaded.items()}, settings.ROW_CACHE_TIMEOUT)
+        for pk in to_load:
+            seen[pk] = _instance(model, loaded[pk]) if pk in loaded else None
+            if seen[pk] is not None:
+                rows[pk] = seen[pk]
+    return rows
+
+
+def get_posts(ids):
+    """
+    Posts by id with their authors attached, so ``post.user`` needs no query
+    """
+    posts = get_rows(Post, ids)
+    users = get_rows(User, {post.user_id for post in posts.values()})
+    for post in posts.values():
+        if post.user_id in users:
+            Post.user.field.set_cached_value(post, users[post.user_id])
+    return posts
+
+
+def get_users(ids):
+    return get_rows(User, ids)
+
+
+def get_post(pk):
+    post = get_posts([pk]).get(pk)
+    if post is None:
+        raise Post.DoesNotExist
+    return post
+
+
+def get_user(pk):
+    user = get_users([pk]).get(pk)
+    if user is None:
+        raise User.DoesNotExist
+    return user
+
+
+def invalidate(model, ids):
+    """
+    Give the rows a new version once the current transaction commits
+    """
+    ids = set(ids)
+    identity_map = _identity_map()
+    if identity_map is not None:
+        for pk in ids:
+            identity_map.get(model, {}).pop(pk, None)
+    if ids:
+        transaction.on_commit(lambda: cache.set_many(
+            {_keys(model, pk)[1]: uuid.uuid4().hex for pk in ids}, settings.ROW_CACHE_TIMEOUT * 2
+        ))
+
+
+class IdentityMapMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.rows = {}
+        try:
+            return self.get_response(request)
+        finally:
+            _local.rows = None
@@ -1,11 +1,16 @@
 from rest_framework import serializers
+from midya.metrics import SerializerMetricsMixin
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import Post, Like, Follow, Block, Activity
+from django.db import models
+from .models import Post, Like, Follow, Block, Activity, Upload
+from .likes import coalescing_enabled, get_like_buffer
+from .rowcache import get_users
 
 User = get_user_model()
 
 
-class PostSerializer(serializers.ModelSerializer):
+class PostSerializer(SerializerMetricsMixin, serializers.ModelSerializer):
     user = serializers.StringRelatedField(read_only=True)
     user_id = serializers.IntegerField(source='user.id', read_only=True)
     user_role = serializers.CharField(source='user.role', read_only=True)
@@ -29,11 +34,20 @@ class PostSerializer(serializers.ModelSerializer):
         return None
     
     def get_likes_count(self, obj):
-        return obj.likes.count()
+        if coalescing_enabled():
+            return obj.like_count + get_like_buffer().pending_delta(obj.id)
+        return obj.like_count
     
     def get_is_liked(self, obj):
         request = self.context.get('request')
         if request and request.user.is_authenticated:
+            if coalescing_enabled():
+                pending = get_like_buffer().pending_state(request.user.id, obj.id)
+                if pending is not None:
+                    return pending
+            viewer_liked = getattr(obj, 'viewer_liked', None)
+            if viewer_liked is not None:
+                return viewer_liked
             return obj.likes.filter(user=request.user).exists()
         return False
     
@@ -51,47 +65,111 @@ class PostSerializer(serializers.ModelSerializer):
         return False
 
 
-class LikeSerializer(serializers.ModelSerializer):
-    user = serializers.StringRelatedField(read_only=True)
+class CachedUsernameField(serializers.Field):
+    """
+    Username for a user id, read through the row cache instead of a join
+    """
+    
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+    
+    def to_representation(self, user_id):
+        user = get_users([user_id]).get(user_id)
+        return str(user) if user else None
+
+
+class CachedUsersListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # Load every user of the page in one cache round trip
+        items = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        sources = [field.source for field in self.child.fields.values() if isinstance(field, CachedUsernameField)]
+        get_users({getattr(item, source) for item in items for source in sources})
+        return super().to_representation(items)
+
+
+class LikeSerializer(SerializerMetricsMixin, serializers.ModelSerializer):
+    user = CachedUsernameField(source='user_id')
     post = serializers.PrimaryKeyRelatedField(read_only=True)
     
     class Meta:
         model = Like
+        list_serializer_class = CachedUsersListSerializer
         fields = ['id', 'user', 'post', 'created_at']
         read_only_fields = ['id', 'created_at']
 
 
-class FollowSerializer(serializers.ModelSerializer):
-    follower = serializers.StringRelatedField(read_only=True)
-    follower_id = serializers.IntegerField(source='follower.id', read_only=True)
-    following = serializers.StringRelatedField(read_only=True)
-    following_id = serializers.IntegerField(source='following.id', read_only=True)
+class FollowSerializer(SerializerMetricsMixin, serializers.ModelSerializer):
+    follower = CachedUsernameField(source='follower_id')
+    follower_id = serializers.IntegerField(read_only=True)
+    following = CachedUsernameField(source='following_id')
+    following_id = serializers.IntegerField(read_only=True)
     
     class Meta:
         model = Follow
+        list_serializer_class = CachedUsersListSerializer
         fields = ['id', 'follower', 'follower_id', 'following', 'following_id', 'created_at']
         read_only_fields = ['id', 'created_at']
 
 
-class BlockSerializer(serializers.ModelSerializer):
-    blocker = serializers.StringRelatedField(read_only=True)
-    blocker_id = serializers.IntegerField(source='blocker.id', read_only=True)
-    blocked = serializers.StringRelatedField(read_only=True)
-    blocked_id = serializers.IntegerField(source='blocked.id', read_only=True)
+class BlockSerializer(SerializerMetricsMixin, serializers.ModelSerializer):
+    blocker = CachedUsernameField(source='blocker_id')
+    blocker_id = serializers.IntegerField(read_only=True)
+    blocked = CachedUsernameField(source='blocked_id')
+    blocked_id = serializers.IntegerField(read_only=True)
     
     class Meta:
         model = Block
+        list_serializer_class = CachedUsersListSerializer
         fields = ['id', 'blocker', 'blocker_id', 'blocked', 'blocked_id', 'created_at']
         read_only_fields = ['id', 'created_at']
 
 
-class ActivitySerializer(serializers.ModelSerializer):
-    actor = serializers.StringRelatedField(read_only=True)
-    target_user = serializers.StringRelatedField(read_only=True)
+class ActivityListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # One username query for the whole page instead of two joins per row
+        activities = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        self.context['usernames'] = Activity.username_map(activities)
+        return super().to_representation(activities)
+
+
+class ActivitySerializer(SerializerMetricsMixin, serializers.ModelSerializer):
+    activity_type = serializers.CharField(read_only=True)
+    actor = serializers.SerializerMethodField()
+    target_user = serializers.SerializerMethodField()
+    description = serializers.SerializerMethodField()
     
     class Meta:
         model = Activity
+        list_serializer_class = ActivityListSerializer
         fields = ['id', 'activity_type', 'actor', 'target_user', 'target_post', 
                   'description', 'created_at']
         read_only_fields = ['id', 'created_at']
+    
+    def _usernames(self, obj):
+        usernames = self.context.get('usernames')
+        if usernames is None:
+            usernames = self.context['usernames'] = Activity.username_map([obj])
+        return usernames
+    
+    def get_actor(self, obj):
+        return self._usernames(obj).get(obj.actor_id)
+    
+    def get_target_user(self, obj):
+        return self._usernames(obj).get(obj.target_user_id)
+    
+    def get_description(self, obj):
+        return obj.render_description(self._usernames(obj))
 
+
+class UploadSerializer(serializers.ModelSerializer):
+    offset = serializers.IntegerField(source='received', read_only=True)
+    chunk_size = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = Upload
+        fields = ['id', 'filename', 'size', 'offset', 'chunk_size', 'content_type', 'status', 'created_at']
+        read_only_fields = fields
+    
+    def get_chunk_size(self, obj):
+        return settings.UPLOAD_CHUNK_SIZE
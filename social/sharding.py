@@ -0,0 +1,288 @@
+"""
+Activity sharding across SQLite files.
+
+With ``SOCIAL_SHARD_COUNT`` set to N > 0, activities are stored in N extra
+SQLite databases (``shard0`` ... ``shard<N-1>``), chosen by the actor's user
+id, so the activity table and the feed queries over it are split across
+files.
+
+* ``ShardRouter`` sends Activity writes to the actor's shard and keeps
+  every other model on ``default``.
+* Each shard numbers its rows from ``(index + 1) << 40`` upwards, so ids
+  stay unique across shards and survive being moved by ``rebalance_shards``.
+* Reads that span users go through ``fanout``: the same query runs on every
+  shard involved and the ordered results are merged.
+* Activity foreign keys carry no database constraint; user and post
+  deletes are applied to the shards by signal handlers.
+
+Shard writes cannot join the main database's transaction, so
+``create_activity`` and ``insert_activities`` write new activities to the
+Activity table of ``default`` in the transaction of the post, like or
+follow they describe. That table is an outbox: ``drain_outbox`` moves its
+rows into their shards, ids preserved, once the transaction commits, and
+again after every later commit, so a crash in between delays an activity
+but cannot lose it, and a rollback leaves nothing behind. The delete hooks
+still run with ``transaction.on_commit`` on ``default``.
+
+Only activities are sharded, and each is still written to the main
+database first. Posts, likes, follows, blocks and the other tables share
+its single writer, so write throughput does not grow with the number of
+shards.
+
+With N = 0 (the default) every helper resolves to ``default``, which is
+the unsharded behaviour, and activity writes join the current transaction.
+"""
+import heapq
+from collections import defaultdict
+from itertools import islice
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import connections, models, transaction
+
+from .bulk import insert_rows
+
+SHARD_ID_SHIFT = 40
+ACTIVITY_FIELDS = ['verb', 'actor_id', 'target_user_id', 'target_post_id', 'created_at']
+
+
+def shard_count():
+    return getattr(settings, 'SOCIAL_SHARD_COUNT', 0)
+
+
+def shard_aliases():
+    return [f'shard{i}' for i in range(shard_count())]
+
+
+def shard_for_user(user_id):
+    """
+    Database alias that holds the activities of ``user_id``
+    """
+    count = shard_count()
+    if not count:
+        return 'default'
+    return f'shard{(user_id or 0) % count}'
+
+
+def activity_databases(user_ids=None):
+    """
+    Databases to query for activities of the given users (or of everyone)
+    """
+    if not shard_count():
+        return ['default']
+    if user_ids is None:
+        return shard_aliases()
+    return sorted({shard_for_user(user_id) for user_id in user_ids})
+
+
+class ShardRouter:
+    def _is_sharded(self, model):
+        return shard_count() and model._meta.label == 'social.Activity'
+
+    def db_for_read(self, model, **hints):
+        if not shard_count():
+            return None
+        if self._is_sharded(model):
+            instance = hints.get('instance')
+            if instance is not None and instance._meta.label == 'social.Activity':
+                return shard_for_user(instance.actor_id)
+            return None
+        return 'default'
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if self._is_sharded(type(obj1)) or self._is_sharded(type(obj2)):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db.startswith('shard'):
+            return app_label == 'social' and model_name == 'activity'
+        return None
+
+
+def seed_sequence(using):
+    """
+    Point a shard's AUTOINCREMENT counter at the end of its own id range.
+    Rows moved in from other shards keep their ids and would otherwise
+    drag the counter into another shard's range.
+    """
+    if using not in shard_aliases():
+        return
+    from .models import Activity
+
+    base = (int(using[len('shard'):]) + 1) << SHARD_ID_SHIFT
+    table = Activity._meta.db_table
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'SELECT MAX(id) FROM {table} WHERE id >= %s AND id < %s', [base, base + (1 << SHARD_ID_SHIFT)])
+        seq = cursor.fetchone()[0] or base
+        cursor.execute('DELETE FROM sqlite_sequence WHERE name = %s', [table])
+        cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, seq])
+
+
+def after_commit(func):
+    """
+    Run a shard write once the main database commits, or at once when
+    nothing is sharded so the write joins the current transaction
+    """
+    if shard_count():
+        transaction.on_commit(func, using='default')
+    else:
+        func()
+
+
+def drain_outbox():
+    """
+    Move activities written to the main database into their shards
+    """
+    if shard_count():
+        rebalance('default')
+
+
+def drain_after_commit():
+    if shard_count():
+        # A failed drain is logged and its rows wait for the next one
+        transaction.on_commit(drain_outbox, using='default', robust=True)
+
+
+def create_activity(**fields):
+    from .models import Activity
+
+    # Take the ids now; a target deleted in the same transaction has no pk afterwards
+    fields = {
+        f'{name}_id' if isinstance(value, models.Model) else name: getattr(value, 'pk', value)
+        for name, value in fields.items()
+    }
+    Activity.objects.using('default').create(**fields)
+    drain_after_commit()
+
+
+def insert_activities(rows):
+    """
+    Bulk insert (verb, actor_id, target_user_id, target_post_id, created_at)
+    rows in the current transaction; they reach the shards through the outbox
+    """
+    from .models import Activity
+
+    from .feed import invalidate_actors
+    from .unread import count_unread
+
+    insert_rows(Activity, ACTIVITY_FIELDS, rows)
+    drain_after_commit()
+    # No post_save for raw inserts
+    count_unread((row[1], row[2]) for row in rows)
+    invalidate_actors(row[1] for row in rows)
+
+
+class Fanout:
+    """
+    A read-only, ordered union of one queryset over several databases.
+
+    Supports the slicing and count() that pagination needs. A slice
+    [start:stop] reads at most ``stop`` rows per database and merges them,
+    so deep pages cost more than shallow ones.
+    """
+
+    def __init__(self, queryset, databases, key=attrgetter('created_at', 'id'), reverse=True):
+        self.queryset = queryset
+        self.databases = databases
+        self.key = key
+        self.reverse = reverse
+
+    def count(self):
+        return sum(self.queryset.using(db).count() for db in self.databases)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return self.merged(None)
+
+    def merged(self, limit):
+        parts = []
+        for db in self.databases:
+            queryset = self.queryset.using(db)
+            parts.append(list(queryset[:limit]) if limit is not None else queryset.iterator())
+        return heapq.merge(*parts, key=self.key, reverse=self.reverse)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop = index.start or 0, index.stop
+            return list(islice(self.merged(stop), start, stop))
+        return self[index:index + 1][0]
+
+    def get(self, **kwargs):
+        for db in self.databases:
+            found = self.queryset.using(db).filter(**kwargs).first()
+            if found is not None:
+                return found
+        raise self.queryset.model.DoesNotExist
+
+
+def fanout(queryset, user_ids=None):
+    """
+    Run an Activity queryset ordered by -created_at, -id on every shard
+    holding activities of ``user_ids`` and merge the results.
+    """
+    queryset = queryset.order_by('-created_at', '-id')
+    databases = activity_databases(user_ids)
+    if databases == ['default']:
+        return queryset
+    return Fanout(queryset, databases)
+
+
+def delete_user_activities(user_id):
+    """
+    Apply the cascades of a user delete to the shards
+    """
+    from .models import Activity
+
+    def write():
+        for db in shard_aliases():
+            Activity.objects.using(db).filter(actor_id=user_id).delete()
+            Activity.objects.using(db).filter(target_user_id=user_id).update(target_user_id=None)
+
+    after_commit(write)
+
+
+def detach_post_activities(post_id):
+    from .models import Activity
+
+    def write():
+        for db in shard_aliases():
+            Activity.objects.using(db).filter(target_post_id=post_id).update(target_post_id=None)
+
+    after_commit(write)
+
+
+def rebalance(source, batch_size=5000):
+    """
+    Move activities stored in ``source`` that belong to another shard.
+    Rows are copied before they are deleted, so an interrupted run can be
+    repeated. Returns the number of rows moved.
+    """
+    from django.db.models import Value
+    from django.db.models.functions import Coalesce, Mod
+    from .models import Activity
+
+    activities = Activity.objects.using(source)
+    if source != 'default':
+        index = int(source[len('shard'):])
+        activities = activities.annotate(
+            shard=Mod(Coalesce('actor_id', Value(0)), Value(shard_count()))
+        ).exclude(shard=index)
+
+    moved, last_id = 0, 0
+    while True:
+        batch = list(activities.filter(id__gt=last_id).order_by('id').values_list('id', *ACTIVITY_FIELDS)[:batch_size])
+        if not batch:
+            return moved
+        last_id = batch[-1][0]
+        by_db = defaultdict(list)
+        for row in batch:
+            by_db[shard_for_user(row[2])].append(row)
+        for using, rows in by_db.items():
+            insert_rows(Activity, ['id'] + ACTIVITY_FIELDS, rows, ignore_conflicts=True, using=using)
+        Activity.objects.using(source).filter(id__in=[row[0] for row in batch]).delete()
+        moved += len(batch)
@@ -0,0 +1,133 @@
+from django.db.models import F
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save, post_delete, pre_delete, post_migrate
+from django.dispatch import receiver
+from .models import Post, Like, Follow, Block, Activity
+from .graph import FOLLOW, BLOCK, record_edge
+from .likes import counters_are_suppressed
+from .tags import index_post, unindex_post
+from .sharding import seed_sequence, delete_user_activities, detach_post_activities
+from .unread import count_unread
+from .changelog import record_change
+from .rowcache import invalidate
+from .feed import invalidate_actors, invalidate_all_feeds, invalidate_feeds, invalidate_latest_posts
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=Follow)
+def follow_created(sender, instance, created, **kwargs):
+    if created:
+        record_edge(FOLLOW, instance.follower_id, instance.following_id, True)
+        invalidate_feeds([instance.follower_id])
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    record_edge(FOLLOW, instance.follower_id, instance.following_id, False)
+    invalidate_feeds([instance.follower_id])
+
+
+@receiver(post_save, sender=Block)
+def block_created(sender, instance, created, **kwargs):
+    if created:
+        record_edge(BLOCK, instance.blocker_id, instance.blocked_id, True)
+        invalidate_feeds([instance.blocker_id])
+
+
+@receiver(post_delete, sender=Block)
+def block_deleted(sender, instance, **kwargs):
+    record_edge(BLOCK, instance.blocker_id, instance.blocked_id, False)
+    invalidate_feeds([instance.blocker_id])
+
+
+@receiver(post_save, sender=Like)
+def like_created(sender, instance, created, **kwargs):
+    if created and not counters_are_suppressed():
+        Post.objects.filter(id=instance.post_id).update(like_count=F('like_count') + 1)
+        invalidate(Post, [instance.post_id])
+
+
+@receiver(post_delete, sender=Like)
+def like_deleted(sender, instance, origin=None, **kwargs):
+    # Likes removed along with their post need no counter update
+    if counters_are_suppressed() or isinstance(origin, Post) or getattr(origin, 'model', None) is Post:
+        return
+    Post.objects.filter(id=instance.post_id, like_count__gt=0).update(like_count=F('like_count') - 1)
+    invalidate(Post, [instance.post_id])
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created or update_fields is None or 'content' in update_fields:
+        index_post(instance)
+
+
+@receiver(post_save, sender=Activity)
+def activity_created(sender, instance, created, **kwargs):
+    if created:
+        count_unread([(instance.actor_id, instance.target_user_id)])
+        invalidate_actors([instance.actor_id])
+
+
+@receiver(pre_delete, sender=Post)
+def post_deleting(sender, instance, **kwargs):
+    unindex_post(instance)
+    detach_post_activities(instance.id)
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    # The ORM only cascades within the main database
+    delete_user_activities(instance.id)
+    # Their activities leave the feeds of everyone who followed them
+    invalidate_all_feeds()
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Like)
+@receiver(post_save, sender=Follow)
+@receiver(post_save, sender=Block)
+@receiver(post_save, sender=User)
+def log_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    record_change(instance)
+
+
+@receiver(post_delete, sender=Post)
+@receiver(post_delete, sender=Like)
+@receiver(post_delete, sender=Follow)
+@receiver(post_delete, sender=Block)
+@receiver(post_delete, sender=User)
+def log_deleted(sender, instance, origin=None, **kwargs):
+    # Rows removed along with a post or user are covered by its tombstone
+    origin_model = getattr(origin, 'model', type(origin))
+    if origin_model in (Post, User) and origin_model is not sender:
+        return
+    record_change(instance, deleted=True)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def post_changed(sender, instance, signal, created=False, **kwargs):
+    invalidate(Post, [instance.id])
+    if created or signal is post_delete:
+        # The author's posts_count and the newest posts changed
+        invalidate(User, [instance.user_id])
+        invalidate_latest_posts()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    # Logins only touch last_login, which no cached payload shows
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    invalidate(User, [instance.id])
+
+
+@receiver(post_migrate)
+def shard_migrated(sender, using, **kwargs):
+    if sender.label == 'social':
+        seed_sequence(using)
@@ -0,0 +1,147 @@
+"""
+Hashtag and mention index.
+
+Posts are parsed when they are created or their content changes. Hashtags
+go into ``PostTag`` (tag -> posts) and @mentions into ``Mention``, and
+each newly mentioned user gets a ``user_mentioned`` activity. Every tag
+use also adds one to the ``TagCount`` row of the hour the post was created
+in, and removing it subtracts one again. Trending tags are therefore a sum
+over the last few hourly rows rather than a scan of the posts.
+"""
+import re
+from collections import Counter
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .bulk import add_counts, insert_rows
+from .graph import get_graph
+from .sharding import insert_activities
+from .models import Activity, Tag, PostTag, Mention, TagCount
+
+User = get_user_model()
+
+HASHTAG = re.compile(r'(?<![\w&#])#(\w{1,50})(?!\w)')
+MENTION = re.compile(r'(?<![\w@])@([\w.@+-]{1,150})')
+TRENDING_CACHE_SECONDS = 60
+
+
+def extract_tags(content):
+    return {name.lower() for name in HASHTAG.findall(content or '')}
+
+
+def extract_mentions(content):
+    # A trailing dot is punctuation, not part of the username
+    return {name.rstrip('.') for name in MENTION.findall(content or '')} - {''}
+
+
+def hour_bucket(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def get_tags(names):
+    """
+    Return {name: tag id}, creating missing tags
+    """
+    if not names:
+        return {}
+    tags = dict(Tag.objects.filter(name__in=names).values_list('name', 'id'))
+    missing = [name for name in names if name not in tags]
+    if missing:
+        insert_rows(Tag, ['name'], [(name,) for name in missing], ignore_conflicts=True)
+        tags.update(Tag.objects.filter(name__in=missing).values_list('name', 'id'))
+    return tags
+
+
+def index_post(post):
+    """
+    Bring the tag and mention index of one post in line with its content
+    """
+    with transaction.atomic():
+        tags = get_tags(extract_tags(post.content))
+        current = dict(PostTag.objects.filter(post=post).values_list('tag_id', 'id'))
+        added = set(tags.values()) - set(current)
+        removed = set(current) - set(tags.values())
+
+        if removed:
+            PostTag.objects.filter(post=post, tag_id__in=removed).delete()
+        insert_rows(PostTag, ['tag_id', 'post_id', 'created_at'],
+                    [(tag_id, post.id, post.created_at) for tag_id in added], ignore_conflicts=True)
+        bucket = hour_bucket(post.created_at)
+        add_counts(TagCount, ['tag_id', 'bucket'], 'count',
+                   [(tag_id, bucket, 1) for tag_id in added] + [(tag_id, bucket, -1) for tag_id in removed])
+
+        index_mentions([post])
+
+
+def index_posts(posts, notify=True):
+    """
+    Index newly created posts in bulk, e.g. after an import
+    """
+    posts = list(posts)
+    names = {post.id: extract_tags(post.content) for post in posts}
+    tags = get_tags(set().union(*names.values()))
+    rows = [(tags[name], post.id, post.created_at) for post in posts for name in names[post.id]]
+    insert_rows(PostTag, ['tag_id', 'post_id', 'created_at'], rows, ignore_conflicts=True)
+    counts = Counter((tag_id, hour_bucket(created_at)) for tag_id, _, created_at in rows)
+    add_counts(TagCount, ['tag_id', 'bucket'], 'count', [(tag_id, bucket, n) for (tag_id, bucket), n in counts.items()])
+    index_mentions(posts, notify)
+
+
+def index_mentions(posts, notify=True):
+    names = {post.id: extract_mentions(post.content) for post in posts}
+    users = dict(User.objects.filter(username__in=set().union(*names.values())).values_list('username', 'id'))
+    current = set(Mention.objects.filter(post__in=posts).values_list('post_id', 'user_id'))
+    wanted = {(post.id, users[name]) for post in posts for name in names[post.id] if name in users}
+
+    stale = current - wanted
+    for post_id, user_id in stale:
+        Mention.objects.filter(post_id=post_id, user_id=user_id).delete()
+    new = wanted - current
+    insert_rows(Mention, ['post_id', 'user_id'], list(new), ignore_conflicts=True)
+    if not notify:
+        return
+
+    # Notify newly mentioned users, unless it is the author or they blocked the author
+    graph = get_graph()
+    authors = {post.id: post.user_id for post in posts}
+    now = timezone.now()
+    insert_activities([
+        (Activity.Verb.USER_MENTIONED, authors[post_id], user_id, post_id, now)
+        for post_id, user_id in sorted(new)
+        if user_id != authors[post_id] and not graph.is_blocked(user_id, authors[post_id])
+    ])
+
+
+def unindex_post(post):
+    """
+    Take a post that is about to be deleted out of the trending counts
+    """
+    bucket = hour_bucket(post.created_at)
+    tag_ids = PostTag.objects.filter(post=post).values_list('tag_id', flat=True)
+    add_counts(TagCount, ['tag_id', 'bucket'], 'count', [(tag_id, bucket, -1) for tag_id in tag_ids])
+
+
+def trending_tags(hours=24, limit=10):
+    """
+    Most used tags over the last ``hours`` hours, cached briefly
+    """
+    key = f'social:trending:{hours}:{limit}'
+    result = cache.get(key)
+    if result is None:
+        since = hour_bucket(timezone.now()) - timedelta(hours=hours - 1)
+        result = list(
+            TagCount.objects.filter(bucket__gte=since)
+            .values('tag__name')
+            .annotate(posts=Sum('count'))
+            .filter(posts__gt=0)
+            .order_by('-posts', 'tag__name')[:limit]
+        )
+        result = [{'tag': row['tag__name'], 'posts': row['posts']} for row in result]
+        cache.set(key, result, TRENDING_CACHE_SECONDS)
+    return result
+
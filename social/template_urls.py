@@ -1,5 +1,6 @@
 from django.urls import path
-from .template_views import home, login_page, register_page, feed, create_post, users_list, user_profile, logout_page
+from .template_views import (home, login_page, register_page, feed, feed_posts_page, create_post, users_list,
+                             user_profile, user_posts_page, logout_page)
 
 urlpatterns = [
     path('', home, name='home'),
@@ -7,8 +8,10 @@ urlpatterns = [
     path('register/', register_page, name='register_page'),
     path('logout/', logout_page, name='logout_page'),
     path('feed/', feed, name='feed'),
+    path('feed/posts/', feed_posts_page, name='feed_posts'),
     path('create-post/', create_post, name='create_post'),
     path('users/', users_list, name='users_list'),
     path('users/<int:user_id>/', user_profile, name='user_profile'),
+    path('users/<int:user_id>/posts/', user_posts_page, name='user_posts'),
 ]
 
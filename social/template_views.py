@@ -1,16 +1,26 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.http import Http404
+from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.core.paginator import Paginator
-from django.db.models import Q, Count, Exists, OuterRef
+from django.db.models import Q, Count, Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Lower
 from .models import Post, Like, Follow, Block, Activity
 from .serializers import PostSerializer, ActivitySerializer
 from accounts.serializers import UserSerializer, UserDetailSerializer
+from .graph import get_graph
+from .likes import with_viewer_liked
+from .feed import PAGE_SIZE, feed_activities, feed_posts, older_posts
+from .rowcache import get_user
+from .sharding import create_activity
 
 User = get_user_model()
 
+USERS_PAGE_SIZE = 24
+
 
 def home(request):
     if request.user.is_authenticated:
@@ -71,31 +81,40 @@ def logout_page(request):
     return redirect('login_page')
 
 
+def _cursor(request):
+    after = request.GET.get('after', '')
+    return int(after) if after.isdigit() else None
+
+
+def _post_page_context(request, posts, next_cursor, url):
+    return {
+        'posts': PostSerializer(posts, many=True, context={'request': request}).data,
+        'next_url': f'{url}?after={next_cursor}' if next_cursor else None,
+    }
+
+
 @login_required
 def feed(request):
-    # Get activities from users in network
-    followed_ids = request.user.following.values_list('following_id', flat=True)
-    user_ids = list(followed_ids) + [request.user.id]
-    
-    # Filter out blocked users
-    blocked_ids = request.user.blocked_users.values_list('blocked_id', flat=True)
-    user_ids = [uid for uid in user_ids if uid not in blocked_ids]
-    
-    activities = Activity.objects.filter(actor_id__in=user_ids).exclude(actor_id__in=blocked_ids).order_by('-created_at')[:50]
-    activity_serializer = ActivitySerializer(activities, many=True, context={'request': request})
-    
-    # Get posts (excluding blocked users)
-    posts = Post.objects.exclude(user_id__in=blocked_ids).select_related('user').prefetch_related('likes').order_by('-created_at')[:50]
-    post_serializer = PostSerializer(posts, many=True, context={'request': request})
+    # Activities from users in the network and the newest posts, excluding blocked users (social/feed.py)
+    activity_serializer = ActivitySerializer(feed_activities(request.user.id), many=True, context={'request': request})
+    posts, next_cursor = feed_posts(request.user)
     
     context = {
         'activities': activity_serializer.data,
-        'posts': post_serializer.data,
         'user': request.user,
+        **_post_page_context(request, posts, next_cursor, reverse('feed_posts')),
     }
     return render(request, 'social/feed.html', context)
 
 
+@login_required
+def feed_posts_page(request):
+    # The next chunk of post cards for infinite scrolling
+    posts, next_cursor = feed_posts(request.user, after=_cursor(request))
+    context = _post_page_context(request, posts, next_cursor, reverse('feed_posts'))
+    return render(request, 'social/_post_page.html', context)
+
+
 @login_required
 def create_post(request):
     if request.method == 'POST':
@@ -105,10 +124,9 @@ def create_post(request):
         try:
             post = Post.objects.create(user=request.user, content=content, image=image)
             # Create activity
-            Activity.objects.create(
-                activity_type='post_created',
-                actor=request.user,
-                description=f"{request.user.username} made a post"
+            create_activity(
+                verb=Activity.Verb.POST_CREATED,
+                actor=request.user
             )
             messages.success(request, 'Post created successfully')
             return redirect('feed')
@@ -121,43 +139,82 @@ def create_post(request):
 @login_required
 def users_list(request):
     # Show all users (blocked users are still visible, just their posts are hidden)
-    users = User.objects.annotate(
-        followers_count=Count('followers'),
-        following_count=Count('following'),
-        posts_count=Count('posts')
+    query = request.GET.get('q', '').strip().lower()
+    after = request.GET.get('after')
+    
+    users = User.objects.alias(username_lower=Lower('username'))
+    if query:
+        # Range scan on the lower(username) index instead of a LIKE
+        users = users.filter(username_lower__gte=query, username_lower__lt=query + '\U0010ffff')
+    if after and after.isdigit():
+        cursor = User.objects.filter(pk=after).values_list(Lower('username'), flat=True).first()
+        if cursor is not None:
+            users = users.filter(Q(username_lower__gt=cursor) | Q(username_lower=cursor, id__gt=after))
+    
+    posts_count = Post.objects.filter(user=OuterRef('pk')).order_by().values('user').annotate(c=Count('*')).values('c')
+    users = list(
+        users.annotate(posts_count=Coalesce(Subquery(posts_count), 0))
+        .order_by('username_lower', 'id')[:USERS_PAGE_SIZE + 1]
     )
+    has_next = len(users) > USERS_PAGE_SIZE
+    users = users[:USERS_PAGE_SIZE]
     
     user_serializer = UserDetailSerializer(users, many=True, context={'request': request})
     
     context = {
         'users': user_serializer.data,
         'user': request.user,
+        'query': request.GET.get('q', '').strip(),
+        'next_cursor': users[-1].id if has_next else None,
     }
     return render(request, 'social/users.html', context)
 
 
+def _profile_posts(request, profile_user, after=None):
+    """
+    One page of the profile user's posts and the cursor of the next page
+    """
+    # Users can see the profile of someone they blocked but not their posts
+    if get_graph().is_blocked(request.user.id, profile_user.id):
+        return [], None
+    
+    posts = Post.objects.filter(user_id=profile_user.id)
+    if after is not None:
+        posts = older_posts(posts, after)
+    posts = with_viewer_liked(posts.select_related('user').order_by('-created_at', '-id'), request.user)
+    posts = list(posts[:PAGE_SIZE + 1])
+    next_cursor = posts[PAGE_SIZE - 1].id if len(posts) > PAGE_SIZE else None
+    return posts[:PAGE_SIZE], next_cursor
+
+
 @login_required
 def user_profile(request, user_id):
-    profile_user = get_object_or_404(User, id=user_id)
+    try:
+        profile_user = get_user(user_id)
+    except User.DoesNotExist:
+        raise Http404
     
-    # Get user posts - filter out if user is blocked
-    posts = Post.objects.filter(user=profile_user)
-    
-    # Filter out posts if the profile user is blocked by current user
-    blocked_ids = request.user.blocked_users.values_list('blocked_id', flat=True)
-    if profile_user.id in blocked_ids:
-        posts = posts.none()  # Return empty queryset - user can see profile but not posts
-    
-    posts = posts.select_related('user').prefetch_related('likes').order_by('-created_at')
-    post_serializer = PostSerializer(posts, many=True, context={'request': request})
+    posts, next_cursor = _profile_posts(request, profile_user)
     
     # Serialize user
     user_serializer = UserDetailSerializer(profile_user, context={'request': request})
     
     context = {
         'profile_user': user_serializer.data,
-        'posts': post_serializer.data,
         'user': request.user,
+        **_post_page_context(request, posts, next_cursor, reverse('user_posts', args=[user_id])),
     }
     return render(request, 'social/profile.html', context)
 
+
+@login_required
+def user_posts_page(request, user_id):
+    # The next chunk of post cards for infinite scrolling
+    try:
+        profile_user = get_user(user_id)
+    except User.DoesNotExist:
+        raise Http404
+    
+    posts, next_cursor = _profile_posts(request, profile_user, after=_cursor(request))
+    context = _post_page_context(request, posts, next_cursor, reverse('user_posts', args=[user_id]))
+    return render(request, 'social/_post_page.html', context)
@@ -0,0 +1,623 @@
+import io
+import json
+import os
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from unittest import mock
+
+from midya import degraded
+
+from .archive import archive_activities, compact_activities
+from .feed import _activity_keys, feed_activities
+from .graph import GraphIndex, load_index, reset_graph
+from .likes import MAX_RETRIES, LikeBuffer
+from .models import Post, Like, Follow, Block, Activity, GraphEvent, UnreadCounter
+from .rowcache import get_posts, get_users
+from .sharding import create_activity, fanout, insert_activities, rebalance, seed_sequence, shard_for_user
+from .unread import mark_read, unread_state
+
+User = get_user_model()
+
+# Enough rows for a second page (list_per_page is 100)
+ROWS = 120
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SOCIAL_GRAPH_SNAPSHOT=None,
+)
+class LargeChangeListTests(TestCase):
+    """
+    The tuned changelists (midya.changelist) run the same number of queries
+    per page whatever the table size: unfiltered, filtered and keyset pages
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('root', 'root@example.com', 'pw')
+        User.objects.bulk_create(
+            User(username=f'user{i}', email=f'user{i}@example.com', password='!') for i in range(ROWS + 1)
+        )
+        users = list(User.objects.filter(username__startswith='user').order_by('id'))
+        Post.objects.bulk_create(Post(user=user, content=f'Post by {user.username}') for user in users)
+        posts = list(Post.objects.order_by('id'))
+        Like.objects.bulk_create(Like(user=user, post=post) for user, post in zip(users, posts[1:]))
+        Follow.objects.bulk_create(Follow(follower=a, following=b) for a, b in zip(users, users[1:]))
+        Block.objects.bulk_create(Block(blocker=a, blocked=b) for a, b in zip(users[1:], users))
+        Activity.objects.bulk_create(
+            Activity(verb=Activity.Verb.POST_LIKED, actor=user, target_user=post.user, target_post=post)
+            for user, post in zip(users, posts[1:])
+        )
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def get_page(self, model, queries, query_string=''):
+        url = reverse(f'admin:social_{model._meta.model_name}_changelist') + query_string
+        with self.assertNumQueries(queries):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def assertChangeListQueries(self, model, queries, filtered_queries):
+        response = self.get_page(model, queries)
+        cl = response.context['cl']
+        self.assertEqual(len(cl.result_list), cl.list_per_page)
+        next_url = cl.next_keyset_url()
+        self.assertIn('id__lt=', next_url)
+
+        # The next page by id costs the same and continues below the last row
+        older = self.get_page(model, filtered_queries, next_url)
+        last_id = cl.result_list[len(cl.result_list) - 1].pk
+        self.assertTrue(all(row.pk < last_id for row in older.context['cl'].result_list))
+
+        since = (timezone.now() - timedelta(days=1)).date().isoformat()
+        self.get_page(model, filtered_queries, f'?created_at__gte={since}')
+
+    def test_post_changelist(self):
+        self.assertChangeListQueries(Post, 5, 4)
+
+    def test_like_changelist(self):
+        self.assertChangeListQueries(Like, 5, 4)
+
+    def test_follow_changelist(self):
+        self.assertChangeListQueries(Follow, 5, 4)
+
+    def test_block_changelist(self):
+        self.assertChangeListQueries(Block, 5, 4)
+
+    def test_activity_changelist(self):
+        self.assertChangeListQueries(Activity, 5, 4)
+
+    def test_estimated_count(self):
+        response = self.get_page(Post, 5)
+        self.assertEqual(response.context['cl'].result_count, Post.objects.count())
+
+    @override_settings(SOCIAL_SHARD_COUNT=2)
+    def test_sharded_activity_count(self):
+        # A row that kept its shard1 id, as rebalance_shards moves them
+        Activity.objects.using('default').bulk_create([
+            Activity(id=(2 << 40) + 1, verb=Activity.Verb.POST_CREATED, actor=self.admin)
+        ])
+        # Shard ids are not contiguous, so the total is counted, not estimated
+        response = self.get_page(Activity, 4)
+        self.assertEqual(response.context['cl'].result_count, Activity.objects.count())
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SOCIAL_GRAPH_SNAPSHOT=None,
+)
+class GraphSyncTests(TestCase):
+    """
+    The graph index replays the event log only when it holds every event
+    since the index was taken, and rebuilds from the tables otherwise
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = User.objects.bulk_create(
+            User(username=f'user{i}', email=f'user{i}@example.com', password='!') for i in range(4)
+        )
+
+    def follow(self, follower, following):
+        return Follow.objects.create(follower=follower, following=following)
+
+    def test_sync_replays_events(self):
+        a, b, c, _ = self.users
+        index = GraphIndex.build()
+        self.follow(a, b)
+        self.follow(a, c)
+        Follow.objects.filter(follower=a, following=b).delete()
+        self.assertTrue(index.sync())
+        self.assertEqual(index.following_ids(a.pk), [c.pk])
+        self.assertEqual(index.follower_ids(c.pk), [a.pk])
+
+    def test_sync_across_pruned_log(self):
+        a, b, c, _ = self.users
+        empty = GraphIndex()
+        self.follow(a, b)
+        self.follow(b, c)
+        # graph_snapshot prunes events the current snapshot already holds
+        GraphEvent.objects.filter(id=GraphEvent.objects.order_by('id').values('id')[:1]).delete()
+        self.assertFalse(empty.sync())
+
+        # An index taken before the pruned events is replaced by a rebuild
+        index = load_index()
+        self.assertEqual(index.following_ids(a.pk), [b.pk])
+        self.assertEqual(index.following_ids(b.pk), [c.pk])
+
+    def test_build_after_full_prune(self):
+        a, b, c, _ = self.users
+        self.follow(a, b)
+        GraphEvent.objects.all().delete()
+        index = GraphIndex.build()
+        self.assertEqual(index.following_ids(a.pk), [b.pk])
+
+        # The next event follows the last id handed out, not the last row left
+        self.follow(a, c)
+        self.assertTrue(index.sync())
+        self.assertEqual(index.following_ids(a.pk), [b.pk, c.pk])
+
+    def test_readers_see_published_state(self):
+        a, b, c, d = self.users
+        index = GraphIndex.build()
+        adjacency = index.relations[0].forward
+        state = adjacency.state
+        index.apply(0, a.pk, b.pk, True)
+        # Earlier states are left untouched for readers still holding them
+        self.assertEqual(state[1], {})
+        self.assertIsNot(adjacency.state, state)
+        index.apply(0, a.pk, c.pk, True)
+        index.apply(0, a.pk, b.pk, False)
+        index.compact()
+        self.assertEqual(index.following_ids(a.pk), [c.pk])
+        self.assertEqual(index.follower_count(c.pk), 1)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SOCIAL_GRAPH_SNAPSHOT=None,
+)
+class ArchiveUnreadTests(TestCase):
+    """
+    Activities removed by compaction or archiving come off the unread
+    counters of the users who had not read them yet
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.actor, cls.follower, cls.author = User.objects.bulk_create(
+            User(username=name, email=f'{name}@example.com', password='!') for name in ('actor', 'follower', 'author')
+        )
+        Follow.objects.bulk_create([Follow(follower=cls.follower, following=cls.actor)])
+        cls.post = Post.objects.create(user=cls.author, content='Hello')
+        Like.objects.bulk_create([Like(user=cls.actor, post=cls.post)])
+
+    def setUp(self):
+        reset_graph()
+        self.addCleanup(reset_graph)
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        self.enterContext(override_settings(ACTIVITY_ARCHIVE_DIR=archive_dir.name))
+
+    def like_activity(self, **fields):
+        return Activity.objects.create(
+            verb=Activity.Verb.POST_LIKED, actor=self.actor, target_user=self.author, target_post=self.post, **fields
+        )
+
+    def unread(self, user):
+        return unread_state(user.pk)['unread']
+
+    def test_compacted_repeats_are_uncounted(self):
+        self.like_activity()
+        newest = self.like_activity()
+        self.assertEqual((self.unread(self.follower), self.unread(self.author)), (2, 2))
+
+        self.assertEqual(compact_activities(), 1)
+        self.assertEqual(list(Activity.objects.values_list('id', flat=True)), [newest.pk])
+        self.assertEqual((self.unread(self.follower), self.unread(self.author)), (1, 1))
+
+    def test_archived_activities_are_uncounted_unless_read(self):
+        self.like_activity()
+        mark_read(self.author.pk)
+        Activity.objects.update(created_at=timezone.now() - timedelta(days=400))
+
+        self.assertEqual(archive_activities(365), 1)
+        self.assertFalse(Activity.objects.exists())
+        self.assertEqual(self.unread(self.follower), 0)
+        # Read before it was archived, so nothing to take back
+        self.assertEqual(UnreadCounter.objects.get(pk=self.author.pk).unread, 0)
+
+    def test_counters_do_not_go_negative(self):
+        for _ in range(3):
+            self.like_activity()
+        UnreadCounter.objects.filter(pk=self.follower.pk).update(unread=1)
+        self.assertEqual(compact_activities(), 2)
+        self.assertEqual(UnreadCounter.objects.get(pk=self.follower.pk).unread, 0)
+        self.assertEqual(UnreadCounter.objects.get(pk=self.author.pk).unread, 1)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SOCIAL_GRAPH_SNAPSHOT=None,
+)
+class ImportTests(TestCase):
+    def setUp(self):
+        reset_graph()
+        self.addCleanup(reset_graph)
+
+    def import_records(self, *records):
+        fd, path = tempfile.mkstemp(suffix='.ndjson')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as fh:
+            fh.writelines(json.dumps(record) + '\n' for record in records)
+        call_command('import_social', path, stdout=io.StringIO())
+
+    def test_block_removes_follow_and_likes(self):
+        self.import_records(
+            {'type': 'user', 'username': 'ann', 'email': 'ann@example.com'},
+            {'type': 'user', 'username': 'eve', 'email': 'eve@example.com'},
+            {'type': 'post', 'user': 'eve', 'content': 'Hi', 'ref': 'p1'},
+            {'type': 'post', 'user': 'ann', 'content': 'Hello', 'ref': 'p2'},
+            {'type': 'follow', 'follower': 'ann', 'following': 'eve'},
+            {'type': 'follow', 'follower': 'eve', 'following': 'ann'},
+            {'type': 'like', 'user': 'ann', 'post': 'p1'},
+            {'type': 'like', 'user': 'eve', 'post': 'p2'},
+        )
+        self.assertEqual((Follow.objects.count(), Like.objects.count()), (2, 2))
+
+        # No snapshot is configured, so none is written
+        self.import_records({'type': 'block', 'blocker': 'ann', 'blocked': 'eve'})
+        ann, eve = User.objects.get(username='ann'), User.objects.get(username='eve')
+        self.assertTrue(Block.objects.filter(blocker=ann, blocked=eve).exists())
+        self.assertEqual(list(Follow.objects.values_list('follower', 'following')), [(eve.pk, ann.pk)])
+        self.assertEqual(list(Like.objects.values_list('user', flat=True)), [eve.pk])
+        self.assertEqual(Post.objects.get(user=eve).like_count, 0)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SOCIAL_GRAPH_SNAPSHOT=None,
+)
+class LikeBufferTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ann, cls.eve, cls.bob = User.objects.bulk_create(
+            User(username=name, email=f'{name}@example.com', password='!') for name in ('ann', 'eve', 'bob')
+        )
+        cls.post = Post.objects.create(user=cls.ann, content='Hello')
+
+    def setUp(self):
+        reset_graph()
+        self.addCleanup(reset_graph)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.buffer = self.open_buffer()
+
+    def open_buffer(self):
+        # Flushed by the tests, not the background thread
+        return LikeBuffer(self.path, interval=3600, max_pending=8)
+
+    def like_count(self):
+        return Post.objects.get(pk=self.post.pk).like_count
+
+    def test_flush_writes_toggles(self):
+        self.assertTrue(self.buffer.toggle(self.eve.pk, self.post.pk, True, False))
+        self.assertFalse(self.buffer.toggle(self.eve.pk, self.post.pk, True, False))
+        self.assertEqual(self.buffer.pending_delta(self.post.pk), 1)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertTrue(Like.objects.filter(user=self.eve, post=self.post).exists())
+        self.assertEqual(self.like_count(), 1)
+        self.assertEqual(self.buffer.pending_delta(self.post.pk), 0)
+        self.assertIsNone(self.buffer.pending_state(self.eve.pk, self.post.pk))
+
+    def test_toggles_are_shared_between_workers(self):
+        other = self.open_buffer()
+        self.buffer.toggle(self.eve.pk, self.post.pk, True, False)
+        self.assertIs(other.pending_state(self.eve.pk, self.post.pk), True)
+        self.assertEqual(other.pending_delta(self.post.pk), 1)
+
+        # An unlike taken by another worker cancels the like before it is written
+        self.assertTrue(other.toggle(self.eve.pk, self.post.pk, False, False))
+        self.assertIsNone(self.buffer.pending_state(self.eve.pk, self.post.pk))
+        self.assertEqual(self.buffer.pending_delta(self.post.pk), 0)
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertFalse(Like.objects.exists())
+
+    def test_flush_with_deleted_user(self):
+        eve_id = self.eve.pk
+        self.buffer.toggle(eve_id, self.post.pk, True, False)
+        User.objects.filter(pk=eve_id).delete()
+        self.assertEqual(self.buffer.flush(), 1)
+        # Nothing left to fail the foreign key check at commit, or to retry
+        connection.check_constraints()
+        self.assertIsNone(self.buffer.pending_state(eve_id, self.post.pk))
+        self.assertEqual(self.buffer.pending_delta(self.post.pk), 0)
+
+        self.buffer.toggle(self.bob.pk, self.post.pk, True, False)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(list(Like.objects.values_list('user', flat=True)), [self.bob.pk])
+        self.assertEqual(self.like_count(), 1)
+
+    def test_failing_toggles_are_dropped(self):
+        self.buffer.toggle(self.eve.pk, self.post.pk, True, False)
+        with mock.patch.object(self.buffer, 'write', side_effect=DatabaseError):
+            for _ in range(MAX_RETRIES - 1):
+                with self.assertRaises(DatabaseError):
+                    self.buffer.flush()
+            self.assertIs(self.buffer.pending_state(self.eve.pk, self.post.pk), True)
+            with self.assertLogs('social.likes', 'ERROR'), self.assertRaises(DatabaseError):
+                self.buffer.flush()
+        self.assertIsNone(self.buffer.pending_state(self.eve.pk, self.post.pk))
+        self.assertEqual(self.buffer.pending_delta(self.post.pk), 0)
+
+    def test_full_buffer_writes_through(self):
+        users = User.objects.bulk_create(
+            User(username=f'fan{i}', email=f'fan{i}@example.com', password='!') for i in range(12)
+        )
+        for user in users:
+            self.assertTrue(self.buffer.toggle(user.pk, self.post.pk, True, False))
+        self.buffer.flush()
+        self.assertEqual(self.like_count(), len(users))
+        self.assertEqual(self.buffer.pending_delta(self.post.pk), 0)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SOCIAL_GRAPH_SNAPSHOT=None,
+    SOCIAL_SHARD_COUNT=2,
+)
+class ShardTests(TestCase):
+    databases = {'default', 'shard0', 'shard1'}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = User.objects.bulk_create(
+            User(username=f'user{i}', email=f'user{i}@example.com', password='!') for i in range(2)
+        )
+
+    def setUp(self):
+        reset_graph()
+        self.addCleanup(reset_graph)
+        for alias in ('shard0', 'shard1'):
+            seed_sequence(alias)
+
+    def shard_ids(self, alias):
+        return sorted(Activity.objects.using(alias).values_list('id', flat=True))
+
+    def test_activities_reach_shards_through_outbox(self):
+        a, b = self.users
+        with self.captureOnCommitCallbacks() as callbacks:
+            create_activity(verb=Activity.Verb.POST_CREATED, actor=a)
+            insert_activities([(Activity.Verb.POST_CREATED, b.pk, None, None, timezone.now())])
+        # Written with the transaction they belong to, moved once it commits
+        outbox = dict(Activity.objects.using('default').values_list('id', 'actor_id'))
+        self.assertEqual(sorted(outbox.values()), [a.pk, b.pk])
+        for callback in callbacks:
+            callback()
+        self.assertFalse(Activity.objects.using('default').exists())
+        for pk, actor_id in outbox.items():
+            self.assertEqual(self.shard_ids(shard_for_user(actor_id)), [pk])
+
+    def test_fanout_slice_and_count(self):
+        now = timezone.now()
+        insert_activities([
+            (Activity.Verb.POST_CREATED, self.users[i % 2].pk, None, None, now - timedelta(minutes=i)) for i in range(7)
+        ])
+        rebalance('default')
+        self.assertTrue(self.shard_ids('shard0') and self.shard_ids('shard1'))
+
+        activities = fanout(Activity.objects.all())
+        self.assertEqual(activities.count(), 7)
+        newest = [activity.created_at for activity in activities[:3]]
+        self.assertEqual(newest, [now - timedelta(minutes=i) for i in range(3)])
+        page = activities[2:5]
+        self.assertEqual([activity.created_at for activity in page], [now - timedelta(minutes=i) for i in range(2, 5)])
+        self.assertEqual(len(list(fanout(Activity.objects.filter(actor=self.users[0])))), 4)
+
+    def test_rebalance_preserves_ids(self):
+        a, b = self.users
+        wrong = 'shard1' if shard_for_user(a.pk) == 'shard0' else 'shard0'
+        right = shard_for_user(a.pk)
+        # Left behind by a shard count change
+        Activity.objects.using(wrong).bulk_create([
+            Activity(id=(5 << 40) + i, verb=Activity.Verb.POST_CREATED, actor_id=a.pk) for i in range(3)
+        ])
+        self.assertEqual(rebalance(wrong), 3)
+        self.assertEqual(self.shard_ids(right), [(5 << 40) + i for i in range(3)])
+        self.assertEqual(self.shard_ids(wrong), [])
+        self.assertEqual(rebalance(wrong), 0)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SOCIAL_GRAPH_SNAPSHOT=None,
+)
+class RowCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ann', 'ann@example.com', 'secret-pw', bio='Hi')
+        cls.post = Post.objects.create(user=cls.user, content='Hello')
+
+    def setUp(self):
+        cache.clear()
+        reset_graph()
+        self.addCleanup(reset_graph)
+
+    def test_rows_are_cached_without_credentials(self):
+        user = get_users([self.user.pk])[self.user.pk]
+        self.assertEqual((user.username, user.bio, user.posts_count), ('ann', 'Hi', 1))
+        get_posts([self.post.pk])
+        with self.assertNumQueries(0):
+            cached = get_posts([self.post.pk])[self.post.pk]
+            self.assertEqual(cached.user.username, 'ann')
+
+        entry = cache.get(f'row:2:user:{self.user.pk}')
+        self.assertNotIn(self.user.password, entry[1])
+        # Fields left out of the cache still load on access
+        with self.assertNumQueries(1):
+            self.assertTrue(user.check_password('secret-pw'))
+
+    def test_save_and_delete_invalidate(self):
+        get_posts([self.post.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            user = User.objects.get(pk=self.user.pk)
+            user.bio = 'Changed'
+            user.save()
+        self.assertEqual(get_users([self.user.pk])[self.user.pk].bio, 'Changed')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Post.objects.create(user=self.user, content='Again')
+        self.assertEqual(get_users([self.user.pk])[self.user.pk].posts_count, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Post.objects.get(pk=self.post.pk).delete()
+        self.assertEqual(get_posts([self.post.pk]), {})
+        self.assertEqual(get_users([self.user.pk])[self.user.pk].posts_count, 1)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SOCIAL_GRAPH_SNAPSHOT=None,
+    SOCIAL_GRAPH_SYNC_INTERVAL=3600,
+)
+class FeedCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader, cls.author, cls.stranger = User.objects.bulk_create(
+            User(username=name, email=f'{name}@example.com', password='!') for name in ('reader', 'author', 'stranger')
+        )
+        Follow.objects.bulk_create([Follow(follower=cls.reader, following=cls.author)])
+
+    def setUp(self):
+        cache.clear()
+        reset_graph()
+        self.addCleanup(reset_graph)
+
+    def post_created(self, actor):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Activity.objects.create(verb=Activity.Verb.POST_CREATED, actor=actor)
+
+    def feed_ids(self):
+        return [activity.id for activity in feed_activities(self.reader.pk)]
+
+    def test_cached_page_is_read_back(self):
+        first = self.post_created(self.author)
+        self.assertEqual(self.feed_ids(), [first.pk])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.feed_ids(), [first.pk])
+
+    def test_activity_of_followed_user_replaces_page(self):
+        self.assertEqual(self.feed_ids(), [])
+        activity = self.post_created(self.author)
+        # Only the actor's token changed, not one per follower
+        self.assertIsNone(cache.get(_activity_keys(self.reader.pk)[1]))
+        self.assertEqual(self.feed_ids(), [activity.pk])
+
+    def test_unrelated_activity_keeps_page(self):
+        self.assertEqual(self.feed_ids(), [])
+        self.post_created(self.stranger)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.feed_ids(), [])
+
+    def test_follow_replaces_page(self):
+        activity = self.post_created(self.stranger)
+        self.assertEqual(self.feed_ids(), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.create(follower=self.reader, following=self.stranger)
+        self.assertEqual(self.feed_ids(), [activity.pk])
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SOCIAL_GRAPH_SNAPSHOT=None,
+    DEGRADED_MAX_WRITES=1,
+)
+class DegradedModeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ann', 'ann@example.com', 'pw')
+        Post.objects.create(user=cls.user, content='Hello')
+
+    def setUp(self):
+        cache.clear()
+        reset_graph()
+        self.addCleanup(reset_graph)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.enterContext(override_settings(DEGRADED_WRITE_LOCK_FILE=path))
+        self.enterContext(mock.patch.object(degraded, '_writes', None))
+        # Rebuilt by the tests that need it, not by a background thread
+        self.enterContext(mock.patch.object(degraded.Revalidator, 'submit'))
+        self.token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def degrade(self):
+        self.enterContext(mock.patch.object(degraded.monitor, 'degraded', True))
+
+    def test_stale_copy_served_while_degraded(self):
+        fresh = self.client.get(reverse('post-list'), **self.auth)
+        self.assertEqual(fresh.status_code, 200)
+        self.degrade()
+        with self.assertNumQueries(1):
+            stale = self.client.get(reverse('post-list'), **self.auth)
+        self.assertEqual(stale['X-Degraded'], 'stale')
+        self.assertEqual(stale.content, fresh.content)
+
+    def test_no_stale_copy_for_revoked_token(self):
+        self.client.get(reverse('post-list'), **self.auth)
+        self.degrade()
+        self.token.delete()
+        response = self.client.get(reverse('post-list'), **self.auth)
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(response.has_header('X-Degraded'))
+
+    def test_no_stale_copy_for_ended_session(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('post-list'))
+        self.degrade()
+        self.assertEqual(self.client.get(reverse('post-list'))['X-Degraded'], 'stale')
+
+        # Logged out elsewhere: the cookie is still sent but names no session
+        self.client.session.delete()
+        response = self.client.get(reverse('post-list'))
+        self.assertFalse(response.has_header('X-Degraded'))
+        self.assertIn(response.status_code, (401, 403))
+
+    def test_writes_shed_with_503(self):
+        self.degrade()
+        slots = degraded._write_slots()
+        slot = slots.acquire()
+        try:
+            response = self.client.post(reverse('post-list'), {'content': 'Hi'}, **self.auth)
+        finally:
+            slots.release(slot)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(settings.DEGRADED_RETRY_AFTER))
+        self.assertFalse(Post.objects.filter(content='Hi').exists())
+
+        # A free slot lets the write through
+        response = self.client.post(reverse('post-list'), {'content': 'Hi'}, **self.auth)
+        self.assertEqual(response.status_code, 201)
+
+    def test_revalidation_replays_a_fresh_request(self):
+        request = self.client.get(reverse('post-list'), {'page': 1}, **self.auth).wsgi_request
+        replayed = degraded.fresh_request(degraded.replay_environ(request))
+        self.assertIsNot(replayed, request)
+        self.assertEqual(replayed.method, 'GET')
+        self.assertEqual(replayed.get_full_path(), request.get_full_path())
+        self.assertEqual(replayed.headers['Authorization'], self.auth['HTTP_AUTHORIZATION'])
+        self.assertEqual(replayed.body, b'')
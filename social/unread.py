@@ -0,0 +1,83 @@
+"""
+Unread activity counters.
+
+Whenever an activity is written, every user who will see it gets their
+``UnreadCounter`` incremented: the followers of the actor (it shows up in
+their activity feed) and the user it targets, minus the actor and anyone
+who blocked the actor. All increments of a write go out as one upsert.
+Marking activities read resets the counter and moves the read watermark.
+Activities compacted or archived before their recipients read them are
+taken back off the counters with ``uncount_unread``.
+"""
+from collections import Counter
+
+from django.utils import timezone
+
+from .bulk import add_counts
+from .graph import get_graph
+from .models import UnreadCounter
+
+
+def recipients(graph, actor_id, target_user_id):
+    users = set(graph.follower_ids(actor_id)) if actor_id else set()
+    if target_user_id:
+        users.add(target_user_id)
+    users.discard(actor_id)
+    if users and actor_id:
+        users.difference_update(graph.blocker_ids(actor_id))
+    return users
+
+
+def count_unread(activities):
+    """
+    Increment the counters for (actor_id, target_user_id) pairs of new
+    activities. Returns the ids of the users whose counters changed.
+    """
+    graph = get_graph()
+    counts = Counter()
+    for actor_id, target_user_id in activities:
+        counts.update(recipients(graph, actor_id, target_user_id))
+    add_counts(UnreadCounter, ['user_id'], 'unread', [(user_id, n) for user_id, n in counts.items()])
+    return set(counts)
+
+
+def uncount_unread(activities):
+    """
+    Decrement the counters for (actor_id, target_user_id, created_at) of
+    removed activities, for each recipient who had not read them yet.
+    Returns the ids of the users whose counters changed.
+    """
+    graph = get_graph()
+    activities = [
+        (recipients(graph, actor_id, target_user_id), created_at)
+        for actor_id, target_user_id, created_at in activities
+    ]
+    users = set().union(*(users for users, _ in activities))
+    counters = {
+        user_id: (unread, last_read_at) for user_id, unread, last_read_at
+        in UnreadCounter.objects.filter(pk__in=users, unread__gt=0).values_list('user_id', 'unread', 'last_read_at')
+    }
+    counts = Counter()
+    for users, created_at in activities:
+        for user_id in users & counters.keys():
+            last_read_at = counters[user_id][1]
+            if last_read_at is None or created_at > last_read_at:
+                counts[user_id] += 1
+    add_counts(UnreadCounter, ['user_id'], 'unread', [
+        (user_id, -min(n, counters[user_id][0])) for user_id, n in counts.items()
+    ])
+    return set(counts)
+
+
+def unread_state(user_id):
+    row = UnreadCounter.objects.filter(pk=user_id).values_list('unread', 'last_read_at').first()
+    unread, last_read_at = row or (0, None)
+    return {'unread': max(unread, 0), 'last_read_at': last_read_at}
+
+
+def mark_read(user_id):
+    now = timezone.now()
+    updated = UnreadCounter.objects.filter(pk=user_id).update(unread=0, last_read_at=now)
+    if not updated:
+        UnreadCounter.objects.get_or_create(user_id=user_id, defaults={'last_read_at': now})
+    return {'unread': 0, 'last_read_at': now}
@@ -0,0 +1,199 @@
+"""
+Resumable chunked image uploads.
+
+A client creates an upload with the file name and total size, then sends
+the bytes with ``PUT`` requests carrying ``Content-Range: bytes
+<start>-<end>/<size>``. Each chunk is streamed from the request straight
+to ``UPLOAD_TEMP_DIR/<id>.part`` without being buffered in memory. A chunk
+must start at the current offset, which ``GET`` returns, so an interrupted
+upload resumes from the last byte that was written. A request holds an
+exclusive ``flock`` on the ``.part`` file while it checks the offset and
+writes, so a concurrent chunk for the same upload gets a 409 instead of
+writing over it. The first chunk must
+begin with a supported image signature or the upload is rejected at once.
+After the last chunk the image is verified and moved to the default
+(content-addressed) storage, ready to be attached to a post.
+"""
+import fcntl
+import os
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image, UnidentifiedImageError
+
+from .models import Upload
+
+READ_SIZE = 64 * 1024
+
+# (content type, extension, signature test on the first bytes)
+SIGNATURES = [
+    ('image/jpeg', '.jpg', lambda head: head.startswith(b'\xff\xd8\xff')),
+    ('image/png', '.png', lambda head: head.startswith(b'\x89PNG\r\n\x1a\n')),
+    ('image/gif', '.gif', lambda head: head[:6] in (b'GIF87a', b'GIF89a')),
+    ('image/webp', '.webp', lambda head: head[:4] == b'RIFF' and head[8:12] == b'WEBP'),
+]
+SIGNATURE_BYTES = 12
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def temp_path(upload):
+    return os.path.join(settings.UPLOAD_TEMP_DIR, f'{upload.id}.part')
+
+
+def sniff(head):
+    for content_type, extension, matches in SIGNATURES:
+        if matches(head):
+            return content_type, extension
+    return None
+
+
+def parse_content_range(header):
+    """
+    Parse ``bytes <start>-<end>/<size>`` into integers
+    """
+    match = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', (header or '').strip())
+    if not match:
+        raise UploadError('Content-Range header of the form "bytes <start>-<end>/<size>" is required')
+    start, end, size = map(int, match.groups())
+    if end < start:
+        raise UploadError('Invalid Content-Range')
+    return start, end, size
+
+
+def start_upload(user, filename, size):
+    if not filename:
+        raise UploadError('filename is required')
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError('size is required')
+    if size <= 0:
+        raise UploadError('size must be positive')
+    if size > settings.UPLOAD_MAX_SIZE:
+        raise UploadError(f'Uploads are limited to {settings.UPLOAD_MAX_SIZE} bytes', status=413)
+    expire_uploads()
+    return Upload.objects.create(user=user, filename=os.path.basename(filename)[:255], size=size)
+
+
+def write_chunk(upload, stream, content_range):
+    """
+    Append one chunk read from ``stream`` at the upload's current offset
+    """
+    if upload.status != 'pending':
+        raise UploadError('Upload is already complete', status=409)
+    start, end, size = parse_content_range(content_range)
+    length = end - start + 1
+    if size != upload.size or end >= upload.size:
+        raise UploadError('Content-Range does not match the upload size')
+    if start != upload.received:
+        raise UploadError(f'Expected a chunk starting at byte {upload.received}', status=409)
+    if length > settings.UPLOAD_CHUNK_SIZE:
+        raise UploadError(f'Chunks are limited to {settings.UPLOAD_CHUNK_SIZE} bytes', status=413)
+    if start == 0 and length < min(SIGNATURE_BYTES, upload.size):
+        raise UploadError(f'The first chunk must contain at least {SIGNATURE_BYTES} bytes')
+
+    os.makedirs(settings.UPLOAD_TEMP_DIR, exist_ok=True)
+    fd = os.open(temp_path(upload), os.O_RDWR | os.O_CREAT, 0o600)
+    with open(fd, 'r+b') as fh:
+        # Claim the upload before touching the file; one chunk is written at a time
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError('Another chunk is being written; query the offset and resume', status=409)
+        try:
+            upload.refresh_from_db(fields=['received', 'status'])
+        except Upload.DoesNotExist:
+            raise UploadError('Upload not found', status=404)
+        if upload.status != 'pending':
+            raise UploadError('Upload is already complete', status=409)
+        if start != upload.received:
+            raise UploadError(f'Expected a chunk starting at byte {upload.received}', status=409)
+        if os.fstat(fh.fileno()).st_size < start:
+            raise UploadError('The uploaded data was lost; start a new upload', status=410)
+        try:
+            write_bytes(upload, fh, stream, start, end)
+        except BaseException:
+            # Roll the file back to the last offset that was recorded
+            if not fh.closed:
+                fh.truncate(start)
+            raise
+    if upload.received == upload.size:
+        finish_upload(upload)
+    return upload
+
+
+def write_bytes(upload, fh, stream, start, end):
+    """
+    Copy the chunk into the claimed ``.part`` file and advance the offset
+    """
+    length = end - start + 1
+    written = 0
+    # Drop anything past the offset left by an interrupted chunk
+    fh.truncate(start)
+    fh.seek(start)
+    while written < length:
+        data = stream.read(min(READ_SIZE, length - written))
+        if not data:
+            break
+        if written == 0 and start == 0:
+            detected = sniff(data[:SIGNATURE_BYTES])
+            if detected is None:
+                fh.close()
+                discard(upload)
+                raise UploadError('Only JPEG, PNG, GIF and WebP images are accepted', status=415)
+            upload.content_type = detected[0]
+        fh.write(data)
+        written += len(data)
+
+    if written != length:
+        raise UploadError(f'Chunk ended after {written} of {length} bytes; resume from {upload.received}')
+    fh.flush()
+    advanced = Upload.objects.filter(id=upload.id, received=start, status='pending').update(
+        received=end + 1, content_type=upload.content_type, updated_at=timezone.now()
+    )
+    if not advanced:
+        raise UploadError('The upload changed while the chunk was written; query the offset and resume', status=409)
+    upload.received = end + 1
+
+
+def finish_upload(upload):
+    path = temp_path(upload)
+    try:
+        with Image.open(path) as image:
+            image.verify()
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+        discard(upload)
+        raise UploadError('The uploaded file is not a valid image', status=415)
+
+    extension = dict((t, e) for t, e, _ in SIGNATURES)[upload.content_type]
+    with open(path, 'rb') as fh:
+        upload.file = default_storage.save(f'posts/{upload.id}{extension}', File(fh))
+    os.remove(path)
+    upload.status = 'complete'
+    upload.save(update_fields=['file', 'status', 'updated_at'])
+
+
+def discard(upload):
+    try:
+        os.remove(temp_path(upload))
+    except FileNotFoundError:
+        pass
+    Upload.objects.filter(id=upload.id).delete()
+
+
+def expire_uploads():
+    """
+    Remove pending uploads that have not received a chunk within UPLOAD_EXPIRY_HOURS
+    """
+    cutoff = timezone.now() - timedelta(hours=settings.UPLOAD_EXPIRY_HOURS)
+    for upload in Upload.objects.filter(status='pending', updated_at__lt=cutoff)[:100]:
+        discard(upload)
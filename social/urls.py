@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import PostViewSet, FollowViewSet, BlockViewSet, ActivityViewSet, LikeViewSet
+from .views import PostViewSet, FollowViewSet, BlockViewSet, ActivityViewSet, LikeViewSet, UploadViewSet, TagViewSet, export, sync
 
 router = DefaultRouter()
 router.register(r'posts', PostViewSet, basename='post')
@@ -8,8 +8,12 @@ router.register(r'follows', FollowViewSet, basename='follow')
 router.register(r'blocks', BlockViewSet, basename='block')
 router.register(r'activities', ActivityViewSet, basename='activity')
 router.register(r'likes', LikeViewSet, basename='like')
+router.register(r'uploads', UploadViewSet, basename='upload')
+router.register(r'tags', TagViewSet, basename='tag')
 
 urlpatterns = [
+    path('export/', export, name='export'),
+    path('sync/', sync, name='sync'),
     path('', include(router.urls)),
 ]
 
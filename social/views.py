@@ -1,91 +1,148 @@
 from rest_framework import viewsets, status
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.db.models import Q
-from .models import Post, Like, Follow, Block, Activity
-from .serializers import PostSerializer, LikeSerializer, FollowSerializer, BlockSerializer, ActivitySerializer
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from .models import Post, Like, Follow, Block, Activity, Upload, Tag
+from .serializers import PostSerializer, LikeSerializer, FollowSerializer, BlockSerializer, ActivitySerializer, UploadSerializer
 from .permissions import IsOwnerOrAdmin
+from .graph import get_graph
+from .likes import coalescing_enabled, get_like_buffer, with_viewer_liked
+from .archive import archived_months, iter_archive
+from .export import iter_export, gzip_stream, parse_cursor
+from .uploads import UploadError, start_upload, write_chunk
+from .tags import trending_tags
+from .sharding import create_activity, fanout
+from .unread import unread_state, mark_read
+from .changelog import changes_since, is_expired, latest_cursor
+from .multiget import MultiGetMixin
+from .rowcache import get_post, with_posts_count
+from accounts.serializers import UserSerializer
 
 User = get_user_model()
 
 
-class PostViewSet(viewsets.ModelViewSet):
+class PostViewSet(MultiGetMixin, viewsets.ModelViewSet):
     serializer_class = PostSerializer
     permission_classes = [IsAuthenticated]
+    throttle_scope = None  # set per action
     
     def get_queryset(self):
         queryset = Post.objects.all()
         
         # Filter out posts from blocked users
         if self.request.user.is_authenticated:
-            blocked_ids = self.request.user.blocked_users.values_list('blocked_id', flat=True)
-            queryset = queryset.exclude(user_id__in=blocked_ids)
+            blocked_ids = get_graph().blocked_ids(self.request.user.id)
+            if blocked_ids:
+                queryset = queryset.exclude(user_id__in=blocked_ids)
         
         # Filter by user if requested
         user_id = self.request.query_params.get('user_id')
         if user_id:
             queryset = queryset.filter(user_id=user_id)
         
-        return queryset.select_related('user').prefetch_related('likes')
+        return with_viewer_liked(queryset.select_related('user'), self.request.user)
     
+    def get_object(self):
+        # Reads come from the row cache; updates and deletes load the current row
+        if self.request.method not in SAFE_METHODS and self.action != 'like':
+            return super().get_object()
+        try:
+            post = get_post(int(self.kwargs['pk']))
+        except (Post.DoesNotExist, ValueError):
+            raise Http404
+        if get_graph().is_blocked(self.request.user.id, post.user_id):
+            raise Http404
+        self.check_object_permissions(self.request, post)
+        return post
+    
+    def get_multi_get_queryset(self):
+        # Posts of blocked users are fetched too, so they can be marked hidden
+        return with_viewer_liked(Post.objects.select_related('user'), self.request.user)
+    
+    def is_hidden(self, post):
+        return get_graph().is_blocked(self.request.user.id, post.user_id)
+    
+    @transaction.atomic
     def perform_create(self, serializer):
         post = serializer.save(user=self.request.user)
         # Create activity
-        Activity.objects.create(
-            activity_type='post_created',
-            actor=self.request.user,
-            description=f"{self.request.user.username} made a post"
+        create_activity(
+            verb=Activity.Verb.POST_CREATED,
+            actor=self.request.user
         )
     
+    @transaction.atomic
     def destroy(self, request, *args, **kwargs):
         post = self.get_object()
         if not (request.user.is_admin() or post.user == request.user):
             return Response({'error': 'Permission denied'}, status=status.HTTP_403_FORBIDDEN)
         
         # Create activity
-        Activity.objects.create(
-            activity_type='post_deleted',
+        create_activity(
+            verb=Activity.Verb.POST_DELETED,
             actor=request.user,
             target_post=post,
-            target_user=post.user,
-            description=f"Post deleted by '{request.user.username}'"
+            target_user=post.user
         )
         
         post.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
     
-    @action(detail=True, methods=['post', 'delete'])
+    @action(detail=True, methods=['post', 'delete'], throttle_scope='like')
     def like(self, request, pk=None):
         post = self.get_object()
+        liked = request.method == 'POST'
         
-        if request.method == 'POST':
-            like, created = Like.objects.get_or_create(user=request.user, post=post)
-            if created:
-                # Create activity
-                Activity.objects.create(
-                    activity_type='post_liked',
-                    actor=request.user,
-                    target_post=post,
-                    target_user=post.user,
-                    description=f"{request.user.username} liked {post.user.username}'s post"
-                )
-                return Response({'message': 'Post liked'}, status=status.HTTP_201_CREATED)
-            return Response({'message': 'Already liked'}, status=status.HTTP_200_OK)
+        if coalescing_enabled():
+            # Buffer the toggle; the flusher writes it with the next batch
+            buffer = get_like_buffer()
+            liked_in_db = buffer.pending_state(request.user.id, post.id)
+            if liked_in_db is None:
+                # Only a toggle the buffer holds no state for needs the database
+                liked_in_db = Like.objects.filter(user=request.user, post=post).exists()
+            changed = buffer.toggle(request.user.id, post.id, liked, liked_in_db)
+            # post comes from the row cache, which the flush invalidates after recounting
+            likes_count = post.like_count + buffer.pending_delta(post.id)
+        else:
+            with transaction.atomic():
+                if liked:
+                    _, changed = Like.objects.get_or_create(user=request.user, post=post)
+                    if changed:
+                        # Create activity
+                        create_activity(
+                            verb=Activity.Verb.POST_LIKED,
+                            actor=request.user,
+                            target_post=post,
+                            target_user=post.user
+                        )
+                else:
+                    changed = Like.objects.filter(user=request.user, post=post).delete()[0] > 0
+            post.refresh_from_db(fields=['like_count'])
+            likes_count = post.like_count
         
-        elif request.method == 'DELETE':
-            Like.objects.filter(user=request.user, post=post).delete()
-            return Response({'message': 'Post unliked'}, status=status.HTTP_200_OK)
+        if liked:
+            message = 'Post liked' if changed else 'Already liked'
+            code = status.HTTP_201_CREATED if changed else status.HTTP_200_OK
+        else:
+            message, code = 'Post unliked', status.HTTP_200_OK
+        return Response({'message': message, 'liked': liked, 'likes_count': likes_count}, status=code)
 
 
 class FollowViewSet(viewsets.ModelViewSet):
     serializer_class = FollowSerializer
     permission_classes = [IsAuthenticated]
+    throttle_scope = 'follow'
     
     def get_queryset(self):
         return Follow.objects.filter(follower=self.request.user)
     
+    @transaction.atomic
     def create(self, request, *args, **kwargs):
         following_id = request.data.get('following_id')
         if not following_id:
@@ -105,17 +162,17 @@ class FollowViewSet(viewsets.ModelViewSet):
             
             if created:
                 # Create activity
-                Activity.objects.create(
-                    activity_type='user_followed',
+                create_activity(
+                    verb=Activity.Verb.USER_FOLLOWED,
                     actor=request.user,
-                    target_user=following_user,
-                    description=f"{request.user.username} followed {following_user.username}"
+                    target_user=following_user
                 )
                 return Response(FollowSerializer(follow).data, status=status.HTTP_201_CREATED)
             return Response({'message': 'Already following'}, status=status.HTTP_200_OK)
         except User.DoesNotExist:
             return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
     
+    @transaction.atomic
     def destroy(self, request, *args, **kwargs):
         follow = self.get_object()
         if follow.follower != request.user:
@@ -131,6 +188,7 @@ class BlockViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return Block.objects.filter(blocker=self.request.user)
     
+    @transaction.atomic
     def create(self, request, *args, **kwargs):
         blocked_id = request.data.get('blocked_id')
         if not blocked_id:
@@ -159,6 +217,7 @@ class BlockViewSet(viewsets.ModelViewSet):
         except User.DoesNotExist:
             return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
     
+    @transaction.atomic
     def destroy(self, request, *args, **kwargs):
         block = self.get_object()
         if block.blocker != request.user:
@@ -173,16 +232,49 @@ class ActivityViewSet(viewsets.ReadOnlyModelViewSet):
     
     def get_queryset(self):
         # Get activities from users in the network (followed users + own activities)
-        followed_ids = self.request.user.following.values_list('following_id', flat=True)
-        user_ids = list(followed_ids) + [self.request.user.id]
+        graph = get_graph()
+        user_ids = set(graph.following_ids(self.request.user.id))
+        user_ids.add(self.request.user.id)
+        
+        # Filter out activities from blocked users
+        user_ids.difference_update(graph.blocked_ids(self.request.user.id))
         
         queryset = Activity.objects.filter(actor_id__in=user_ids)
         
-        # Filter out activities from blocked users
-        blocked_ids = self.request.user.blocked_users.values_list('blocked_id', flat=True)
-        queryset = queryset.exclude(actor_id__in=blocked_ids)
+        # Usernames are batch-loaded by ActivitySerializer
+        return fanout(queryset, user_ids)
+    
+    @action(detail=False, methods=['get'])
+    def unread(self, request):
+        # Badge polling: a single primary-key lookup
+        return Response(unread_state(request.user.id))
+    
+    @action(detail=False, methods=['post'], url_path='mark-read')
+    def mark_read(self, request):
+        return Response(mark_read(request.user.id))
+    
+    def get_object(self):
+        # Works on the merged shard reader as well as on a queryset
+        try:
+            activity = self.get_queryset().get(pk=self.kwargs['pk'])
+        except (Activity.DoesNotExist, ValueError):
+            raise Http404
+        self.check_object_permissions(self.request, activity)
+        return activity
+    
+    @action(detail=False, methods=['get'])
+    def archive(self, request):
+        # Historical lookup in the monthly archives, e.g. ?month=2025-01
+        month = request.query_params.get('month')
+        if not month:
+            return Response({'months': archived_months()})
+        if month not in archived_months():
+            return Response({'error': 'No archive for this month'}, status=status.HTTP_404_NOT_FOUND)
         
-        return queryset.select_related('actor', 'target_user', 'target_post')
+        user_id = None if request.user.is_admin() else request.user.id
+        records = sorted(iter_archive(month, user_id=user_id), key=lambda r: r['created_at'], reverse=True)
+        page = self.paginate_queryset(records)
+        return self.get_paginated_response(page)
 
 
 class LikeViewSet(viewsets.ModelViewSet):
@@ -192,6 +284,7 @@ class LikeViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return Like.objects.filter(user=self.request.user)
     
+    @transaction.atomic
     def destroy(self, request, *args, **kwargs):
         like = self.get_object()
         if not (request.user.is_admin() or like.user == request.user):
@@ -199,3 +292,158 @@ class LikeViewSet(viewsets.ModelViewSet):
         like.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+
+class UploadViewSet(viewsets.GenericViewSet):
+    """
+    Chunked, resumable image uploads (see social/uploads.py):
+    POST to start, PUT chunks with Content-Range, GET for the offset to
+    resume from, then POST attach/ with a post_id.
+    """
+    serializer_class = UploadSerializer
+    permission_classes = [IsAuthenticated]
+    
+    def get_queryset(self):
+        return Upload.objects.filter(user=self.request.user)
+    
+    def create(self, request):
+        try:
+            upload = start_upload(request.user, request.data.get('filename'), request.data.get('size'))
+        except UploadError as e:
+            return Response({'error': str(e)}, status=e.status)
+        return Response(UploadSerializer(upload).data, status=status.HTTP_201_CREATED)
+    
+    def retrieve(self, request, pk=None):
+        return Response(UploadSerializer(self.get_object()).data)
+    
+    def update(self, request, pk=None):
+        upload = self.get_object()
+        # Read the raw body as a stream; request.data would buffer and parse it
+        stream = request.stream
+        if stream is None:
+            return Response({'error': 'Empty chunk'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            write_chunk(upload, stream, request.headers.get('Content-Range'))
+        except UploadError as e:
+            data = {'error': str(e)}
+            if Upload.objects.filter(id=upload.id).exists():
+                upload.refresh_from_db()
+                data['offset'] = upload.received
+            return Response(data, status=e.status)
+        return Response(UploadSerializer(upload).data)
+    
+    @action(detail=True, methods=['post'])
+    def attach(self, request, pk=None):
+        upload = self.get_object()
+        if upload.status != 'complete':
+            return Response({'error': 'Upload is not complete'}, status=status.HTTP_409_CONFLICT)
+        
+        try:
+            post = Post.objects.get(id=request.data.get('post_id'), user=request.user)
+        except (Post.DoesNotExist, ValueError, TypeError):
+            return Response({'error': 'Post not found'}, status=status.HTTP_404_NOT_FOUND)
+        
+        post.image = upload.file
+        post.save(update_fields=['image', 'updated_at'])
+        upload.status = 'attached'
+        upload.save(update_fields=['status', 'updated_at'])
+        return Response(PostSerializer(post, context={'request': request}).data)
+
+
+class TagViewSet(viewsets.GenericViewSet):
+    permission_classes = [IsAuthenticated]
+    lookup_field = 'name'
+    lookup_value_regex = r'\w+'
+    
+    def get_queryset(self):
+        return Tag.objects.all()
+    
+    def retrieve(self, request, name=None):
+        tag = get_object_or_404(Tag, name=name.lower())
+        return Response({'tag': tag.name, 'posts_count': tag.post_tags.count()})
+    
+    @action(detail=True, methods=['get'])
+    def posts(self, request, name=None):
+        # Served from the PostTag index instead of scanning post content
+        posts = Post.objects.filter(post_tags__tag__name=name.lower())
+        blocked_ids = get_graph().blocked_ids(request.user.id)
+        if blocked_ids:
+            posts = posts.exclude(user_id__in=blocked_ids)
+        posts = with_viewer_liked(posts.select_related('user').order_by('-post_tags__created_at'), request.user)
+        page = self.paginate_queryset(posts)
+        serializer = PostSerializer(page, many=True, context={'request': request})
+        return self.get_paginated_response(serializer.data)
+    
+    @action(detail=False, methods=['get'])
+    def trending(self, request):
+        # e.g. ?hours=24&limit=10
+        try:
+            hours = min(max(int(request.query_params.get('hours', 24)), 1), 24 * 7)
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 100)
+        except ValueError:
+            return Response({'error': 'hours and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'hours': hours, 'tags': trending_tags(hours, limit)})
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def export(request):
+    """
+    Stream the requester's posts, likes, follows, blocks and activities as NDJSON.
+    Pass ?cursor=<last cursor received> to resume and ?gzip=1 to compress.
+    """
+    cursor = request.query_params.get('cursor')
+    try:
+        parse_cursor(cursor)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    stream = iter_export(request.user, cursor=cursor)
+    filename = f'midya-{request.user.username}.ndjson'
+    if request.query_params.get('gzip') in ('1', 'true'):
+        response = StreamingHttpResponse(gzip_stream(stream), content_type='application/gzip')
+        filename += '.gz'
+    else:
+        response = StreamingHttpResponse(stream, content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def _sync_querysets(user):
+    return {
+        'posts': (with_viewer_liked(Post.objects.select_related('user'), user), PostSerializer),
+        'likes': (Like.objects.select_related('user'), LikeSerializer),
+        'follows': (Follow.objects.select_related('follower', 'following'), FollowSerializer),
+        'blocks': (Block.objects.select_related('blocker', 'blocked'), BlockSerializer),
+        'users': (with_posts_count(User.objects.all()), UserSerializer),
+    }
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def sync(request):
+    """
+    Posts, likes, follows, blocks and users changed for the requester since
+    ?since=<cursor>, with tombstone ids for deletions. Without a cursor, or
+    when the cursor is older than the retained change log, the response only
+    carries the current cursor and reset=true: reload everything, then sync
+    from that cursor.
+    """
+    since = request.query_params.get('since')
+    if since is None:
+        return Response({'cursor': latest_cursor(), 'reset': True})
+    if not since.isdigit():
+        return Response({'error': 'since must be a cursor returned by this endpoint'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if is_expired(int(since)):
+        return Response({'cursor': latest_cursor(), 'reset': True}, status=status.HTTP_410_GONE)
+    
+    changes, cursor, has_more = changes_since(request.user.id, int(since), settings.SYNC_PAGE_SIZE)
+    data = {'cursor': cursor, 'has_more': has_more, 'reset': False, 'deleted': {}}
+    for name, (queryset, serializer_class) in _sync_querysets(request.user).items():
+        changed, deleted = changes[name]['changed'], changes[name]['deleted']
+        rows = list(queryset.filter(id__in=changed)) if changed else []
+        # Deleted again after the last entry of this page
+        deleted += sorted(set(changed) - {row.id for row in rows})
+        data[name] = serializer_class(rows, many=True, context={'request': request}).data
+        data['deleted'][name] = deleted
+    return Response(data)
@@ -0,0 +1,39 @@
+// Replaces each .load-more marker with the next page of post cards
+// (rendered by social/_post_page.html) once it scrolls into view.
+(function () {
+    function load(marker) {
+        if (marker.dataset.loading) return;
+        marker.dataset.loading = '1';
+        fetch(marker.dataset.next, { credentials: 'same-origin' })
+            .then(response => {
+                if (!response.ok) throw new Error(response.status);
+                return response.text();
+            })
+            .then(html => {
+                const page = document.createRange().createContextualFragment(html);
+                const next = page.querySelector('.load-more');
+                marker.replaceWith(page);
+                if (next) watch(next);
+            })
+            .catch(error => {
+                console.error('Error:', error);
+                delete marker.dataset.loading;
+            });
+    }
+
+    const observer = 'IntersectionObserver' in window ? new IntersectionObserver(entries => {
+        entries.forEach(entry => {
+            if (entry.isIntersecting) {
+                observer.unobserve(entry.target);
+                load(entry.target);
+            }
+        });
+    }, { rootMargin: '600px' }) : null;
+
+    function watch(marker) {
+        marker.querySelector('button').addEventListener('click', () => load(marker));
+        if (observer) observer.observe(marker);
+    }
+
+    document.querySelectorAll('.load-more').forEach(watch);
+})();